@@ -1,11 +1,36 @@
+import itertools
+import json
+from datetime import date
+
 import streamlit as st
-from engine import route_and_answer
+from engine import route_and_answer, route_and_answer_stream, run_horizon, sweep_figure
 
 st.set_page_config(page_title="생산계획 AI 챗봇", page_icon="🏭", layout="wide")
 st.title("🏭 생산계획 AI 챗봇")
 
 # (선택) 디버그 정보 표시 토글
 show_debug = st.sidebar.checkbox("디버그(라우팅/날짜) 표시", value=False)
+use_stream = st.sidebar.checkbox("스트리밍 응답", value=True)
+
+# 기간 평준화 배치 (채팅과 별개로 한 번에 계획)
+with st.sidebar.expander("기간 평준화 배치"):
+    h_start = st.date_input("시작일", value=date(2026, 1, 5))
+    h_end = st.date_input("종료일", value=date(2026, 1, 30))
+    h_util = st.slider("목표 가동률(%)", min_value=50, max_value=100, value=80, step=5)
+    if st.button("배치 계획 실행"):
+        with st.spinner("기간 계획 중..."):
+            st.session_state.horizon = run_horizon(h_start.isoformat(), h_end.isoformat(), h_util / 100.0)
+    if st.session_state.get("horizon"):
+        st.download_button(
+            "이동 계획 JSON",
+            data=json.dumps(st.session_state.horizon["moves"], ensure_ascii=False, indent=2),
+            file_name="horizon_moves.json",
+            mime="application/json",
+        )
+
+if st.session_state.get("horizon"):
+    with st.expander("📊 기간 평준화 결과", expanded=True):
+        st.markdown(st.session_state.horizon["report"])
 
 if "messages" not in st.session_state:
     st.session_state.messages = []
@@ -14,6 +39,8 @@ if "messages" not in st.session_state:
 for m in st.session_state.messages:
     with st.chat_message(m["role"]):
         st.markdown(m["content"])
+        if m.get("sweep"):
+            st.plotly_chart(sweep_figure(m["sweep"]), use_container_width=True)
         if show_debug and m.get("debug"):
             st.code(m["debug"], language="json")
 
@@ -26,10 +53,25 @@ if prompt:
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
-        with st.spinner("분석 중..."):
-            answer, debug = route_and_answer(prompt)
-            st.markdown(answer)
+        if use_stream:
+            # 첫 토큰부터 바로 표시 (debug는 스트림이 끝난 뒤 채워짐)
+            chunks, debug = route_and_answer_stream(prompt)
+            # DB 조회와 첫 토큰 대기는 첫 next()에서 일어나므로 그동안은 스피너를 띄운다
+            with st.spinner("분석 중..."):
+                first = next(chunks, None)
+            answer = st.write_stream(itertools.chain([] if first is None else [first], chunks))
             if show_debug:
                 st.code(debug, language="json")
+        else:
+            with st.spinner("분석 중..."):
+                answer, debug = route_and_answer(prompt)
+                st.markdown(answer)
+                if show_debug:
+                    st.code(debug, language="json")
+
+        # 목표 가동률 스윕이면 감축 곡선도 함께 표시
+        sweep = (debug.get("hybrid_sweep") or {}).get("rows")
+        if sweep:
+            st.plotly_chart(sweep_figure(sweep), use_container_width=True)
 
-    st.session_state.messages.append({"role": "assistant", "content": answer, "debug": debug})
+    st.session_state.messages.append({"role": "assistant", "content": answer, "debug": debug, "sweep": sweep})
@@ -0,0 +1,330 @@
+# bench.py - engine 마이크로벤치마크
+# 사용법: python bench.py router [--n 5000]
+#         python bench.py slack [--days 30 90 180] [--products 300]
+#         python bench.py reduce [--n 200] [--items 30] [--days 10] [--time-limit 2.0]
+#         python bench.py dtypes [--days 90] [--products 300]
+#         python bench.py ledger [--days 365] [--horizon 60] [--n 2000]
+import argparse
+import random
+import time
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+import engine
+
+
+def _korean_prompts(n: int, seed: int = 0) -> list:
+    rnd = random.Random(seed)
+    templates = [
+        "{m}월 CAPA 초과한 날?",
+        "{m}월 {m2}월 총 생산량 브리핑",
+        "{m}월 {d}일 T6 생산량 알려줘",
+        "{m}/{d} 조립{l} {p}%만 생산하고 싶어",
+        "{m}/{d} T6 샘플 {q}개 추가",
+        "{m}월 팬 생산량",
+        "부품 결품 사례 보여줘",
+        "{m}월 {d}일 A2XX 0차 최종 비교해줘",
+        "내일 조립{l} 가동률 {p}% 맞춰줘",
+        "{m}월 카파 알려줘",
+    ]
+    out = []
+    for _ in range(n):
+        t = rnd.choice(templates)
+        out.append(t.format(
+            m=rnd.randint(1, 12), m2=rnd.randint(1, 12), d=rnd.randint(1, 28),
+            l=rnd.randint(1, 3), p=rnd.randint(50, 95), q=rnd.randint(1, 20) * 50,
+        ))
+    return out
+
+
+def _rate(fn, items) -> float:
+    t0 = time.perf_counter()
+    for x in items:
+        fn(x)
+    dt = time.perf_counter() - t0
+    return len(items) / dt if dt > 0 else float("inf")
+
+
+def bench_router(n: int):
+    prompts = _korean_prompts(n)
+    print(f"[router] prompts={n}")
+    print(f"- classify_route : {_rate(engine.classify_route, prompts):,.0f} prompts/s")
+    print(f"- parse_query    : {_rate(engine.parse_query, prompts):,.0f} prompts/s")
+
+    # 어휘가 늘어나도 자동기계 스캔 비용은 프롬프트 길이에만 비례해야 한다
+    rnd = random.Random(1)
+    syllables = [chr(c) for c in range(0xAC00, 0xAC00 + 400)]
+    for extra in (0, 1000, 10000):
+        vocab = ["".join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4))) for _ in range(extra)]
+        auto = engine._KeywordAutomaton({
+            "hybrid": engine.HYBRID_INTENT_WORDS + vocab,
+            "legacy": engine.LEGACY_FORCE_WORDS,
+        })
+        print(f"- automaton scan (+{extra:,} words): {_rate(auto.scan, prompts):,.0f} prompts/s")
+
+
+def _synthetic_plan(days: int, products: int, seed: int = 0, start: date = date(2026, 1, 1)) -> pd.DataFrame:
+    """hybrid plan 테이블 모양의 합성 계획 (품목-날짜당 최대 1행, 주말은 휴무)"""
+    rnd = random.Random(seed)
+    lines = ["조립1", "조립2", "조립3"]
+    prods = [(f"{rnd.choice(['T6', 'A2XX', 'B1', 'C9'])}-{i:04d}", rnd.choice(lines), rnd.choice([10, 20, 40, 50]))
+             for i in range(products)]
+    rows = []
+    for k in range(days):
+        d = start + timedelta(days=k)
+        workday = d.weekday() < 5
+        for name, line, plt in prods:
+            if rnd.random() < 0.3:
+                q1 = rnd.randint(0, 20) * plt if workday else 0
+                q0 = max(0, q1 + rnd.randint(-3, 3) * plt) if rnd.random() < 0.8 else 0
+                rows.append({"plan_date": d.isoformat(), "line": line, "product_name": name,
+                             "qty_0차": q0, "qty_1차": q1, "plt": plt, "is_workday": workday})
+    return pd.DataFrame(rows)
+
+
+def _slack_reference(plan_df, stock_result):
+    """벡터화 이전 step2 구현(품목마다 필터/정렬/누적합) - 동등성 기준"""
+    items_with_slack = []
+    for item in stock_result['items']:
+        p_name = item['name']
+        p_series = plan_df[plan_df['product_name'] == p_name].sort_values('plan_date').copy()
+        if p_series.empty:
+            continue
+        p_series['cumsum_0차'] = p_series['qty_0차'].cumsum()
+        p_series['cumsum_1차'] = p_series['qty_1차'].cumsum()
+        today_row = p_series[p_series['plan_date'] == stock_result['date']]
+        if today_row.empty:
+            continue
+        today_row = today_row.iloc[0]
+        cumsum_target = int(today_row.get('cumsum_0차', 0))
+        cumsum_actual = int(today_row.get('cumsum_1차', 0))
+        max_movable_cumsum = cumsum_actual - cumsum_target
+        future_demand = int(p_series[p_series['plan_date'] > stock_result['date']]['qty_0차'].sum())
+        future_prod = int(p_series[p_series['plan_date'] > stock_result['date']]['qty_1차'].sum())
+        future_slack = int(future_prod - future_demand)
+        if max_movable_cumsum > 0:
+            max_movable = max_movable_cumsum
+        elif future_slack >= 0:
+            max_movable = int(item['qty_1차'])
+        else:
+            max_movable = max(0, int(item['qty_1차']) + future_slack)
+        due_dates = p_series[p_series['qty_0차'] > 0]['plan_date'].tolist()
+        last_due = max(due_dates) if due_dates else "미확인"
+        if last_due != "미확인":
+            buffer_days = (datetime.strptime(last_due, '%Y-%m-%d').date() -
+                           datetime.strptime(stock_result['date'], '%Y-%m-%d').date()).days
+        else:
+            buffer_days = 999
+        items_with_slack.append({
+            'name': p_name, 'qty_0차': int(item.get('qty_0차', 0)), 'qty_1차': int(item['qty_1차']),
+            'plt': int(item['plt']), 'cumsum_target': int(cumsum_target), 'cumsum_actual': int(cumsum_actual),
+            'future_slack': int(future_slack), 'max_movable': int(max_movable), 'last_due': last_due,
+            'buffer_days': int(buffer_days), 'movable': int(max_movable) >= int(item['plt']),
+        })
+    return items_with_slack
+
+
+def bench_slack(days_list: list, products: int):
+    engine.initialize_globals(date(2026, 1, 1), {"조립1": 3300, "조립2": 3700, "조립3": 3600})
+    for days in days_list:
+        df = _synthetic_plan(days, products)
+        dates = sorted(df["plan_date"].unique())
+        probes = [(d, ln) for d in dates[::max(1, len(dates) // 10)] for ln in ("조립1", "조립2", "조립3")]
+
+        t0 = time.perf_counter()
+        ref = []
+        for d, ln in probes:
+            stock, _ = engine.step1_list_current_stock(df, d, ln)
+            if stock:
+                ref.append(_slack_reference(df, stock))
+        t_ref = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        pf = engine.PlanFrame(df)
+        new = []
+        for d, ln in probes:
+            stock, _ = engine.step1_list_current_stock(pf, d, ln)
+            if stock:
+                new.append(engine.step2_calculate_cumulative_slack(pf, stock))
+        t_new = time.perf_counter() - t0
+
+        assert ref == new, f"step2 결과 불일치 (days={days})"
+        print(f"[slack] rows={len(df):,} days={days} probes={len(probes)} : "
+              f"loop {t_ref * 1000:,.0f}ms / vectorized {t_new * 1000:,.0f}ms (equal)")
+
+
+def _reduce_instance(rnd: random.Random, n_items: int, days: int = 10):
+    """감축 문제 합성 인스턴스: 2026-01-05 조립1에서 감축, 당일 조립2/3 + 이후 days일 조립1 목적지"""
+    from_loc, target_line = "2026-01-05_조립1", "조립1"
+    constraint_info = []
+    for i in range(n_items):
+        kind = rnd.choice(["T6", "A2XX", "D1", "D1"])
+        plt = rnd.choice([20, 30, 40, 50, 60, 100])
+        units = rnd.randint(1, 12)
+        constraint_info.append({
+            "name": f"{kind}-{i:03d}", "plt": plt, "qty_1차": units * plt,
+            "max_movable": units * plt - rnd.choice([0, 0, plt, 2 * plt]) + rnd.randint(0, plt - 1),
+            "is_t6": kind == "T6", "is_a2xx": kind == "A2XX", "buffer_days": rnd.randint(0, 20),
+        })
+    capa_status = {f"2026-01-05_{ln}": {"remaining": rnd.randint(-200, 900)} for ln in ("조립2", "조립3")}
+    for k in range(1, days + 1):
+        capa_status[f"{date(2026, 1, 5) + timedelta(days=k)}_조립1"] = {"remaining": rnd.randint(-300, 700)}
+    need = rnd.randint(20, 200) * 10
+    return constraint_info, capa_status, from_loc, target_line, need
+
+
+def bench_reduce(n: int, n_items: int, time_limit: float, days: int = 10):
+    rnd = random.Random(7)
+    stats = {"greedy": [], "optimal": []}
+    proven, opt_ms = 0, []
+    for _ in range(n):
+        ci, cs, from_loc, line, need = _reduce_instance(rnd, n_items, days)
+
+        t0 = time.perf_counter()
+        g = engine._fallback_reduce(ci, {k: dict(v) for k, v in cs.items()}, from_loc, line, need)
+        g_ms = (time.perf_counter() - t0) * 1000
+        o, info = engine._optimal_reduce(ci, cs, from_loc, line, need, time_limit=time_limit)
+
+        for key, moves, ms in (("greedy", g, g_ms), ("optimal", o, info["ms"])):
+            moved = sum(m["qty"] for m in moves)
+            stats[key].append((need - moved, moved >= need, len(moves), ms))
+        proven += info["optimal"]
+        opt_ms.append(info["ms"])
+
+    print(f"[reduce] instances={n} items={n_items} days={days} time_limit={time_limit}s")
+    for key, rows in stats.items():
+        short = sum(r[0] for r in rows) / len(rows)
+        met = 100.0 * sum(r[1] for r in rows) / len(rows)
+        moves = sum(r[2] for r in rows) / len(rows)
+        ms = sorted(r[3] for r in rows)
+        print(f"- {key:<8}: avg shortfall {short:,.1f} / need met {met:.1f}% / avg moves {moves:.2f} / "
+              f"p50 {ms[len(ms) // 2]:.1f}ms p95 {ms[int(len(ms) * 0.95)]:.1f}ms")
+    print(f"- proven optimal: {proven}/{n}")
+
+
+def _ms(fn, n: int = 20) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n * 1000
+
+
+def bench_dtypes(days: int, products: int):
+    engine.initialize_globals(date(2026, 1, 1), {"조립1": 3300, "조립2": 3700, "조립3": 3600})
+    raw = _synthetic_plan(days, products)
+    typed = engine.typed_plan_frame(raw)
+    probe = raw["plan_date"].iloc[len(raw) // 2]
+    probe_ts = pd.Timestamp(probe)
+
+    print(f"[dtypes] rows={len(raw):,} days={days} products={products} "
+          f"(typed_plan_frame {_ms(lambda: engine.typed_plan_frame(raw), 5):.1f}ms)")
+    print(f"- memory        : object {raw.memory_usage(deep=True).sum() / 1e6:.2f}MB / "
+          f"typed {typed.memory_usage(deep=True).sum() / 1e6:.2f}MB")
+    print(f"- date/line mask: object {_ms(lambda: raw[(raw['plan_date'] == probe) & (raw['line'] == '조립1')]):.2f}ms / "
+          f"typed {_ms(lambda: typed[(typed['plan_date'] == probe_ts) & (typed['line'] == '조립1')]):.2f}ms")
+    for name, cols in (("date/line sum", ["plan_date", "line"]), ("product sum", ["product_name"])):
+        r = _ms(lambda: raw.groupby(cols, sort=False)["qty_1차"].sum())
+        t = _ms(lambda: typed.groupby(cols, sort=False, observed=True)["qty_1차"].sum())
+        print(f"- {name:<14}: object {r:.2f}ms / typed {t:.2f}ms")
+    print(f"- PlanFrame     : object {_ms(lambda: engine.PlanFrame(raw), 5):.1f}ms / "
+          f"typed {_ms(lambda: engine.PlanFrame(typed), 5):.1f}ms")
+
+    a, b = engine.compute_slack_table(raw), engine.compute_slack_table(typed)
+    assert a.equals(b), "slack 테이블 불일치(object vs typed)"
+    pa, pb = engine.PlanFrame(raw), engine.PlanFrame(typed)
+    for d in pa.calendar.days[::5]:
+        for ln in ("조립1", "조립2", "조립3"):
+            sa, _ = engine.step1_list_current_stock(pa, d, ln)
+            sb, _ = engine.step1_list_current_stock(pb, d, ln)
+            assert sa == sb and engine.step3_analyze_destination_capacity(pa, d, ln) == \
+                engine.step3_analyze_destination_capacity(pb, d, ln), f"단계 결과 불일치 ({d} {ln})"
+    print("- step1/2/3 results: equal")
+
+
+def bench_ledger(days: int, horizon: int, n: int):
+    """장기 목적지 탐색: capa_status 사전 스캔 vs CapacityLedger 구간 질의 (같은 답인지 확인)"""
+    engine.initialize_globals(date(2026, 1, 1), {"조립1": 3300, "조립2": 3700, "조립3": 3600})
+    pf = engine.PlanFrame(engine.typed_plan_frame(_synthetic_plan(days, 40 * days // 30)))
+    t0 = time.perf_counter()
+    ledger = engine.CapacityLedger.from_plan(pf)
+    build_ms = (time.perf_counter() - t0) * 1000
+    flat = {f"{d}_{ln}": ledger.status(ln, d) for d in pf.calendar.days for ln in ledger.lines}
+
+    rnd = random.Random(5)
+    queries = []
+    for _ in range(n):
+        start = rnd.choice(pf.calendar.days)
+        span = pf.calendar.next(start, horizon)
+        queries.append((rnd.choice(ledger.lines), start, span[-1], span, rnd.randint(1, 40) * 50))
+
+    def scan():
+        out = []
+        for ln, start, end, span, qty in queries:
+            rems = [(flat[f"{d}_{ln}"]["remaining"], d) for d in span]
+            best = max(r for r, _ in rems)
+            out.append((best, next((d for r, d in rems if r >= qty), None)))
+        return out
+
+    def tree():
+        return [(ledger.max_remaining(ln, start, end)[0], ledger.first_fit(ln, start, end, qty))
+                for ln, start, end, span, qty in queries]
+
+    assert scan() == tree(), "장부 질의 결과 불일치"
+    print(f"[ledger] dates={len(pf.dates)} workdays={len(pf.calendar.days)} horizon={horizon} queries={n} "
+          f"(build {build_ms:.1f}ms)")
+    print(f"- max/first-fit : dict scan {_ms(scan, 3):.1f}ms / ledger {_ms(tree, 3):.1f}ms (equal)")
+
+    moves = [(rnd.choice(ledger.lines), rnd.choice(pf.calendar.days), rnd.randint(1, 10) * 50) for _ in range(20)]
+
+    def copy_and_apply():
+        cs = {k: dict(v) for k, v in flat.items()}
+        for ln, d, q in moves:
+            cs[f"{d}_{ln}"]["remaining"] -= q
+
+    def snapshot_and_rollback():
+        token = ledger.snapshot()
+        for ln, d, q in moves:
+            ledger.reserve(ln, d, q)
+        ledger.rollback(token)
+
+    print(f"- trial plan    : dict copy {_ms(copy_and_apply, 50):.2f}ms / snapshot+rollback "
+          f"{_ms(snapshot_and_rollback, 50):.2f}ms")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="engine microbenchmarks")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("router")
+    p.add_argument("--n", type=int, default=5000)
+    p = sub.add_parser("slack")
+    p.add_argument("--days", type=int, nargs="+", default=[30, 90, 180])
+    p.add_argument("--products", type=int, default=300)
+    p = sub.add_parser("reduce")
+    p.add_argument("--n", type=int, default=200)
+    p.add_argument("--items", type=int, default=30)
+    p.add_argument("--days", type=int, default=10)
+    p.add_argument("--time-limit", type=float, default=2.0)
+    p = sub.add_parser("dtypes")
+    p.add_argument("--days", type=int, default=90)
+    p.add_argument("--products", type=int, default=300)
+    p = sub.add_parser("ledger")
+    p.add_argument("--days", type=int, default=365)
+    p.add_argument("--horizon", type=int, default=60)
+    p.add_argument("--n", type=int, default=2000)
+    args = ap.parse_args()
+
+    if args.cmd == "router":
+        bench_router(args.n)
+    elif args.cmd == "slack":
+        bench_slack(args.days, args.products)
+    elif args.cmd == "reduce":
+        bench_reduce(args.n, args.items, args.time_limit, args.days)
+    elif args.cmd == "dtypes":
+        bench_dtypes(args.days, args.products)
+    elif args.cmd == "ledger":
+        bench_ledger(args.days, args.horizon, args.n)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,32 @@
 import os
 import re
 import json
+import math
+import bisect
+import functools
+import asyncio
+import hashlib
+import time
+import random
+import sqlite3
+import contextvars
+import tempfile
+import threading
+import weakref
+import atexit
 import requests
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, asdict
 from datetime import datetime, timedelta, date
 
+import httpx
+import numpy as np
 import pandas as pd
 import streamlit as st
+from requests.adapters import HTTPAdapter
 from supabase import create_client, Client
 
-# (Optional) Gemini SDK
-try:
-    import google.generativeai as genai
-except Exception:
-    genai = None
-
 
 # =============================================================================
 # Secrets & Clients
@@ -51,6 +64,88 @@ CAPA_LIMITS_DEFAULT = SECRETS.get("CAPA_LIMITS", {"조립1": 3300, "조립2": 37
 HYBRID_REPORT_STYLE = str(SECRETS.get("HYBRID_REPORT_STYLE", "investigation")).lower()  # investigation | simple
 HYBRID_DEFAULT_TARGET_UTIL = float(SECRETS.get("HYBRID_DEFAULT_TARGET_UTIL", 0.81))  # 예시 리포트의 81%
 HYBRID_TARGET_ROUNDING = int(SECRETS.get("HYBRID_TARGET_ROUNDING", 100))  # 목표 수량 반올림 단위(100단위 등)
+HYBRID_AI_DEADLINE_SEC = float(SECRETS.get("HYBRID_AI_DEADLINE_SEC", 20))  # AI 계획 대기 한도(넘으면 폴백 계획 사용)
+HYBRID_OPTIMAL_PLANNER = bool(SECRETS.get("HYBRID_OPTIMAL_PLANNER", True))  # False면 기존 greedy 폴백
+HYBRID_OPT_TIME_LIMIT_SEC = float(SECRETS.get("HYBRID_OPT_TIME_LIMIT_SEC", 2.0))  # 최적화 탐색 시간 한도
+HYBRID_OPT_NODE_BUDGET = int(SECRETS.get("HYBRID_OPT_NODE_BUDGET", 200000))  # 배치(평준화/스윕) 탐색 노드 한도(시간 대신, 결과 재현용)
+HYBRID_HORIZON_WORKERS = int(SECRETS.get("HYBRID_HORIZON_WORKERS", min(4, os.cpu_count() or 1)))  # 배치 평준화/스윕 공용 스레드 수
+HYBRID_PLAN_WINDOW_DAYS = int(SECRETS.get("HYBRID_PLAN_WINDOW_DAYS", 10))  # 대상일 기준 ±N일 계획을 읽음
+HYBRID_DEST_HORIZON_DAYS = int(SECRETS.get("HYBRID_DEST_HORIZON_DAYS", 10))  # 같은 라인 이후 목적지 근무일 수(읽은 계획 구간 안에서)
+HYBRID_DAILY_CAPA = bool(SECRETS.get("HYBRID_DAILY_CAPA", False))  # daily_capa(최종)의 일/월별 CAPA 사용, 없으면 CAPA_LIMITS
+HYBRID_PLAN_CACHE_TTL_SEC = float(SECRETS.get("HYBRID_PLAN_CACHE_TTL_SEC", 600))  # 받아 둔 날짜 구간 유지 시간
+HYBRID_SWEEP_MIN_PCT = int(SECRETS.get("HYBRID_SWEEP_MIN_PCT", 30))  # 스윕 목표 가동률 하한(%), 미만 값은 버림
+
+# Legacy local snapshot config (레거시 조회 테이블을 로컬 SQLite로 미러링)
+LEGACY_SNAPSHOT_ENABLED = bool(SECRETS.get("LEGACY_SNAPSHOT_ENABLED", False))
+LEGACY_SNAPSHOT_PATH = str(SECRETS.get("LEGACY_SNAPSHOT_PATH", os.path.join(tempfile.gettempdir(), "chatbot_legacy_snapshot.sqlite3")))
+LEGACY_SNAPSHOT_SYNC_SEC = int(SECRETS.get("LEGACY_SNAPSHOT_SYNC_SEC", 900))
+# 마지막 동기화가 이보다 오래된 테이블은 원격으로 조회(동기화 실패가 이어질 때 오래된 답을 주지 않도록, 0이면 제한 없음)
+LEGACY_SNAPSHOT_MAX_AGE_SEC = int(SECRETS.get("LEGACY_SNAPSHOT_MAX_AGE_SEC", LEGACY_SNAPSHOT_SYNC_SEC * 4))
+LEGACY_SNAPSHOT_PAGE_SIZE = int(SECRETS.get("LEGACY_SNAPSHOT_PAGE_SIZE", 1000))
+LEGACY_SNAPSHOT_TABLES = ["production_data", "daily_capa", "daily_total_production", "monthly_production"]
+# 증분 동기화: {"production_data": {"cursor": "updated_at", "keys": ["id"]}} 형태. 없으면 전체 재적재.
+LEGACY_SNAPSHOT_CURSORS = SECRETS.get("LEGACY_SNAPSHOT_CURSORS", {})
+# 증분 테이블도 이 주기마다 전체 재적재(커서를 바꾸지 않는 수정/삭제 반영, 0이면 하지 않음)
+LEGACY_SNAPSHOT_FULL_RESYNC_SEC = int(SECRETS.get("LEGACY_SNAPSHOT_FULL_RESYNC_SEC", 6 * 3600))
+
+# Legacy query result cache config (동일 조회 결과를 세션 간 공유)
+LEGACY_QUERY_CACHE_ENABLED = bool(SECRETS.get("LEGACY_QUERY_CACHE_ENABLED", True))
+LEGACY_QUERY_CACHE_TTL_SEC = float(SECRETS.get("LEGACY_QUERY_CACHE_TTL_SEC", 300))
+LEGACY_QUERY_CACHE_MAX_ENTRIES = int(SECRETS.get("LEGACY_QUERY_CACHE_MAX_ENTRIES", 512))
+LEGACY_QUERY_CACHE_TABLE_TTLS = SECRETS.get("LEGACY_QUERY_CACHE_TABLE_TTLS", {
+    "final_issue": 3600,
+    "production_issue_analysis_8_11": 3600,
+})
+
+# Aggregation pushdown RPC ("" 이면 RPC를 쓰지 않고 로컬 집계)
+LEGACY_AGG_RPC = str(SECRETS.get("LEGACY_AGG_RPC", "legacy_agg_sum"))
+LEGACY_AGG_RPC_RETRY_SEC = float(SECRETS.get("LEGACY_AGG_RPC_RETRY_SEC", 600))
+
+# 독립 쿼리 동시 실행 스레드 수
+QUERY_FANOUT_WORKERS = int(SECRETS.get("QUERY_FANOUT_WORKERS", 8))
+
+# 프로젝션 검사 모드: 프로젝션에 없는 컬럼을 읽으면 ProjectionError (개발/검증용)
+PROJECTION_CHECK = bool(SECRETS.get("PROJECTION_CHECK", False))
+
+# 품명 trigram 인덱스 (ilike '%키워드%' 대신 품명 equality 필터)
+PRODUCT_INDEX_ENABLED = bool(SECRETS.get("PRODUCT_INDEX_ENABLED", True))
+PRODUCT_CATALOG_TTL_SEC = float(SECRETS.get("PRODUCT_CATALOG_TTL_SEC", 3600))
+PRODUCT_FUZZY_THRESHOLD = float(SECRETS.get("PRODUCT_FUZZY_THRESHOLD", 0.35))
+PRODUCT_IN_MAX = int(SECRETS.get("PRODUCT_IN_MAX", 50))  # 이보다 많이 매칭되면 ilike로 조회
+# 고유 품명 RPC ("" 이면 RPC 없이 품명 컬럼을 페이지로 훑음). 함수 정의는 PRODUCT_CATALOG_RPC_SQL
+PRODUCT_CATALOG_RPC = str(SECRETS.get("PRODUCT_CATALOG_RPC", "legacy_product_names"))
+
+# Gemini REST transport (legacy/hybrid 공용, keep-alive 세션)
+GEMINI_MODEL = str(SECRETS.get("GEMINI_MODEL", "gemini-2.0-flash-exp"))
+GEMINI_BASE_URL = str(SECRETS.get("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta")).rstrip("/")
+GEMINI_CONNECT_TIMEOUT = float(SECRETS.get("GEMINI_CONNECT_TIMEOUT", 5))
+GEMINI_READ_TIMEOUT = float(SECRETS.get("GEMINI_READ_TIMEOUT", 60))
+GEMINI_DEADLINE_SEC = float(SECRETS.get("GEMINI_DEADLINE_SEC", 90))  # 재시도 포함 요청당 전체 제한
+GEMINI_MAX_RETRIES = int(SECRETS.get("GEMINI_MAX_RETRIES", 2))
+GEMINI_BACKOFF_SEC = float(SECRETS.get("GEMINI_BACKOFF_SEC", 0.5))
+
+# Gemini 응답 캐시 (메모리 LRU + 선택적 디스크 SQLite)
+LLM_CACHE_ENABLED = bool(SECRETS.get("LLM_CACHE_ENABLED", True))
+LLM_CACHE_TTL_SEC = float(SECRETS.get("LLM_CACHE_TTL_SEC", 3600))
+LLM_CACHE_MAX_ENTRIES = int(SECRETS.get("LLM_CACHE_MAX_ENTRIES", 256))
+LLM_CACHE_PATH = str(SECRETS.get("LLM_CACHE_PATH", ""))  # 비어 있으면 디스크 계층 사용 안 함
+
+# 구조화된 레거시 Context는 Gemini 없이 로컬 템플릿으로 표/제목을 만든다
+LEGACY_TEMPLATE_RENDER = bool(SECRETS.get("LEGACY_TEMPLATE_RENDER", True))
+
+# LLM 프롬프트에 넣는 표 형태 Context의 토큰 예산(추정치 기준, 0이면 제한 없음)
+LLM_CONTEXT_TOKEN_BUDGET = int(SECRETS.get("LLM_CONTEXT_TOKEN_BUDGET", 1500))
+
+# 페이지 단위 조회 크기 (PostgREST max-rows 이하로 둘 것: 짧은 페이지를 마지막 페이지로 판단)
+PAGED_FETCH_SIZE = int(SECRETS.get("PAGED_FETCH_SIZE", 1000))
+# 페이지 조회 정렬의 앞 컬럼(테이블 -> 기본키/자연키). PostgREST는 ORDER BY 없이는 페이지 간 순서를 보장하지 않는다.
+# 정렬은 항상 "조회하는 컬럼 전체"로 완성한다(page_order_for): 키가 유일하지 않거나 없어도 동률 행은
+# 조회 컬럼 값이 모두 같아 어느 쪽을 받아도 결과가 같다. 여기 키는 DB 인덱스를 타게 하는 선두 컬럼일 뿐이다.
+PAGED_ORDER_KEYS = SECRETS.get("PAGED_ORDER_KEYS", {
+    "daily_capa": ["월", "버전", "날짜", "라인"],
+    "daily_total_production": ["월", "버전", "날짜", "라인"],
+    "monthly_production": ["월", "버전"],
+})
 
 
 @st.cache_resource
@@ -64,11 +159,1468 @@ def init_supabase() -> Client | None:
 
 supabase: Client | None = init_supabase()
 
-if genai and GEMINI_API_KEY:
+
+# =============================================================================
+# Local Snapshot (legacy tables)
+# =============================================================================
+
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+class _QueryResult:
+    """postgrest 응답과 같은 모양(.data/.count)의 로컬 조회 결과"""
+    __slots__ = ("data", "count")
+
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+def _qi(name: str) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _to_sql_value(v):
+    if isinstance(v, (dict, list)):
+        return json.dumps(v, ensure_ascii=False)
+    return v
+
+
+def _like_to_glob(pattern: str) -> str:
+    """SQL LIKE 패턴(%, _, \\ 이스케이프) -> 대소문자를 구분하는 SQLite GLOB 패턴"""
+    out, i = [], 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\" and i + 1 < len(pattern):
+            i += 1
+            ch = pattern[i]
+            out.append(f"[{ch}]" if ch in "*?[" else ch)
+        elif ch == "%":
+            out.append("*")
+        elif ch == "_":
+            out.append("?")
+        elif ch in "*?[":
+            out.append(f"[{ch}]")
+        else:
+            out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def _recorded(method):
+    """빌더 호출을 기록해 로컬에서 처리할 수 없을 때 원격 쿼리로 그대로 재생할 수 있게 한다."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._calls.append((method.__name__, args, kwargs))
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _split_or_filters(filters: str) -> list:
+    """PostgREST or 문자열을 최상위 쉼표로 나눈다('col.in.(a,b)'의 괄호 안 쉼표는 유지)"""
+    parts, depth, cur = [], 0, []
+    for ch in filters:
+        if ch == "," and depth == 0:
+            parts.append("".join(cur).strip())
+            cur = []
+            continue
+        depth += (ch == "(") - (ch == ")")
+        cur.append(ch)
+    parts.append("".join(cur).strip())
+    return [p for p in parts if p]
+
+
+class _SnapshotQuery:
+    """
+    supabase 쿼리 빌더 체인(select/eq/ilike/in_/or_/limit/range/order)을
+    로컬 SQLite 스냅샷 위에서 그대로 실행한다.
+    로컬에서 처리할 수 없는 조회(지원하지 않는 or_ 연산자, 스냅샷에 없는 컬럼)는
+    기록해 둔 빌더 호출을 원격 클라이언트에 재생해 실행한다.
+    """
+
+    _OR_OPS = {"eq": "=", "neq": "!=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<=", "like": "GLOB", "ilike": "LIKE"}
+
+    def __init__(self, store: "LocalSnapshotStore", table: str):
+        self._store = store
+        self._table = table
+        self._columns = None
+        self._where = []
+        self._params = []
+        self._order = []
+        self._limit = None
+        self._offset = None
+        self._calls = []
+        self._unsupported = None
+
+    @_recorded
+    def select(self, columns: str = "*", **_kwargs):
+        cols = [c.strip() for c in str(columns).split(",") if c.strip()]
+        self._columns = None if (not cols or cols == ["*"]) else cols
+        return self
+
+    def _cmp(self, col, op, val):
+        if isinstance(val, str) and _DATE_RE.match(val):
+            # DB 쪽 date/timestamp 비교와 맞추기 위해 앞 10자리(YYYY-MM-DD)로 비교
+            return f"substr({_qi(col)}, 1, 10) {op} ?", [val]
+        return f"{_qi(col)} {op} ?", [_to_sql_value(val)]
+
+    def _add(self, clause, params):
+        self._where.append(clause)
+        self._params.extend(params)
+        return self
+
+    @_recorded
+    def eq(self, col, val):
+        return self._add(*self._cmp(col, "=", val))
+
+    @_recorded
+    def neq(self, col, val):
+        return self._add(*self._cmp(col, "!=", val))
+
+    @_recorded
+    def gt(self, col, val):
+        return self._add(*self._cmp(col, ">", val))
+
+    @_recorded
+    def gte(self, col, val):
+        return self._add(*self._cmp(col, ">=", val))
+
+    @_recorded
+    def lt(self, col, val):
+        return self._add(*self._cmp(col, "<", val))
+
+    @_recorded
+    def lte(self, col, val):
+        return self._add(*self._cmp(col, "<=", val))
+
+    @_recorded
+    def like(self, col, pattern):
+        # SQLite LIKE는 대소문자를 구분하지 않으므로 like는 GLOB로 바꿔 구분한다
+        return self._add(f"{_qi(col)} GLOB ?", [_like_to_glob(pattern)])
+
+    @_recorded
+    def ilike(self, col, pattern):
+        # SQLite LIKE는 ASCII 대소문자를 구분하지 않는다(= ilike)
+        return self._add(f"{_qi(col)} LIKE ?", [pattern])
+
+    @_recorded
+    def in_(self, col, values):
+        values = list(values)
+        if not values:
+            return self._add("0", [])
+        marks = ", ".join("?" for _ in values)
+        return self._add(f"{_qi(col)} IN ({marks})", [_to_sql_value(v) for v in values])
+
+    @_recorded
+    def or_(self, filters: str, **_kwargs):
+        # PostgREST or 문법 "col.op.value,..." 중 비교/like/ilike/is/in을 로컬로 처리하고
+        # 그 밖의 형태(not./and()/중첩 등)는 execute()에서 원격으로 보낸다
+        parts, params = [], []
+        for cond in _split_or_filters(filters):
+            bits = cond.split(".", 2)
+            if len(bits) != 3:
+                self._unsupported = f"or_ 조건 형식: {cond}"
+                return self
+            col, op, val = bits
+            if op in self._OR_OPS:
+                if op in ("like", "ilike"):
+                    val = val.replace("*", "%")
+                if op == "like":
+                    val = _like_to_glob(val)
+                parts.append(f"{_qi(col)} {self._OR_OPS[op]} ?")
+                params.append(val)
+            elif op == "is" and val.lower() in ("null", "true", "false"):
+                parts.append({"null": f"{_qi(col)} IS NULL", "true": f"{_qi(col)} = 1",
+                              "false": f"{_qi(col)} = 0"}[val.lower()])
+            elif op == "in" and val.startswith("(") and val.endswith(")"):
+                vals = [v.strip().strip('"') for v in val[1:-1].split(",") if v.strip()]
+                parts.append(f"{_qi(col)} IN ({', '.join('?' for _ in vals)})" if vals else "0")
+                params.extend(vals)
+            else:
+                self._unsupported = f"or_ 연산자 {op}"
+                return self
+        return self._add("(" + " OR ".join(parts) + ")", params)
+
+    @_recorded
+    def order(self, col, desc: bool = False, **_kwargs):
+        self._order.append(f"{_qi(col)} {'DESC' if desc else 'ASC'}")
+        return self
+
+    @_recorded
+    def limit(self, n: int, **_kwargs):
+        self._limit = int(n)
+        return self
+
+    @_recorded
+    def range(self, start: int, end: int, **_kwargs):
+        self._offset = int(start)
+        self._limit = int(end) - int(start) + 1
+        return self
+
+    def execute(self):
+        if self._unsupported is None:
+            try:
+                return _QueryResult(self._store.run_select(
+                    self._table, self._columns, self._where, self._params,
+                    self._order, self._limit, self._offset,
+                ))
+            except KeyError as e:  # 스냅샷에 없는 테이블/컬럼
+                self._unsupported = str(e)
+        return self._execute_remote()
+
+    def _execute_remote(self):
+        remote = self._store.remote
+        if remote is None:
+            raise KeyError(f"snapshot {self._table}: 로컬 처리 불가({self._unsupported})이고 원격 클라이언트가 없습니다.")
+        self._store.remote_fallbacks += 1
+        q = remote.table(self._table)
+        for name, args, kwargs in self._calls:
+            q = getattr(q, name)(*args, **kwargs)
+        return q.execute()
+
+    def aggregate_rows(self, column: str, group_by: str | None = None) -> list:
+        return self._store.run_aggregate(self._table, column, group_by, self._where, self._params)
+
+
+class LocalSnapshotStore:
+    """
+    레거시 조회 테이블을 로컬 SQLite 파일로 미러링한다.
+    - 백그라운드 스레드가 주기적으로 동기화(커서 컬럼이 설정된 테이블은 증분, 나머지는 전체 재적재)
+    - 증분은 워터마크 이상(>=)을 다시 받아 키로 중복 제거: 같은 시각에 늦게 커밋된 행도 놓치지 않는다
+    - 커서를 바꾸지 않는 수정/삭제는 증분으로 보이지 않으므로 full_resync초마다 전체 재적재
+    - 동기화가 끝난 테이블만 로컬에서 응답하고, 나머지는 원격(Supabase)으로 보낸다.
+    """
+
+    def __init__(self, path: str, remote, tables: list, cursors: dict | None = None,
+                 sync_interval: int = 900, page_size: int = 1000, max_age: float = 0, full_resync: float = 0):
+        self.path = path
+        self.remote = remote
+        self.tables = list(tables)
+        self.cursors = dict(cursors or {})
+        self.sync_interval = int(sync_interval)
+        self.page_size = int(page_size)
+        self.max_age = float(max_age or 0)
+        self.full_resync = float(full_resync or 0)
+        self.last_error = None
+        self.remote_fallbacks = 0
+        self.on_synced = []  # 동기화로 데이터가 바뀐 테이블명을 받는 콜백들
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS _snapshot_meta ("
+                "table_name TEXT PRIMARY KEY, synced_at REAL, row_count INTEGER, "
+                "watermark TEXT, columns TEXT, full_synced_at REAL, data_version INTEGER, digest TEXT)"
+            )
+            meta_cols = {r[1] for r in self._conn.execute("PRAGMA table_info(_snapshot_meta)")}
+            for col, decl in (("full_synced_at", "REAL"), ("data_version", "INTEGER"), ("digest", "TEXT")):
+                if col not in meta_cols:  # 이전 버전 스냅샷 파일
+                    self._conn.execute(f"ALTER TABLE _snapshot_meta ADD COLUMN {col} {decl}")
+            self._conn.commit()
+
+    # ---- 상태 ----------------------------------------------------------------
+    def _meta(self, table: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM _snapshot_meta WHERE table_name = ?", (table,)
+            ).fetchone()
+        if row is None:
+            return None
+        meta = dict(row)
+        meta["columns"] = json.loads(meta["columns"] or "[]")
+        meta["watermark"] = None if meta["watermark"] is None else json.loads(meta["watermark"])
+        return meta
+
+    def version(self) -> str:
+        """동기화로 행이 실제로 바뀐 경우에만 바뀌는 스냅샷 버전 토큰 (파생 캐시 무효화용)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT table_name, data_version FROM _snapshot_meta ORDER BY table_name"
+            ).fetchall()
+        return hashlib.sha1(json.dumps([list(r) for r in rows]).encode()).hexdigest()[:16]
+
+    def is_ready(self, table: str) -> bool:
+        """동기화된 적이 있고, 스키마(컬럼)를 알고, max_age 안에 동기화된 테이블만 로컬에서 응답한다."""
+        if table not in self.tables:
+            return False
+        meta = self._meta(table)
+        if meta is None or not meta["columns"]:
+            return False
+        return not self.max_age or (time.time() - float(meta["synced_at"] or 0)) <= self.max_age
+
+    def table(self, name: str) -> _SnapshotQuery:
+        return _SnapshotQuery(self, name)
+
+    # ---- 조회 ----------------------------------------------------------------
+    def run_select(self, table, columns, where, params, order, limit, offset) -> list:
+        meta = self._meta(table)
+        if meta is None:
+            raise KeyError(f"snapshot에 {table} 테이블이 없습니다.")
+        known = set(meta["columns"])
+        for c in columns or []:
+            if c not in known:
+                raise KeyError(f"snapshot {table}에 {c} 컬럼이 없습니다.")
+
+        cols_sql = ", ".join(_qi(c) for c in columns) if columns else "*"
+        sql = f"SELECT {cols_sql} FROM {_qi('snap_' + table)}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if order:
+            sql += " ORDER BY " + ", ".join(order)
+        if limit is not None or offset:
+            sql += f" LIMIT {-1 if limit is None else int(limit)}"
+            if offset:
+                sql += f" OFFSET {int(offset)}"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [dict(r) for r in rows]
+
+    def run_aggregate(self, table, column, group_by, where, params) -> list:
+        meta = self._meta(table)
+        if meta is None:
+            raise KeyError(f"snapshot에 {table} 테이블이 없습니다.")
+        for c in [column] + ([group_by] if group_by else []):
+            if c not in meta["columns"]:
+                raise KeyError(f"snapshot {table}에 {c} 컬럼이 없습니다.")
+
+        grp = _qi(group_by) if group_by else "NULL"
+        sql = f"SELECT {grp} AS grp, SUM({_qi(column)}) AS total, COUNT(*) AS n FROM {_qi('snap_' + table)}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " GROUP BY 1"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [dict(r) for r in rows]
+
+    def aggregate_rows(self, table, column, filters, group_by=None) -> list:
+        return _apply_filters(self.table(table), filters).aggregate_rows(column, group_by)
+
+    # ---- 동기화 --------------------------------------------------------------
+    def _pull(self, table: str, cursor_col: str | None = None, after=None, keys=()) -> list:
+        def make_query():
+            q = self.remote.table(table).select("*")
+            if cursor_col and after is not None:
+                # >= : 워터마크와 같은 시각에 나중에 커밋된 행도 받는다(이미 받은 행은 sync_table에서 걸러냄)
+                q = q.gte(cursor_col, after)
+            return q
+        # 커서+키(증분 upsert 키는 유일)가 있으면 그것으로, 없으면 실제 컬럼 전체로 정렬
+        if cursor_col and keys:
+            order_by = [cursor_col] + [k for k in keys if k != cursor_col]
+        else:
+            order_by = page_order_for(self.remote, table)
+        return fetch_all(make_query, order_by, self.page_size).data
+
+    def _ensure_columns(self, table: str, rows: list, columns: list) -> list:
+        cols = list(columns)
+        for r in rows:
+            for c in r.keys():
+                if c not in cols:
+                    cols.append(c)
+                    self._conn.execute(f"ALTER TABLE {_qi('snap_' + table)} ADD COLUMN {_qi(c)}")
+        return cols
+
+    def _insert(self, target: str, cols: list, rows: list):
+        if not rows or not cols:
+            return
+        sql = f"INSERT INTO {_qi(target)} ({', '.join(_qi(c) for c in cols)}) VALUES ({', '.join('?' for _ in cols)})"
+        self._conn.executemany(sql, [[_to_sql_value(r.get(c)) for c in cols] for r in rows])
+
+    def _write_meta(self, table: str, cols: list, watermark, full_synced_at, data_version: int, digest):
+        count = self._conn.execute(f"SELECT COUNT(*) FROM {_qi('snap_' + table)}").fetchone()[0]
+        self._conn.execute(
+            "INSERT OR REPLACE INTO _snapshot_meta "
+            "(table_name, synced_at, row_count, watermark, columns, full_synced_at, data_version, digest) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (table, time.time(), int(count), None if watermark is None else json.dumps(watermark, ensure_ascii=False),
+             json.dumps(cols, ensure_ascii=False), full_synced_at, int(data_version), digest),
+        )
+
+    @staticmethod
+    def _digest(rows: list) -> str:
+        # 전체 재적재 결과 비교용(페이지 정렬이 전순서라 같은 데이터면 같은 순서로 온다)
+        h = hashlib.sha1()
+        for r in rows:
+            h.update(json.dumps(r, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+            h.update(b"\n")
+        return h.hexdigest()
+
+    def _new_rows(self, table: str, rows: list, keys: list, cursor_col: str, after) -> list:
+        """증분으로 받은 행에서 키 중복을 없애고, 워터마크 시각의 행 중 스냅샷과 같은 행은 뺀다"""
+        by_key = {}
+        for r in rows:
+            by_key[tuple(_to_sql_value(r.get(k)) for k in keys)] = r
+        cond = " AND ".join(f"{_qi(k)} = ?" for k in keys)
+        out = []
+        for key, r in by_key.items():
+            if r.get(cursor_col) == after:
+                with self._lock:
+                    old = self._conn.execute(f"SELECT * FROM {_qi('snap_' + table)} WHERE {cond}", key).fetchone()
+                if old is not None and all(c in old.keys() and old[c] == _to_sql_value(v) for c, v in r.items()):
+                    continue
+            out.append(r)
+        return out
+
+    def sync_table(self, table: str) -> int:
+        """
+        테이블 하나를 동기화하고 적용한 행 수를 반환(바뀐 것이 없으면 0).
+        행이 바뀐 경우에만 data_version을 올리고 on_synced 콜백을 부른다.
+        """
+        spec = self.cursors.get(table) or {}
+        cursor_col = spec.get("cursor")
+        keys = list(spec.get("keys") or [])
+        meta = self._meta(table)
+        now = time.time()
+
+        incremental = bool(cursor_col and keys and meta and meta.get("watermark") is not None)
+        if incremental and self.full_resync and now - float(meta.get("full_synced_at") or 0) >= self.full_resync:
+            incremental = False
+        rows = self._pull(table, cursor_col, meta["watermark"] if incremental else None, keys)
+        if incremental:
+            rows = self._new_rows(table, rows, keys, cursor_col, meta["watermark"])
+
+        digest = None if incremental else self._digest(rows)
+        prev_version = int((meta or {}).get("data_version") or 0)
+        changed = bool(rows) if incremental else (meta is None or digest != meta.get("digest") or not meta["columns"])
+
+        watermark = meta.get("watermark") if incremental else None
+        if cursor_col and rows:
+            vals = [r.get(cursor_col) for r in rows if r.get(cursor_col) is not None]
+            if vals:
+                watermark = max(vals)
+
+        with self._lock:
+            try:
+                if not changed:
+                    cols = meta["columns"]  # 같은 데이터: 테이블은 그대로 두고 동기화 시각만 갱신
+                elif incremental:
+                    cols = self._ensure_columns(table, rows, meta["columns"])
+                    if rows:
+                        cond = " AND ".join(f"{_qi(k)} = ?" for k in keys)
+                        self._conn.executemany(
+                            f"DELETE FROM {_qi('snap_' + table)} WHERE {cond}",
+                            [[_to_sql_value(r.get(k)) for k in keys] for r in rows],
+                        )
+                        self._insert("snap_" + table, cols, rows)
+                else:
+                    # 빈 테이블이어도 프로젝션 컬럼으로 스키마를 잡아 둔다(없으면 is_ready=False로 원격 조회)
+                    cols = _projection_columns(table)
+                    for r in rows:
+                        for c in r.keys():
+                            if c not in cols:
+                                cols.append(c)
+                    tmp = f"snap_{table}__new"
+                    self._conn.execute(f"DROP TABLE IF EXISTS {_qi(tmp)}")
+                    # 타입 선언 없이 생성해 원본 값의 타입(int/float/text)을 그대로 보존
+                    col_defs = ", ".join(_qi(c) for c in cols) or '"_empty"'
+                    self._conn.execute(f"CREATE TABLE {_qi(tmp)} ({col_defs})")
+                    self._insert(tmp, cols, rows)
+                    self._conn.execute(f"DROP TABLE IF EXISTS {_qi('snap_' + table)}")
+                    self._conn.execute(f"ALTER TABLE {_qi(tmp)} RENAME TO {_qi('snap_' + table)}")
+                self._write_meta(table, cols, watermark, meta.get("full_synced_at") if incremental else now,
+                                 prev_version + changed, (meta or {}).get("digest") if incremental else digest)
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        if not changed:
+            return 0
+        for cb in self.on_synced:
+            cb(table)
+        return len(rows)
+
+    def sync_all(self) -> dict:
+        result = {}
+        for t in self.tables:
+            try:
+                result[t] = self.sync_table(t)
+            except Exception as e:
+                self.last_error = f"{t}: {e}"
+                result[t] = None
+        return result
+
+    def start_background_sync(self):
+        if self._thread and self._thread.is_alive():
+            return
+
+        def _loop():
+            while not self._stop.is_set():
+                self.sync_all()
+                self._stop.wait(self.sync_interval)
+
+        self._thread = threading.Thread(target=_loop, name="legacy-snapshot-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def _projection_columns(table: str) -> list:
+    """COLUMN_PROJECTIONS에서 이 테이블로 조회하는 컬럼들(등장 순서, '*' 제외)"""
+    cols = []
+    for t, projection in COLUMN_PROJECTIONS.values():
+        if t == table and projection != ("*",):
+            cols.extend(c for c in projection if c not in cols)
+    return cols
+
+
+class _SnapshotRoutingClient:
+    """스냅샷이 준비된 테이블은 로컬, 나머지는 원격 클라이언트로 보낸다."""
+
+    def __init__(self, store: LocalSnapshotStore, remote):
+        self.store = store
+        self.remote = remote
+
+    def table(self, name: str):
+        if self.store.is_ready(name):
+            return self.store.table(name)
+        return self.remote.table(name)
+
+    def aggregate_rows(self, table, column, filters, group_by=None) -> list:
+        if self.store.is_ready(table):
+            try:
+                return self.store.aggregate_rows(table, column, filters, group_by)
+            except KeyError:  # 스냅샷에 없는 컬럼
+                self.store.remote_fallbacks += 1
+        return _aggregate_rows(self.remote, table, column, filters, group_by)
+
+
+@st.cache_resource
+def init_legacy_snapshot() -> LocalSnapshotStore | None:
+    if not LEGACY_SNAPSHOT_ENABLED or supabase is None:
+        return None
+    try:
+        store = LocalSnapshotStore(
+            LEGACY_SNAPSHOT_PATH, supabase, LEGACY_SNAPSHOT_TABLES,
+            cursors=LEGACY_SNAPSHOT_CURSORS if isinstance(LEGACY_SNAPSHOT_CURSORS, dict) else {},
+            sync_interval=LEGACY_SNAPSHOT_SYNC_SEC,
+            page_size=LEGACY_SNAPSHOT_PAGE_SIZE,
+            max_age=LEGACY_SNAPSHOT_MAX_AGE_SEC,
+            full_resync=LEGACY_SNAPSHOT_FULL_RESYNC_SEC,
+        )
+        store.start_background_sync()
+        return store
+    except Exception:
+        return None
+
+legacy_snapshot: LocalSnapshotStore | None = init_legacy_snapshot()
+
+
+# =============================================================================
+# Query Result Cache (process-wide)
+# =============================================================================
+
+# 결과가 조회 조건(순서 무관)에만 의존하는 필터 연산
+_CACHE_FILTER_OPS = {"eq", "neq", "gt", "gte", "lt", "lte", "like", "ilike", "in_", "or_", "is_", "contains"}
+
+
+def _cache_token(v):
+    return json.dumps(v, ensure_ascii=False, sort_keys=True, default=str)
+
+
+class QueryResultCache:
+    """
+    정규화된 쿼리(테이블/프로젝션/필터/버전) -> 결과 캐시.
+    - 테이블별 TTL, LRU 크기 제한, 명시적 무효화, hit/miss 카운터
+    - 프로세스 전역(st.cache_resource)이라 Streamlit 세션 간에 공유된다.
+    """
+
+    def __init__(self, max_entries: int = 512, default_ttl: float = 300, table_ttls: dict | None = None):
+        self.max_entries = int(max_entries)
+        self.default_ttl = float(default_ttl)
+        self.table_ttls = dict(table_ttls or {})
+        self._data = OrderedDict()  # key -> (expires_at, table, data, count)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ttl_for(self, table: str) -> float:
+        return float(self.table_ttls.get(table, self.default_ttl))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+        _, _, data, count = entry
+        # 호출부가 행을 수정해도 캐시 원본은 그대로 유지
+        return _QueryResult([dict(r) if isinstance(r, dict) else r for r in (data or [])], count)
+
+    def put(self, key, table: str, data, count=None):
+        ttl = self.ttl_for(table)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, table, data, count)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, table: str | None = None) -> int:
+        with self._lock:
+            if table is None:
+                n = len(self._data)
+                self._data.clear()
+                return n
+            keys = [k for k, v in self._data.items() if v[1] == table]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "size": len(self._data),
+                "evictions": self.evictions,
+            }
+
+
+class _CachedQuery:
+    """쿼리 빌더 호출을 기록만 해두었다가, execute() 시점에 캐시를 먼저 확인한다."""
+
+    def __init__(self, cache: QueryResultCache, client, table: str):
+        self._cache = cache
+        self._client = client
+        self._table = table
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def _record(*args, **kwargs):
+            self._calls.append((name, args, kwargs))
+            return self
+        return _record
+
+    def cache_key(self) -> tuple:
+        select, filters, rest = None, [], []
+        for name, args, kwargs in self._calls:
+            if name == "select":
+                # 컬럼 순서는 응답 dict 순서에 영향을 주므로 공백만 정규화
+                cols = ",".join(c.strip() for c in str(args[0] if args else "*").split(",") if c.strip())
+                select = (cols, _cache_token(kwargs))
+            elif name in _CACHE_FILTER_OPS:
+                filters.append(_cache_token([name, list(args), kwargs]))
+            else:
+                rest.append(_cache_token([name, list(args), kwargs]))
+        return (self._table, select, tuple(sorted(filters)), tuple(rest))
+
+    def execute(self):
+        key = self.cache_key()
+        hit = self._cache.get(key)
+        if hit is not None:
+            return hit
+
+        q = self._client.table(self._table)
+        for name, args, kwargs in self._calls:
+            q = getattr(q, name)(*args, **kwargs)
+        res = q.execute()
+        data = res.data
+        self._cache.put(key, self._table, [dict(r) if isinstance(r, dict) else r for r in (data or [])],
+                        getattr(res, "count", None))
+        return res
+
+
+class _CachedClient:
+    def __init__(self, cache: QueryResultCache, client):
+        self.cache = cache
+        self.client = client
+
+    def table(self, name: str):
+        return _CachedQuery(self.cache, self.client, name)
+
+    def aggregate_rows(self, table, column, filters, group_by=None) -> list:
+        key = ("__agg__", table, column, tuple(sorted(_cache_token(list(f)) for f in filters)), group_by)
+        hit = self.cache.get(key)
+        if hit is not None:
+            return hit.data
+        rows = _aggregate_rows(self.client, table, column, filters, group_by)
+        self.cache.put(key, table, [dict(r) for r in rows])
+        return rows
+
+
+@st.cache_resource
+def init_query_cache() -> QueryResultCache | None:
+    if not LEGACY_QUERY_CACHE_ENABLED:
+        return None
+    return QueryResultCache(
+        max_entries=LEGACY_QUERY_CACHE_MAX_ENTRIES,
+        default_ttl=LEGACY_QUERY_CACHE_TTL_SEC,
+        table_ttls=LEGACY_QUERY_CACHE_TABLE_TTLS if isinstance(LEGACY_QUERY_CACHE_TABLE_TTLS, dict) else {},
+    )
+
+query_cache: QueryResultCache | None = init_query_cache()
+
+if query_cache is not None and legacy_snapshot is not None:
+    # 스냅샷이 새로 동기화되면 해당 테이블 캐시는 버린다
+    if query_cache.invalidate not in legacy_snapshot.on_synced:
+        legacy_snapshot.on_synced.append(query_cache.invalidate)
+
+# =============================================================================
+# Aggregation pushdown (SUM / GROUP BY)
+# =============================================================================
+
+# Supabase에 아래 함수를 만들어 두면 합계만 네트워크로 전달된다. 없으면 로컬 집계로 폴백.
+LEGACY_AGG_RPC_SQL = """
+create or replace function legacy_agg_sum(
+  p_table text, p_column text, p_filters jsonb default '[]'::jsonb, p_group_by text default null
+) returns table(grp text, total numeric, n bigint)
+language plpgsql stable as $$
+declare
+  f jsonb;
+  where_sql text := 'true';
+begin
+  if p_table not in ('production_data', 'daily_total_production', 'daily_capa', 'monthly_production') then
+    raise exception 'table not allowed: %', p_table;
+  end if;
+  for f in select * from jsonb_array_elements(p_filters) loop
+    if f->>'op' = 'eq' then
+      where_sql := where_sql || format(' and %I = %L', f->>'col', f->>'val');
+    elsif f->>'op' = 'ilike' then
+      where_sql := where_sql || format(' and %I::text ilike %L', f->>'col', f->>'val');
+    elsif f->>'op' = 'in' then
+      where_sql := where_sql || format(' and %I::text in (select jsonb_array_elements_text(%L::jsonb))', f->>'col', f->'val');
+    else
+      raise exception 'unsupported op: %', f->>'op';
+    end if;
+  end loop;
+  return query execute format(
+    'select %s, sum(%I)::numeric, count(*)::bigint from %I where %s group by 1',
+    case when p_group_by is null then 'null::text' else format('%I::text', p_group_by) end,
+    p_column, p_table, where_sql
+  );
+end $$;
+"""
+
+_AGG_RPC_RETRY_AT = 0.0
+
+
+def _apply_filters(q, filters):
+    """filters: [(op, col, val), ...]  op: eq | ilike | in"""
+    for op, col, val in filters:
+        if op == "in":
+            q = q.in_(col, list(val))
+        else:
+            q = getattr(q, op)(col, val)
+    return q
+
+def _agg_number(v):
+    if v is None:
+        return 0
+    if isinstance(v, (int, float)):
+        return int(v) if float(v).is_integer() else v
+    v = float(v)
+    return int(v) if v.is_integer() else v
+
+def _aggregate_rows(db, table, column, filters, group_by=None) -> list:
+    """[{grp, total, n}] 반환. 클라이언트가 직접 집계할 수 있으면 위임, 아니면 RPC -> 로컬 집계 순."""
+    global _AGG_RPC_RETRY_AT
+    fn = getattr(db, "aggregate_rows", None)
+    if fn is not None:
+        return fn(table, column, filters, group_by)
+
+    if LEGACY_AGG_RPC and hasattr(db, "rpc") and time.monotonic() >= _AGG_RPC_RETRY_AT:
+        try:
+            res = db.rpc(LEGACY_AGG_RPC, {
+                "p_table": table,
+                "p_column": column,
+                "p_filters": [{"op": op, "col": col, "val": list(val) if op == "in" else val} for op, col, val in filters],
+                "p_group_by": group_by,
+            }).execute()
+            return [{"grp": r.get("grp"), "total": r.get("total"), "n": r.get("n")} for r in (res.data or [])]
+        except Exception:
+            # 함수가 없거나 실패하면 한동안 RPC를 건너뛰고 로컬 집계
+            _AGG_RPC_RETRY_AT = time.monotonic() + LEGACY_AGG_RPC_RETRY_SEC
+
+    cols = column if not group_by else f"{group_by}, {column}"
+    order_by = table_order_keys(table, [group_by, column] if group_by else [column])
+    acc = sum_pages(iter_pages(lambda: _apply_filters(db.table(table).select(cols), filters), order_by), column, group_by)
+    return [{"grp": k, "total": t, "n": n} for k, (t, n) in acc.items()]
+
+def aggregate_sum(db, table: str, column: str, filters: list, group_by: str | None = None) -> dict:
+    """{그룹값: (합계, 행수)} 반환 (group_by가 없으면 키는 None)"""
+    out = {}
+    for r in _aggregate_rows(db, table, column, filters, group_by):
+        out[r.get("grp")] = (_agg_number(r.get("total")), int(r.get("n") or 0))
+    return out
+
+def aggregate_total(db, table: str, column: str, filters: list) -> tuple:
+    """(합계, 행수) 반환. 행수가 0이면 조건에 맞는 데이터가 없는 것."""
+    return aggregate_sum(db, table, column, filters).get(None, (0, 0))
+
+
+# =============================================================================
+# Concurrent query fan-out
+# =============================================================================
+
+# 요청 단위 측정값(쿼리 소요시간 등). route_and_answer가 dict를 넣어두면 debug로 노출된다.
+_REQUEST_METRICS: contextvars.ContextVar = contextvars.ContextVar("request_metrics", default=None)
+
+_FANOUT_POOL = ThreadPoolExecutor(max_workers=max(1, QUERY_FANOUT_WORKERS), thread_name_prefix="query-fanout")
+_FANOUT_LOCAL = threading.local()
+
+
+def _record_metric(section: str, name: str, value):
+    metrics = _REQUEST_METRICS.get()
+    if metrics is not None:
+        metrics.setdefault(section, {})[name] = value
+
+
+class QueryBatch:
+    """
+    서로 독립적인 쿼리들을 공용 스레드풀에서 동시에 실행한다.
+    여러 쿼리 답변의 대기 시간이 합이 아니라 가장 느린 한 번 정도가 되도록.
+    """
+
+    def __init__(self):
+        self._jobs = []
+        self.timings = {}
+
+    def add(self, name: str, fn, *args, **kwargs) -> "QueryBatch":
+        self._jobs.append((name, fn, args, kwargs))
+        return self
+
+    def _timed(self, name, fn, args, kwargs):
+        prev = getattr(_FANOUT_LOCAL, "in_worker", False)
+        _FANOUT_LOCAL.in_worker = True
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            ms = (time.perf_counter() - t0) * 1000.0
+            self.timings[name] = ms
+            _record_metric("query_ms", name, round(ms, 1))
+            _FANOUT_LOCAL.in_worker = prev
+
+    def run(self) -> dict:
+        """{name: 결과} 반환. 실패한 쿼리가 있으면 (모두 끝난 뒤) 첫 예외를 그대로 올린다."""
+        # 풀 작업 안에서 다시 배치를 돌리면 교착될 수 있으므로 그때는 순차 실행
+        if len(self._jobs) <= 1 or getattr(_FANOUT_LOCAL, "in_worker", False):
+            return {name: self._timed(name, fn, args, kwargs) for name, fn, args, kwargs in self._jobs}
+
+        futures = [
+            (name, _FANOUT_POOL.submit(contextvars.copy_context().run, self._timed, name, fn, args, kwargs))
+            for name, fn, args, kwargs in self._jobs
+        ]
+        results, first_error = {}, None
+        for name, fut in futures:
+            try:
+                results[name] = fut.result()
+            except Exception as e:
+                if first_error is None:
+                    first_error = e
+        if first_error is not None:
+            raise first_error
+        return results
+
+
+# =============================================================================
+# Paged fetch (PostgREST row cap)
+# =============================================================================
+
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="page-prefetch")
+
+
+def table_order_keys(table: str, columns) -> list:
+    """
+    조회 컬럼 목록에 대한 전순서 정렬: PAGED_ORDER_KEYS[table] 중 조회하는 컬럼을 앞에, 나머지 조회 컬럼을 뒤에.
+    동률 행은 조회 컬럼 값이 모두 같으므로 페이지 경계에서 어느 쪽이 와도 중복/누락이 생기지 않는다.
+    """
+    cols = [c for c in columns if c and c != "*"]
+    if not cols:
+        raise ValueError(f"{table}: 정렬할 조회 컬럼이 없습니다('*'는 page_order_for로 컬럼을 확인하세요).")
+    keys = [k for k in PAGED_ORDER_KEYS.get(table, []) if k in cols]
+    return keys + [c for c in cols if c not in keys]
+
+def table_columns(client, table: str) -> list:
+    """select('*')로 한 행을 받아 실제 컬럼 목록을 확인한다(빈 테이블이면 [])"""
+    rows = client.table(table).select("*").limit(1).execute().data or []
+    return list(rows[0].keys()) if rows else []
+
+def page_order_for(client, table: str, columns=("*",)) -> list:
+    """
+    페이지 정렬 컬럼. '*' 조회는 실제 컬럼을 확인해 전체 컬럼으로 정렬한다.
+    PAGED_ORDER_KEYS에 있는데 테이블에 없는 키 컬럼은 지표(paged_order/missing_key)만 남기고 건너뛴다.
+    빈 테이블이면 정렬할 필요가 없으므로 설정된 키(없으면 None)를 돌려준다.
+    """
+    if tuple(columns) != ("*",):
+        return table_order_keys(table, columns)
+    cols = table_columns(client, table)
+    if not cols:
+        return list(PAGED_ORDER_KEYS.get(table, [])) or None
+    missing = [k for k in PAGED_ORDER_KEYS.get(table, []) if k not in cols]
+    if missing:
+        _record_metric("paged_order", "missing_key", {table: missing})
+    return table_order_keys(table, cols)
+
+def page_order(key: str, client=None) -> list:
+    """프로젝션 키(COLUMN_PROJECTIONS)의 페이지 정렬 컬럼('*' 프로젝션은 client로 컬럼 확인)"""
+    table, cols = COLUMN_PROJECTIONS[key]
+    if tuple(cols) == ("*",):
+        return page_order_for(client, table)
+    return table_order_keys(table, cols)
+
+def iter_pages(make_query, order_by, page_size: int | None = None, prefetch: bool = True):
+    """
+    make_query()가 만든 (필터까지 적용된) 새 쿼리에 order_by 정렬과 .range()를 붙여 페이지 단위로 가져온다.
+    정렬이 없으면 PostgREST가 페이지마다 다른 순서로 돌려줄 수 있어(행 중복/누락) order_by는 필수.
+    페이지가 꽉 차 있으면 현재 페이지를 처리하는 동안 다음 페이지를 미리 요청한다.
+    """
+    if order_by is None:  # page_order_for: 빈 테이블
+        yield from ()
+        return
+    order_by = [order_by] if isinstance(order_by, str) else list(order_by)
+    if not order_by:
+        raise ValueError("iter_pages: order_by가 필요합니다.")
+    size = max(1, int(page_size or PAGED_FETCH_SIZE))
+
+    def _fetch(i):
+        start = i * size
+        q = make_query()
+        for col in order_by:
+            q = q.order(col)
+        return q.range(start, start + size - 1).execute().data or []
+
+    i = 0
+    page = _fetch(0)
+    while True:
+        full = len(page) >= size
+        nxt = None
+        if full and prefetch:
+            nxt = _PREFETCH_POOL.submit(contextvars.copy_context().run, _fetch, i + 1)
+        if page:
+            yield page
+        if not full:
+            return
+        i += 1
+        page = nxt.result() if nxt is not None else _fetch(i)
+
+def fetch_all(make_query, order_by, page_size: int | None = None) -> _QueryResult:
+    """.execute() 대신 사용: 행 수 제한에 잘리지 않고 모든 페이지를 합쳐 돌려준다(order_by는 iter_pages 참고)."""
+    rows = []
+    for page in iter_pages(make_query, order_by, page_size):
+        rows.extend(page)
+    return _QueryResult(rows)
+
+def sum_pages(pages, column: str, group_by: str | None = None) -> dict:
+    """페이지 스트림을 받아 {그룹값: (합계, 행수)}를 누적 (행 전체를 메모리에 들고 있지 않음)"""
+    acc = {}
+    for page in pages:
+        for r in page:
+            k = r.get(group_by) if group_by else None
+            t, n = acc.get(k, (0, 0))
+            acc[k] = (t + (r.get(column) or 0), n + 1)
+    return acc
+
+
+# =============================================================================
+# Column projections
+# =============================================================================
+
+# 분기/단계별로 실제로 읽는 컬럼만 조회한다. 새 컬럼을 읽으려면 여기에 먼저 추가할 것.
+COLUMN_PROJECTIONS = {
+    "legacy.increase_case": ("final_issue", ("날짜", "품목명", "생산량", "final_role", "final_remark")),
+    "legacy.issue_case": ("production_issue_analysis_8_11", ("품목명", "날짜", "계획_v0", "실적_v2", "누적차이_Gap")),
+    "legacy.monthly_total": ("monthly_production", ("월", "총_생산량")),
+    "legacy.month_capa": ("daily_capa", ("라인", "capa")),
+    "legacy.capa_compare.capa": ("daily_capa", ("라인", "capa")),
+    "legacy.capa_compare.prod": ("daily_total_production", ("날짜", "라인", "총_생산량")),
+    "legacy.date_product": ("production_data", ("품명", "구분", "생산량")),
+    "legacy.product_catalog": ("production_data", ("품명",)),
+    "hybrid.plan": (HYBRID_PLAN_TABLE, ("plan_date", "line", "product_name", "qty_0차", "qty_1차", "plt", "is_workday")),
+    "hybrid.hist": (HYBRID_HIST_TABLE, ("*",)),
+    "hybrid.daily_capa": ("daily_capa", ("날짜", "월", "버전", "라인", "capa")),
+}
+
+
+class ProjectionError(KeyError):
+    pass
+
+
+class _ProjectedRow(dict):
+    """PROJECTION_CHECK 모드에서 조회하지 않은 컬럼을 읽으면 (.get 포함) 바로 실패시킨다."""
+    __slots__ = ("_key",)
+
+    def _fail(self, col):
+        raise ProjectionError(f"'{col}' 컬럼은 {self._key} 프로젝션에 없습니다(COLUMN_PROJECTIONS 확인).")
+
+    def __missing__(self, col):
+        self._fail(col)
+
+    def get(self, col, default=None):
+        if col not in self:
+            self._fail(col)
+        return dict.get(self, col, default)
+
+
+def select_columns(key: str) -> str:
+    return ", ".join(COLUMN_PROJECTIONS[key][1])
+
+def projected(key: str, res):
+    """검사 모드일 때 결과 행을 프로젝션 검사용 행으로 감싼다(스키마 누락도 함께 검사)."""
+    cols = COLUMN_PROJECTIONS[key][1]
+    if not PROJECTION_CHECK or cols == ("*",):
+        return res
+    rows = []
+    for r in res.data or []:
+        missing = [c for c in cols if c not in r]
+        if missing:
+            raise ProjectionError(f"{key}: 응답에 {missing} 컬럼이 없습니다.")
+        row = _ProjectedRow(r)
+        row._key = key
+        rows.append(row)
+    return _QueryResult(rows, getattr(res, "count", None))
+
+def check_frame_projection(df: pd.DataFrame, key: str) -> pd.DataFrame:
+    cols = COLUMN_PROJECTIONS[key][1]
+    if PROJECTION_CHECK and not df.empty and cols != ("*",):
+        missing = [c for c in cols if c not in df.columns]
+        if missing:
+            raise ProjectionError(f"{key}: 데이터프레임에 {missing} 컬럼이 없습니다.")
+    return df
+
+
+def _legacy_db():
+    client = supabase
+    if legacy_snapshot is not None:
+        client = _SnapshotRoutingClient(legacy_snapshot, supabase)
+    if query_cache is not None:
+        client = _CachedClient(query_cache, client)
+    return client
+
+
+# =============================================================================
+# Context compaction (token budget)
+# =============================================================================
+def estimate_tokens(text: str) -> int:
+    """토크나이저 없이 쓰는 보수적 추정: ASCII 4자당 1토큰, 그 외(한글 등) 1자당 1토큰"""
+    ascii_n = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_n + 3) // 4 + (len(text) - ascii_n)
+
+def _cell(v) -> str:
+    if isinstance(v, bool):
+        return "Y" if v else "N"
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)
+    return str("" if v is None else v).replace("|", "/").replace("\n", " ")
+
+def compact_table(rows: list, columns: list, label: str, rank=None, budget: int | None = None) -> str:
+    """
+    행(dict) 목록을 'a|b|c' 형태의 헤더 1줄 + 값 행 표로 변환한다.
+    예산을 넘으면 rank(행 -> 정렬키, 클수록 중요) 상위 행만 남기고(원래 순서 유지) 생략 행 수를 표시한다.
+    절감 토큰은 context_tokens 측정값으로 기록된다.
+    """
+    budget = LLM_CONTEXT_TOKEN_BUDGET if budget is None else budget
+    header = "|".join(columns)
+    lines = ["|".join(_cell(r.get(c)) for c in columns) for r in rows]
+
+    order = list(range(len(rows)))
+    if rank is not None:
+        order.sort(key=lambda i: rank(rows[i]), reverse=True)
+    keep, used = set(), estimate_tokens(header)
+    for i in order:
+        cost = estimate_tokens(lines[i]) + 1
+        if budget and used + cost > budget:
+            break
+        keep.add(i)
+        used += cost
+
+    out = [header] + [lines[i] for i in range(len(rows)) if i in keep]
+    omitted = len(rows) - len(keep)
+    if omitted:
+        out.append(f"... (+{omitted}행 생략)")
+    text = "\n".join(out)
+
+    raw = estimate_tokens(json.dumps(rows, ensure_ascii=False, default=str))
+    compact = estimate_tokens(text)
+    _record_metric("context_tokens", label, {
+        "raw": raw, "compact": compact, "saved": raw - compact, "rows": f"{len(keep)}/{len(rows)}",
+    })
+    return text
+
+def parse_compact_table(text: str) -> list[dict]:
+    """compact_table 출력을 다시 행(dict, 값은 문자열) 목록으로 (생략 표시 줄은 무시)"""
+    lines = [ln for ln in text.strip().splitlines() if ln and not ln.startswith("... (+")]
+    if not lines:
+        return []
+    cols = lines[0].split("|")
+    return [dict(zip(cols, ln.split("|"))) for ln in lines[1:]]
+
+
+# =============================================================================
+# Gemini transport
+# =============================================================================
+
+class GeminiError(Exception):
+    pass
+
+
+class GeminiTransport:
+    """
+    Gemini REST 호출용 공용 전송 계층.
+    - requests.Session 커넥션 풀(keep-alive)로 매 호출 TLS 연결 비용 제거
+    - connect/read 타임아웃 분리, 요청당 전체 deadline
+    - 429/5xx/연결 오류만 jitter backoff로 제한 횟수 재시도
+    - 지연시간/재시도/오류 지표
+    """
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, api_key: str, base_url: str = GEMINI_BASE_URL,
+                 connect_timeout: float = GEMINI_CONNECT_TIMEOUT, read_timeout: float = GEMINI_READ_TIMEOUT,
+                 deadline: float = GEMINI_DEADLINE_SEC, max_retries: int = GEMINI_MAX_RETRIES,
+                 backoff: float = GEMINI_BACKOFF_SEC, pool_size: int = 10):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.deadline = float(deadline)
+        self.max_retries = int(max_retries)
+        self.backoff = float(backoff)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": "application/json", "x-goog-api-key": api_key})
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=500)
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self._aio = None
+
+    def _url(self, model: str, method: str) -> str:
+        return f"{self.base_url}/models/{model}:{method}"
+
+    def _backoff_delay(self, attempt: int, remaining: float) -> float:
+        # full jitter: [0, backoff * 2^attempt]
+        delay = random.uniform(0, self.backoff * (2 ** attempt))
+        return max(0.0, min(delay, remaining))
+
+    def _backoff_sleep(self, attempt: int, remaining: float):
+        time.sleep(self._backoff_delay(attempt, remaining))
+
+    def aio(self) -> "AsyncGeminiTransport":
+        """같은 설정/지표를 공유하는 asyncio(httpx) 전송 계층"""
+        with self._lock:
+            if self._aio is None:
+                self._aio = AsyncGeminiTransport(self)
+            return self._aio
+
+    def post(self, model: str, method: str, payload: dict, label: str = "gemini",
+             deadline: float | None = None, **kwargs) -> requests.Response:
+        """
+        deadline/재시도 정책을 적용해 POST. 성공(200) 응답을 돌려주고 실패하면 GeminiError.
+        deadline을 주면 전송 계층 기본값보다 짧은 쪽을 쓴다(호출 측 대기 한도에 맞춰 연결을 끊기 위해).
+        """
+        deadline = self.deadline if deadline is None else min(self.deadline, float(deadline))
+        t0 = time.monotonic()
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - (time.monotonic() - t0)
+            if remaining <= 0:
+                break
+            try:
+                r = self.session.post(
+                    self._url(model, method), json=payload,
+                    timeout=(min(self.connect_timeout, remaining), min(self.read_timeout, remaining)),
+                    **kwargs,
+                )
+                if r.status_code == 200:
+                    self._record(label, t0, ok=True)
+                    return r
+                # 재시도하지 않는 오류도 응답을 닫아야 커넥션이 풀로 돌아간다
+                r.close()
+                last_error = GeminiError(f"HTTP {r.status_code}")
+                if r.status_code not in self.RETRY_STATUS:
+                    break
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = GeminiError(f"{type(e).__name__}: {e}")
+
+            if attempt < self.max_retries:
+                with self._lock:
+                    self.retries += 1
+                self._backoff_sleep(attempt, deadline - (time.monotonic() - t0))
+
+        self._record(label, t0, ok=False)
+        raise last_error or GeminiError("deadline exceeded")
+
+    def generate(self, prompt_text: str, model: str = GEMINI_MODEL, label: str = "gemini",
+                 deadline: float | None = None) -> str:
+        payload = {"contents": [{"parts": [{"text": prompt_text}]}]}
+        j = self.post(model, "generateContent", payload, label=label, deadline=deadline).json()
+        try:
+            return j["candidates"][0]["content"]["parts"][0]["text"]
+        except (KeyError, IndexError, TypeError):
+            raise GeminiError("응답 형식 오류")
+
+    def stream(self, prompt_text: str, model: str = GEMINI_MODEL, label: str = "gemini"):
+        """
+        streamGenerateContent(SSE) 텍스트 조각 generator.
+        재시도는 첫 바이트 전(연결/상태코드)까지만, 이후에는 deadline을 넘기면 중단한다.
+        finishReason 없이 스트림이 끝나면(연결 끊김/미종결 SSE) GeminiError: 조각은 이미 나갔으므로
+        호출 측이 잘린 응답임을 알려야 한다.
+        """
+        t0 = time.monotonic()
+        payload = {"contents": [{"parts": [{"text": prompt_text}]}]}
+        r = self.post(model, "streamGenerateContent", payload, label=f"{label}_connect",
+                      params={"alt": "sse"}, stream=True)
+        first = True
+        finish = None
+        ok = True
+        try:
+            with r:
+                r.encoding = "utf-8"
+                for line in r.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    try:
+                        cand = json.loads(line[5:].strip())["candidates"][0]
+                        finish = cand.get("finishReason") or finish
+                        text = "".join(p.get("text", "") for p in (cand.get("content") or {}).get("parts", []))
+                    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                        continue
+                    if first:
+                        first = False
+                        _record_metric("llm_ms", f"{label}_first_token", round((time.monotonic() - t0) * 1000.0, 1))
+                    if text:
+                        yield text
+                    if time.monotonic() - t0 > self.deadline:
+                        raise GeminiError("deadline exceeded (stream)")
+            if finish is None:
+                raise GeminiError("stream ended without finishReason")
+        except requests.RequestException as e:
+            ok = False
+            raise GeminiError(f"{type(e).__name__}: {e}") from e
+        except GeminiError:
+            ok = False
+            raise
+        except GeneratorExit:
+            # 소비 측이 중간에 닫음(Streamlit 재실행/중지): 전송 오류는 아니지만 지표에는 남긴다
+            _record_metric("llm_stream", label, "closed")
+            raise
+        finally:
+            self._record(label, t0, ok=ok)
+
+    def _record(self, label: str, t0: float, ok: bool):
+        ms = (time.monotonic() - t0) * 1000.0
+        with self._lock:
+            self.calls += 1
+            if ok:
+                self._latencies.append(ms)
+            else:
+                self.errors += 1
+        _record_metric("llm_ms", label, round(ms, 1))
+
+    def stats(self) -> dict:
+        with self._lock:
+            lat = sorted(self._latencies)
+            calls, retries, errors = self.calls, self.retries, self.errors
+
+        def pct(p):
+            return round(lat[min(len(lat) - 1, int(p * len(lat)))], 1) if lat else None
+        return {"calls": calls, "retries": retries, "errors": errors, "p50_ms": pct(0.5), "p95_ms": pct(0.95)}
+
+
+class AsyncGeminiTransport:
+    """
+    GeminiTransport의 asyncio 버전(httpx.AsyncClient).
+    타임아웃/재시도/deadline 설정과 지표는 원래 전송 계층(base)과 공유한다.
+    """
+
+    def __init__(self, base: GeminiTransport, pool_size: int = 20):
+        self.base = base
+        self.pool_size = pool_size
+        # AsyncClient는 생성된 이벤트 루프에 묶이므로 루프별로 하나씩 둔다
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                headers={"Content-Type": "application/json", "x-goog-api-key": self.base.api_key},
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+            self._clients[loop] = client
+        return client
+
+    async def aclose(self):
+        """현재 루프의 AsyncClient를 닫는다(루프를 끝내기 전에 그 루프 안에서 호출)"""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    async def post(self, model: str, method: str, payload: dict, label: str = "gemini",
+                   params: dict | None = None, deadline: float | None = None) -> httpx.Response:
+        """GeminiTransport.post와 같은 정책(deadline을 주면 전송 계층 기본값보다 짧은 쪽)"""
+        b = self.base
+        deadline = b.deadline if deadline is None else min(b.deadline, float(deadline))
+        t0 = time.monotonic()
+        last_error = None
+        for attempt in range(b.max_retries + 1):
+            remaining = deadline - (time.monotonic() - t0)
+            if remaining <= 0:
+                break
+            try:
+                r = await self._client().post(
+                    b._url(model, method), json=payload, params=params,
+                    timeout=httpx.Timeout(min(b.read_timeout, remaining), connect=min(b.connect_timeout, remaining)),
+                )
+                if r.status_code == 200:
+                    b._record(label, t0, ok=True)
+                    return r
+                last_error = GeminiError(f"HTTP {r.status_code}")
+                if r.status_code not in b.RETRY_STATUS:
+                    break
+            except httpx.TransportError as e:
+                last_error = GeminiError(f"{type(e).__name__}: {e}")
+
+            if attempt < b.max_retries:
+                with b._lock:
+                    b.retries += 1
+                await asyncio.sleep(b._backoff_delay(attempt, deadline - (time.monotonic() - t0)))
+
+        b._record(label, t0, ok=False)
+        raise last_error or GeminiError("deadline exceeded")
+
+    async def generate(self, prompt_text: str, model: str = GEMINI_MODEL, label: str = "gemini",
+                       deadline: float | None = None) -> str:
+        payload = {"contents": [{"parts": [{"text": prompt_text}]}]}
+        j = (await self.post(model, "generateContent", payload, label=label, deadline=deadline)).json()
+        try:
+            return j["candidates"][0]["content"]["parts"][0]["text"]
+        except (KeyError, IndexError, TypeError):
+            raise GeminiError("응답 형식 오류")
+
+
+class LLMResponseCache:
+    """
+    (모델, 렌더링된 프롬프트+Context, 데이터 버전) 해시 -> 응답 텍스트.
+    메모리 LRU 계층과, 재시작 후에도 남는 선택적 디스크(SQLite) 계층.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 3600, disk_path: str | None = None):
+        self.max_entries = int(max_entries)
+        self.ttl = float(ttl)
+        self._mem = OrderedDict()  # key -> (expires_at_epoch, text)
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, text TEXT, expires_at REAL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model: str, prompt_text: str, data_version: str | None = None) -> str:
+        h = hashlib.sha256()
+        for part in (model, data_version or "", prompt_text):
+            h.update(part.encode("utf-8"))
+            h.update(b"\x00")
+        return h.hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                if entry[0] >= now:
+                    self._mem.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._mem[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT text, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[1] >= now:
+                    self._put_mem(key, row[0], row[1])
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def _put_mem(self, key, text, expires_at):
+        self._mem[key] = (expires_at, text)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def put(self, key: str, text: str):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._put_mem(key, text, expires_at)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO llm_cache (key, text, expires_at) VALUES (?, ?, ?)",
+                                 (key, text, expires_at))
+                self._db.execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),))
+                self._db.commit()
+
+    def invalidate(self, *_args) -> None:
+        with self._lock:
+            self._mem.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM llm_cache")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "size": len(self._mem)}
+
+
+@st.cache_resource
+def init_llm_cache() -> LLMResponseCache | None:
+    if not LLM_CACHE_ENABLED:
+        return None
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
+        cache = LLMResponseCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SEC, LLM_CACHE_PATH or None)
     except Exception:
-        pass
+        cache = LLMResponseCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SEC, None)
+    # 스냅샷 데이터가 바뀌면 키의 data_version도 바뀌어 이전 응답은 다시 쓰이지 않으므로 바로 비운다
+    if legacy_snapshot is not None and cache.invalidate not in legacy_snapshot.on_synced:
+        legacy_snapshot.on_synced.append(cache.invalidate)
+    return cache
+
+llm_cache: LLMResponseCache | None = init_llm_cache()
+
+def _data_version() -> str | None:
+    # 스냅샷이 있으면 동기화로 행이 바뀔 때마다 키가 바뀐다 (없으면 Context 자체 + TTL로 신선도 유지)
+    if legacy_snapshot is not None:
+        try:
+            return legacy_snapshot.version()
+        except Exception:
+            return None
+    return None
+
+
+@st.cache_resource
+def init_gemini_transport() -> GeminiTransport | None:
+    if not GEMINI_API_KEY:
+        return None
+    return GeminiTransport(GEMINI_API_KEY)
+
+gemini_transport: GeminiTransport | None = init_gemini_transport()
 
 
 # =============================================================================
@@ -89,6 +1641,86 @@ LEGACY_FORCE_WORDS = [
     "0차", "최종", "납기", "생산일",
 ]
 
+
+class _KeywordAutomaton:
+    """
+    Aho-Corasick 키워드 자동기계.
+    {클래스: [키워드...]}를 import 시점에 한 번 컴파일해 두고,
+    프롬프트를 한 번만 훑어서 매칭된 클래스 집합을 돌려준다(겹치는 키워드도 모두 인식).
+    """
+
+    def __init__(self, groups: dict):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [frozenset()]
+        self._all = frozenset(groups.keys())
+
+        outs = [set()]
+        for cls, words in groups.items():
+            for w in words:
+                w = str(w).lower()
+                if not w:
+                    continue
+                node = 0
+                for ch in w:
+                    nxt = self._goto[node].get(ch)
+                    if nxt is None:
+                        nxt = len(self._goto)
+                        self._goto[node][ch] = nxt
+                        self._goto.append({})
+                        self._fail.append(0)
+                        outs.append(set())
+                    node = nxt
+                outs[node].add(cls)
+
+        # BFS로 실패 링크 계산 + 출력 집합 병합
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0) if node else 0
+                outs[nxt] |= outs[self._fail[nxt]]
+        self._out = [frozenset(o) for o in outs]
+
+    def scan(self, text: str) -> frozenset:
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        node = 0
+        for ch in text.lower():
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found |= out[node]
+                if len(found) == len(self._all):
+                    break
+        return frozenset(found)
+
+
+_PERCENT_RE = re.compile(r"\d+\s*%")
+
+def _build_intent_automaton() -> _KeywordAutomaton:
+    return _KeywordAutomaton({
+        "hybrid": HYBRID_INTENT_WORDS,
+        "legacy": LEGACY_FORCE_WORDS,
+        "capa": ["capa", "카파"],
+        "case": ["사례"],
+    })
+
+_INTENT_AUTOMATON = _build_intent_automaton()
+
+def rebuild_intent_automaton():
+    """HYBRID_INTENT_WORDS/LEGACY_FORCE_WORDS를 런타임에 바꿨다면 호출"""
+    global _INTENT_AUTOMATON
+    _INTENT_AUTOMATON = _build_intent_automaton()
+
+def _intent_classes(prompt: str) -> frozenset:
+    return _INTENT_AUTOMATON.scan(prompt)
+
 def _extract_year(prompt: str, default_year: str) -> str:
     m = re.search(r"(20\d{2})\s*년", prompt)
     if m:
@@ -143,33 +1775,35 @@ def _extract_date_any(prompt: str, default_year: str = "2026") -> str | None:
 
     return None
 
-def _has_adjustment_intent(prompt: str) -> bool:
-    p = prompt.lower()
-    if re.search(r"\d+\s*%", p):
+def _has_adjustment_intent(prompt: str, classes: frozenset | None = None) -> bool:
+    if _PERCENT_RE.search(prompt):
         return True
-    return any(w in p for w in [x.lower() for x in HYBRID_INTENT_WORDS])
+    if classes is None:
+        classes = _intent_classes(prompt)
+    return "hybrid" in classes
 
 def classify_route(prompt: str) -> tuple[str, dict]:
     meta = {}
+    classes = _intent_classes(prompt)
 
-    if "사례" in prompt:
+    if "case" in classes:
         meta["reason"] = "force_legacy_case"
         return "legacy", meta
 
-    p_lower = prompt.lower()
+    adjust = _has_adjustment_intent(prompt, classes)
 
-    if any(w.lower() in p_lower for w in [x.lower() for x in LEGACY_FORCE_WORDS]):
-        if _has_adjustment_intent(prompt):
+    if "legacy" in classes:
+        if adjust:
             meta["reason"] = "legacy_word_but_adjustment_intent"
             return "hybrid", meta
         meta["reason"] = "force_legacy_words"
         return "legacy", meta
 
-    if ("capa" in p_lower or "카파" in prompt) and not _has_adjustment_intent(prompt):
+    if "capa" in classes and not adjust:
         meta["reason"] = "capa_lookup_legacy"
         return "legacy", meta
 
-    if _has_adjustment_intent(prompt):
+    if adjust:
         meta["reason"] = "adjustment_intent"
         return "hybrid", meta
 
@@ -177,6 +1811,147 @@ def classify_route(prompt: str) -> tuple[str, dict]:
     return "legacy", meta
 
 
+# =============================================================================
+# Query Plan (parse once)
+# =============================================================================
+
+LEGACY_ISSUE_MAPPING = {
+    "MDL1": {"keywords": ["먼저", "줄여", "순위", "교체"], "db_text": "생산순위 조정",
+             "title": "MDL1: 미달(생산순위 조정/모델 교체)"},
+    "MDL2": {"keywords": ["감사", "정지", "설비", "라인전체"], "db_text": "라인전체이슈",
+             "title": "MDL2: 미달(라인전체이슈/설비)"},
+    "MDL3": {"keywords": ["부품", "자재", "결품", "수급", "안되는"], "db_text": "자재결품",
+             "title": "MDL3: 미달(부품수급/자재결품)"},
+    "PRP": {"keywords": ["선행", "미리", "당겨", "땡겨"], "db_text": "선행 생산",
+            "title": "PRP: 선행 생산(숙제 미리하기)"},
+    "SMP": {"keywords": ["샘플", "긴급"], "db_text": "계획외 긴급 생산",
+            "title": "SMP: 계획외 긴급 생산"},
+    "CCL": {"keywords": ["취소"], "db_text": "계획 취소", "title": "CCL: 계획 취소/라인 가동중단"},
+}
+
+LEGACY_GUBUN_KEYWORDS = ["fan", "motor", "flange", "팬", "모터", "플랜지"]
+
+# 레거시 분기별 조회 테이블 (실행 전에 필요한 DB 호출을 미리 알 수 있도록)
+LEGACY_BRANCH_TABLES = {
+    "increase_case": ("final_issue",),
+    "issue_case": ("production_issue_analysis_8_11",),
+    "monthly_briefing": ("monthly_production",),
+    "month_total": ("monthly_production",),
+    "month_capa": ("daily_capa",),
+    "capa_compare": ("daily_capa", "daily_total_production"),
+    "gubun_total": ("production_data",),
+    "date_product": ("production_data",),
+    "date_total": ("daily_total_production", "production_data"),
+    "none": (),
+}
+
+
+@dataclass(frozen=True)
+class QueryPlan:
+    """프롬프트를 한 번만 파싱한 결과. 라우터/레거시/하이브리드가 모두 이 값을 사용한다."""
+    text: str
+    route: str
+    route_reason: str
+    year: str
+    date: str | None = None            # 레거시 기준 날짜 (LEGACY_DEFAULT_YEAR)
+    month: int | None = None
+    months: tuple = ()
+    version: str = "최종"
+    product_key: str | None = None
+    legacy_branch: str = "none"
+    issue_code: str | None = None
+    gubun: str | None = None
+    compare: bool = False
+    hybrid_date: str | None = None     # 하이브리드 기준 날짜 (2026년, 오늘/내일/모레)
+    line: str | None = None
+    target_percent: float | None = None
+    sweep_percents: tuple = ()         # 목표 가동률 여러 개(what-if 스윕), 2개 이상일 때만
+    sample_qty: int | None = None
+    add_qty: int | None = None
+
+    @property
+    def tables(self) -> tuple:
+        if self.route == "hybrid":
+            return (HYBRID_PLAN_TABLE,)
+        return LEGACY_BRANCH_TABLES.get(self.legacy_branch, ())
+
+    def debug_info(self) -> dict:
+        d = {k: v for k, v in asdict(self).items() if k != "text" and v not in (None, (), False)}
+        d["tables"] = list(self.tables)
+        return d
+
+
+def _detect_issue_code(text: str) -> str | None:
+    for code, meta in LEGACY_ISSUE_MAPPING.items():
+        if any(k in text for k in meta["keywords"]):
+            return code
+    return None
+
+def _detect_gubun(text: str) -> str | None:
+    low = text.lower()
+    if not any(k in low for k in LEGACY_GUBUN_KEYWORDS):
+        return None
+    if "fan" in low or "팬" in text:
+        return "Fan"
+    if "motor" in low or "모터" in text:
+        return "Motor"
+    return "Flange"
+
+def _select_legacy_branch(text: str, target_date, target_month, months, product_key, issue_code, gubun) -> str:
+    if ("늘려" in text or "증량" in text or "증가" in text) and "사례" in text:
+        return "increase_case"
+    if "사례" in text and issue_code:
+        return "issue_case"
+    if len(months) >= 2 and product_key is None:
+        return "monthly_briefing"
+    if target_month and product_key is None and not target_date and _is_month_total_query(text):
+        return "month_total"
+    if target_month and (("capa" in text.lower()) or ("카파" in text)) \
+       and "비교" not in text and "초과" not in text and not target_date:
+        return "month_capa"
+    if ("초과" in text and "월" in text) or ("비교" in text and "월" in text and product_key is None):
+        return "capa_compare"
+    if target_month and gubun:
+        return "gubun_total"
+    if target_date and product_key:
+        return "date_product"
+    if target_date and ("생산량" in text):
+        return "date_total"
+    return "none"
+
+def parse_query(prompt: str) -> QueryPlan:
+    route, meta = classify_route(prompt)
+
+    info = extract_date_info_legacy(prompt, LEGACY_DEFAULT_YEAR)
+    months = tuple(sorted({int(m) for m in re.findall(r"(\d{1,2})월", prompt)}))
+    product_key = extract_product_keyword(prompt)
+    issue_code = _detect_issue_code(prompt) if "사례" in prompt else None
+    gubun = _detect_gubun(prompt)
+    branch = _select_legacy_branch(prompt, info["date"], info["month"], months, product_key, issue_code, gubun)
+
+    return QueryPlan(
+        text=prompt,
+        route=route,
+        route_reason=meta.get("reason", ""),
+        year=info["year"],
+        date=info["date"],
+        month=info["month"],
+        months=months,
+        version=extract_version(prompt),
+        product_key=product_key,
+        legacy_branch=branch,
+        issue_code=issue_code,
+        gubun=gubun,
+        compare="비교" in prompt,
+        hybrid_date=_extract_date_any(prompt, default_year="2026"),
+        line=next((ln for ln in ["조립1", "조립2", "조립3"] if ln in prompt), None),
+        target_percent=_parse_target_percent(prompt),
+        sweep_percents=_parse_sweep_percents(prompt),
+        sample_qty=_parse_sample_qty(prompt),
+        add_qty=_parse_add_qty(prompt),
+    )
+
+
 # =============================================================================
 # Legacy
 # =============================================================================
@@ -211,18 +1986,20 @@ def extract_version(text: str) -> str:
         return "0차"
     return "최종"
 
+_PRODUCT_IGNORE_WORDS = frozenset(w.lower() for w in [
+    "생산량","알려줘","비교해줘","비교","제품","최종","0차","월","일","capa","카파",
+    "초과","어떻게","돼","있어","사례","총","월간","브리핑",
+    "fan","motor","flange","팬","모터","플랜지",
+    "조립1","조립2","조립3",
+    "늘려","증량","증가",
+])
+_NON_WORD_RE = re.compile(r"[^a-zA-Z0-9가-힣]")
+_MONTH_DAY_TOKEN_RE = re.compile(r"\d+(월|일)")
+
 def extract_product_keyword(text: str) -> str | None:
-    ignore_words = [
-        "생산량","알려줘","비교해줘","비교","제품","최종","0차","월","일","capa","카파",
-        "초과","어떻게","돼","있어","사례","총","월간","브리핑",
-        "fan","motor","flange","팬","모터","플랜지",
-        "조립1","조립2","조립3",
-        "늘려","증량","증가",
-    ]
-    words = text.split()
-    for w in words:
-        clean = re.sub(r"[^a-zA-Z0-9가-힣]", "", w)
-        if clean and clean.lower() not in [x.lower() for x in ignore_words] and not re.match(r"\d+(월|일)", clean):
+    for w in text.split():
+        clean = _NON_WORD_RE.sub("", w)
+        if clean and clean.lower() not in _PRODUCT_IGNORE_WORDS and not _MONTH_DAY_TOKEN_RE.match(clean):
             return clean
     return None
 
@@ -252,24 +2029,221 @@ def _is_month_total_query(user_input: str) -> bool:
         return True
     return False
 
-def fetch_db_data_legacy(user_input: str) -> str:
+# -----------------------------------------------------------------------------
+# Product name index (trigram)
+# -----------------------------------------------------------------------------
+
+def _normalize_product(name) -> str:
+    # extract_product_keyword와 같은 규칙(특수문자 제거)으로 맞춰야 'T6-002A' == 'T6002A'
+    return _NON_WORD_RE.sub("", str(name)).lower()
+
+def _trigrams(s: str) -> set:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+def _padded_trigrams(s: str) -> set:
+    return _trigrams(f"  {s} ")
+
+
+class ProductTrigramIndex:
+    """고유 품명 목록 위의 trigram 역색인. 부분일치는 색인으로 후보를 좁히고, 오타는 유사도로 찾는다."""
+
+    def __init__(self, names):
+        self.names = sorted({str(n) for n in names if n})
+        self.norm = [_normalize_product(n) for n in self.names]
+        self.by_norm = {}
+        self.postings = {}
+        for i, s in enumerate(self.norm):
+            self.by_norm.setdefault(s, []).append(i)
+            for g in _trigrams(s):
+                self.postings.setdefault(g, set()).add(i)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _substring(self, key: str) -> list:
+        grams = _trigrams(key)
+        if grams:
+            cand = None
+            for g in sorted(grams, key=lambda g: len(self.postings.get(g, ()))):
+                post = self.postings.get(g)
+                if not post:
+                    return []
+                cand = set(post) if cand is None else cand & post
+                if not cand:
+                    return []
+        else:
+            cand = range(len(self.norm))
+        return [i for i in cand if key in self.norm[i]]
+
+    def lookup(self, keyword: str, limit: int = 5) -> tuple[list, str | None]:
+        """
+        ([(품명, 점수), ...], mode) 반환. mode: exact | substring | fuzzy | None
+        - exact/substring: ilike '%키워드%'와 같은 집합(가까운 길이 순)
+        - fuzzy: 부분일치가 없을 때 trigram 유사도 상위 (오타 허용)
+        """
+        key = _normalize_product(keyword)
+        if not key:
+            return [], None
+
+        if key in self.by_norm:
+            hits = self.by_norm[key]
+            subs = [i for i in self._substring(key) if i not in hits]
+            ranked = [(self.names[i], 1.0) for i in hits] + \
+                     [(self.names[i], len(key) / len(self.norm[i])) for i in sorted(subs, key=lambda i: len(self.norm[i]))]
+            return ranked, "exact"
+
+        subs = self._substring(key)
+        if subs:
+            subs.sort(key=lambda i: (len(self.norm[i]), self.norm[i]))
+            return [(self.names[i], len(key) / len(self.norm[i])) for i in subs], "substring"
+
+        q = _padded_trigrams(key)
+        overlap = {}
+        for g in _trigrams(key):
+            for i in self.postings.get(g, ()):
+                overlap[i] = overlap.get(i, 0) + 1
+        scored = []
+        for i in (overlap or range(len(self.norm))):
+            t = _padded_trigrams(self.norm[i])
+            score = 2.0 * len(q & t) / (len(q) + len(t)) if (q or t) else 0.0
+            if score >= PRODUCT_FUZZY_THRESHOLD:
+                scored.append((self.names[i], score))
+        scored.sort(key=lambda x: (-x[1], x[0]))
+        return scored[:limit], ("fuzzy" if scored else None)
+
+
+PRODUCT_CATALOG_RPC_SQL = """
+create or replace function legacy_product_names()
+returns table ("품명" text)
+language sql stable as $$
+  select distinct "품명" from production_data where "품명" is not null
+$$;
+"""
+
+
+class ProductCatalog:
+    """
+    production_data 고유 품명 카탈로그.
+    색인은 요청 경로 밖(백그라운드 스레드)에서 만든다: 처음/TTL 만료/무효화 후 조회는 새로 만드는 동안
+    이전 색인(처음이면 None -> 호출 측은 ilike 조회)을 바로 돌려준다.
+    품명은 스냅샷이 준비돼 있으면 로컬에서, 아니면 고유 품명 RPC로 받고, RPC가 없으면 컬럼을 페이지로 훑는다.
+    """
+
+    def __init__(self, ttl: float, rpc: str = PRODUCT_CATALOG_RPC):
+        self.ttl = float(ttl)
+        self.rpc = rpc
+        self.last_error = None
+        self._index = None
+        self._built_at = 0.0
+        self._rpc_retry_at = 0.0
+        self._refreshing = None  # 진행 중인 갱신 스레드
+        self._lock = threading.Lock()
+
+    def _names(self) -> set:
+        if legacy_snapshot is not None and legacy_snapshot.is_ready("production_data"):
+            client = legacy_snapshot
+        else:
+            client = supabase
+            if self.rpc and hasattr(client, "rpc") and time.monotonic() >= self._rpc_retry_at:
+                try:
+                    return {r.get("품명") for r in (client.rpc(self.rpc, {}).execute().data or [])}
+                except Exception:
+                    # 함수가 없거나 실패하면 한동안 RPC를 건너뛰고 페이지 조회
+                    self._rpc_retry_at = time.monotonic() + LEGACY_AGG_RPC_RETRY_SEC
+        # 품명 목록은 크고 한 번만 쓰므로 결과 캐시는 거치지 않는다
+        names = set()
+        for page in iter_pages(lambda: client.table("production_data").select(select_columns("legacy.product_catalog")),
+                               page_order("legacy.product_catalog")):
+            names.update(r.get("품명") for r in page)
+        return names
+
+    def _rebuild(self):
+        try:
+            index = ProductTrigramIndex(self._names())
+            with self._lock:
+                self._index, self._built_at = index, time.monotonic()
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)  # 실패하면 이전 색인을 그대로 사용(다음 조회 때 다시 시도)
+        finally:
+            with self._lock:
+                self._refreshing = None
+
+    def refresh(self, wait: bool = False):
+        """백그라운드 갱신을 시작한다(이미 진행 중이면 그것을 사용). wait=True면 끝날 때까지 기다림."""
+        with self._lock:
+            t = self._refreshing
+            if t is None:
+                t = self._refreshing = threading.Thread(target=self._rebuild, name="product-catalog", daemon=True)
+                t.start()
+        if wait:
+            t.join()
+
+    def index(self) -> ProductTrigramIndex | None:
+        with self._lock:
+            index, stale = self._index, self._index is None or time.monotonic() - self._built_at > self.ttl
+        if stale:
+            self.refresh()
+        return index
+
+    def invalidate(self, table: str | None = None):
+        if table in (None, "production_data"):
+            with self._lock:
+                self._built_at = float("-inf")
+
+
+@st.cache_resource
+def init_product_catalog() -> ProductCatalog | None:
+    if not PRODUCT_INDEX_ENABLED:
+        return None
+    catalog = ProductCatalog(PRODUCT_CATALOG_TTL_SEC)
+    if legacy_snapshot is not None and catalog.invalidate not in legacy_snapshot.on_synced:
+        legacy_snapshot.on_synced.append(catalog.invalidate)
+    if supabase is not None:
+        catalog.refresh()  # 시작 시 미리 만들어 첫 품명 질문이 기다리지 않게
+    return catalog
+
+product_catalog: ProductCatalog | None = init_product_catalog()
+
+def _product_filter(product_key: str) -> tuple[tuple, str]:
+    """
+    품명 필터와 표시용 라벨 반환.
+    색인으로 품명을 찾으면 ("in", "품명", [...]) equality 필터, 못 찾으면 기존 ilike 필터.
+    """
+    index = product_catalog.index() if product_catalog is not None and supabase is not None else None
+    if index is not None and len(index):
+        ranked, mode = index.lookup(product_key)
+        if mode == "fuzzy":
+            best = ranked[0][1]
+            names = [n for n, s in ranked if s == best]
+            return ("in", "품명", names), f"{product_key}→{', '.join(names)}"
+        if mode and len(ranked) <= PRODUCT_IN_MAX:
+            return ("in", "품명", [n for n, _ in ranked]), product_key
+    return ("ilike", "품명", f"%{product_key}%"), product_key
+
+
+def fetch_db_data_legacy(user_input: str, plan: QueryPlan | None = None) -> str:
     if supabase is None:
         return "SUPABASE_URL/SUPABASE_KEY가 설정되지 않아 DB 조회를 할 수 없습니다. Streamlit Secrets를 확인하세요."
 
-    info = extract_date_info_legacy(user_input, LEGACY_DEFAULT_YEAR)
-    target_date = info["date"]
-    target_month = info["month"]
-    target_version = extract_version(user_input)
-    product_key = extract_product_keyword(user_input)
+    plan = plan or parse_query(user_input)
+    target_date = plan.date
+    target_month = plan.month
+    target_version = plan.version
+    product_key = plan.product_key
+    branch = plan.legacy_branch
+    db = _legacy_db()
 
     try:
         # =====================================================================
         # 0) 생산량 증량 사례 검색 (NEW - 최우선 순위)
         # =====================================================================
-        if ("늘려" in user_input or "증량" in user_input or "증가" in user_input) and "사례" in user_input:
-            query = supabase.table("final_issue").select("날짜, 품목명, 생산량, final_role, final_remark")
-            query = query.or_("final_remark.ilike.%긴급 물량 증량%,final_remark.ilike.%품목간 간섭%")
-            response = query.execute()
+        if branch == "increase_case":
+            response = projected("legacy.increase_case", fetch_all(
+                lambda: db.table("final_issue").select(select_columns("legacy.increase_case"))
+                .or_("final_remark.ilike.%긴급 물량 증량%,final_remark.ilike.%품목간 간섭%"),
+                page_order("legacy.increase_case"),
+            ))
             
             if response.data:
                 date_groups = {}
@@ -318,61 +2292,44 @@ def fetch_db_data_legacy(user_input: str) -> str:
         # =====================================================================
         # 1) 과거 이슈 사례
         # =====================================================================
-        if "사례" in user_input:
-            issue_mapping = {
-                "MDL1": {"keywords": ["먼저", "줄여", "순위", "교체"], "db_text": "생산순위 조정",
-                         "title": "MDL1: 미달(생산순위 조정/모델 교체)"},
-                "MDL2": {"keywords": ["감사", "정지", "설비", "라인전체"], "db_text": "라인전체이슈",
-                         "title": "MDL2: 미달(라인전체이슈/설비)"},
-                "MDL3": {"keywords": ["부품", "자재", "결품", "수급", "안되는"], "db_text": "자재결품",
-                         "title": "MDL3: 미달(부품수급/자재결품)"},
-                "PRP": {"keywords": ["선행", "미리", "당겨", "땡겨"], "db_text": "선행 생산",
-                        "title": "PRP: 선행 생산(숙제 미리하기)"},
-                "SMP": {"keywords": ["샘플", "긴급"], "db_text": "계획외 긴급 생산",
-                        "title": "SMP: 계획외 긴급 생산"},
-                "CCL": {"keywords": ["취소"], "db_text": "계획 취소", "title": "CCL: 계획 취소/라인 가동중단"},
-            }
-            detected_code = None
-            for code, meta in issue_mapping.items():
-                if any(k in user_input for k in meta["keywords"]):
-                    detected_code = code
-                    break
-
-            if detected_code:
-                meta = issue_mapping[detected_code]
-                query = supabase.table("production_issue_analysis_8_11") \
-                    .select("품목명, 날짜, 계획_v0, 실적_v2, 누적차이_Gap, 최종_이슈분류")
+        if branch == "issue_case":
+            detected_code = plan.issue_code
+            meta = LEGACY_ISSUE_MAPPING[detected_code]
+            query = db.table("production_issue_analysis_8_11") \
+                .select(select_columns("legacy.issue_case"))
+
+            if detected_code == "MDL2":
+                query = query.or_("최종_이슈분류.ilike.%라인전체이슈%,최종_이슈분류.ilike.%설비%")
+            elif detected_code == "MDL3":
+                query = query.or_("최종_이슈분류.ilike.%부품수급%,최종_이슈분류.ilike.%자재결품%")
+            else:
+                query = query.ilike("최종_이슈분류", f"%{meta['db_text']}%")
 
-                if detected_code == "MDL2":
-                    query = query.or_("최종_이슈분류.ilike.%라인전체이슈%,최종_이슈분류.ilike.%설비%")
-                elif detected_code == "MDL3":
-                    query = query.or_("최종_이슈분류.ilike.%부품수급%,최종_이슈분류.ilike.%자재결품%")
-                else:
-                    query = query.ilike("최종_이슈분류", f"%{meta['db_text']}%")
-
-                res = query.limit(3).execute()
-                if res.data:
-                    return (
-                        f"[CODE CASE FOUND]\n"
-                        f"Code: {detected_code}\n"
-                        f"Title: {meta['title']}\n"
-                        f"Data: {json.dumps(res.data, ensure_ascii=False)}"
-                    )
-                return "관련된 과거 유사 사례를 찾을 수 없습니다."
+            res = projected("legacy.issue_case", query.limit(3).execute())
+            if res.data:
+                table = compact_table(
+                    res.data, ["날짜", "품목명", "계획_v0", "실적_v2", "누적차이_Gap"], "issue_case",
+                    rank=lambda r: abs(_agg_number(r.get("누적차이_Gap"))),
+                )
+                return (
+                    f"[CODE CASE FOUND]\n"
+                    f"Code: {detected_code}\n"
+                    f"Title: {meta['title']}\n"
+                    f"Data:\n{table}"
+                )
+            return "관련된 과거 유사 사례를 찾을 수 없습니다."
 
         # =====================================================================
         # 2) 월간 총 생산량 브리핑 (두 달 이상)
         # =====================================================================
-        found_months = re.findall(r"(\d{1,2})월", user_input)
-        found_months = sorted(list(set([int(m) for m in found_months])))
-
-        if len(found_months) >= 2 and product_key is None:
-            target_ver = extract_version(user_input)
-            res = supabase.table("monthly_production") \
-                .select("월, 총_생산량") \
-                .in_("월", found_months) \
-                .eq("버전", target_ver) \
-                .execute()
+        if branch == "monthly_briefing":
+            found_months = list(plan.months)
+            target_ver = target_version
+            res = projected("legacy.monthly_total", db.table("monthly_production")
+                            .select(select_columns("legacy.monthly_total"))
+                            .in_("월", found_months)
+                            .eq("버전", target_ver)
+                            .execute())
             if res.data:
                 df = pd.DataFrame(res.data).sort_values(by="월")
                 out = [f"[{target_ver} 월간 총 생산량 브리핑]"]
@@ -397,13 +2354,13 @@ def fetch_db_data_legacy(user_input: str) -> str:
         # =====================================================================
         # 2-1) [FIX] 단일 월 총 생산량 ("00월 총 생산량 알려줘")
         # =====================================================================
-        if target_month and product_key is None and not target_date and _is_month_total_query(user_input):
-            res = supabase.table("monthly_production") \
-                .select("월, 총_생산량") \
-                .eq("월", target_month) \
-                .eq("버전", target_version) \
-                .limit(1) \
-                .execute()
+        if branch == "month_total":
+            res = projected("legacy.monthly_total", db.table("monthly_production")
+                            .select(select_columns("legacy.monthly_total"))
+                            .eq("월", target_month)
+                            .eq("버전", target_version)
+                            .limit(1)
+                            .execute())
             if res.data:
                 row = res.data[0]
                 return f"[{row['월']}월 {target_version} 총 생산량]: {int(row['총_생산량']):,}"
@@ -412,13 +2369,12 @@ def fetch_db_data_legacy(user_input: str) -> str:
         # =====================================================================
         # 3) 월 CAPA 조회
         # =====================================================================
-        if target_month and (("capa" in user_input.lower()) or ("카파" in user_input)) \
-           and "비교" not in user_input and "초과" not in user_input and not target_date:
-            res = supabase.table("daily_capa") \
-                .select("라인, capa") \
-                .eq("월", target_month) \
-                .eq("버전", target_version) \
-                .execute()
+        if branch == "month_capa":
+            res = projected("legacy.month_capa", db.table("daily_capa")
+                            .select(select_columns("legacy.month_capa"))
+                            .eq("월", target_month)
+                            .eq("버전", target_version)
+                            .execute())
             if res.data:
                 df = pd.DataFrame(res.data)
                 df["라인"] = df["라인"].apply(normalize_line_name)
@@ -433,9 +2389,17 @@ def fetch_db_data_legacy(user_input: str) -> str:
         # =====================================================================
         # 4) CAPA 초과/비교 (월 단위)
         # =====================================================================
-        if ("초과" in user_input and "월" in user_input) or ("비교" in user_input and "월" in user_input and product_key is None):
-            res_capa = supabase.table("daily_capa").select("*").eq("월", target_month).eq("버전", "최종").execute()
-            res_prod = supabase.table("daily_total_production").select("*").eq("월", target_month).eq("버전", "최종").execute()
+        if branch == "capa_compare":
+            r = QueryBatch() \
+                .add("capa", db.table("daily_capa").select(select_columns("legacy.capa_compare.capa"))
+                     .eq("월", target_month).eq("버전", "최종").execute) \
+                .add("prod", fetch_all,
+                     lambda: db.table("daily_total_production").select(select_columns("legacy.capa_compare.prod"))
+                     .eq("월", target_month).eq("버전", "최종"),
+                     page_order("legacy.capa_compare.prod")) \
+                .run()
+            res_capa = projected("legacy.capa_compare.capa", r["capa"])
+            res_prod = projected("legacy.capa_compare.prod", r["prod"])
             if not res_capa.data or not res_prod.data:
                 return "데이터 조회 실패(월/버전 확인 필요)"
 
@@ -462,68 +2426,64 @@ def fetch_db_data_legacy(user_input: str) -> str:
         # =====================================================================
         # 5) 구분 합계(Fan/Motor/Flange)
         # =====================================================================
-        gubun_keywords = ["fan","motor","flange","팬","모터","플랜지"]
-        if target_month and any(k in user_input.lower() for k in gubun_keywords):
-            if "fan" in user_input.lower() or "팬" in user_input:
-                g = "Fan"
-            elif "motor" in user_input.lower() or "모터" in user_input:
-                g = "Motor"
-            else:
-                g = "Flange"
-
-            res = supabase.table("production_data") \
-                .select("생산량") \
-                .eq("월", target_month) \
-                .eq("버전", "최종") \
-                .ilike("구분", f"%{g}%") \
-                .execute()
-            if res.data:
-                total = sum([x["생산량"] for x in res.data])
+        if branch == "gubun_total":
+            g = plan.gubun
+            total, n = aggregate_total(db, "production_data", "생산량", [
+                ("eq", "월", target_month), ("eq", "버전", "최종"), ("ilike", "구분", f"%{g}%"),
+            ])
+            if n:
                 return f"[{target_month}월 {g} 총 생산량(최종)]: {total:,}"
             return f"{target_month}월 {g} 데이터가 없습니다."
 
         # =====================================================================
         # 6) 특정 일자 + 제품명 생산량 (0차 vs 최종 비교)
         # =====================================================================
-        if target_date and product_key:
-            if "비교" in user_input:
-                res_v0 = supabase.table("production_data").select("*") \
-                    .eq("납기일", target_date).eq("버전", "0차").ilike("품명", f"%{product_key}%").execute()
-                res_final = supabase.table("production_data").select("*") \
-                    .eq("생산일", target_date).eq("버전", "최종").ilike("품명", f"%{product_key}%").execute()
-
-                v0_qty = sum([x.get("생산량", 0) for x in (res_v0.data or [])])
-                final_qty = sum([x.get("생산량", 0) for x in (res_final.data or [])])
+        if branch == "date_product":
+            product_filter, product_label = _product_filter(product_key)
+            if plan.compare:
+                r = QueryBatch() \
+                    .add("v0", aggregate_total, db, "production_data", "생산량", [
+                        ("eq", "납기일", target_date), ("eq", "버전", "0차"), product_filter,
+                    ]) \
+                    .add("final", aggregate_total, db, "production_data", "생산량", [
+                        ("eq", "생산일", target_date), ("eq", "버전", "최종"), product_filter,
+                    ]) \
+                    .run()
+                v0_qty, _ = r["v0"]
+                final_qty, _ = r["final"]
 
                 return (
-                    f"[비교 결과 ({target_date} {product_key})]\n"
+                    f"[비교 결과 ({target_date} {product_label})]\n"
                     f"- 0차(납기일 기준): {v0_qty:,}\n"
                     f"- 최종(생산일 기준): {final_qty:,}\n"
                 )
 
             ver_col = "납기일" if target_version == "0차" else "생산일"
-            res = supabase.table("production_data").select("*") \
-                .eq("버전", target_version).eq(ver_col, target_date).ilike("품명", f"%{product_key}%").execute()
+            query = db.table("production_data").select(select_columns("legacy.date_product")) \
+                .eq("버전", target_version).eq(ver_col, target_date)
+            res = projected("legacy.date_product", _apply_filters(query, [product_filter]).execute())
             if res.data:
                 total = sum([x.get("생산량", 0) for x in res.data])
-                return f"[제품 데이터 ({target_date} {product_key} / {target_version})]\n[총 생산량]: {total:,}\nData: {json.dumps(res.data, ensure_ascii=False)}"
+                table = compact_table(res.data, ["품명", "구분", "생산량"], "date_product",
+                                      rank=lambda r: _agg_number(r.get("생산량")))
+                return f"[제품 데이터 ({target_date} {product_label} / {target_version})]\n[총 생산량]: {total:,}\nData:\n{table}"
             return f"[알림] {target_date}에 '{product_key}' {target_version} 데이터가 없습니다."
 
         # =====================================================================
         # 7) 일자별 총 생산량
         # =====================================================================
-        if target_date and ("생산량" in user_input):
-            res = supabase.table("daily_total_production") \
-                .select("총_생산량").eq("날짜", target_date).eq("버전", target_version).execute()
-            if res.data:
-                total = sum([x["총_생산량"] for x in res.data])
+        if branch == "date_total":
+            total, n = aggregate_total(db, "daily_total_production", "총_생산량", [
+                ("eq", "날짜", target_date), ("eq", "버전", target_version),
+            ])
+            if n:
                 return f"[{target_date} {target_version} 총 생산량]: {total:,} (daily_total 합계)"
 
             ver_col = "납기일" if target_version == "0차" else "생산일"
-            res_fallback = supabase.table("production_data").select("생산량") \
-                .eq(ver_col, target_date).eq("버전", target_version).execute()
-            if res_fallback.data:
-                total = sum([x.get("생산량", 0) for x in res_fallback.data])
+            total, n = aggregate_total(db, "production_data", "생산량", [
+                ("eq", ver_col, target_date), ("eq", "버전", target_version),
+            ])
+            if n:
                 return f"[{target_date} {target_version} 총 생산량]: {total:,} (item 합계)"
             return f"[{target_date}] 데이터가 없습니다."
 
@@ -533,14 +2493,89 @@ def fetch_db_data_legacy(user_input: str) -> str:
         return f"레거시 DB 조회 오류: {str(e)}"
 
 
-def query_gemini_legacy(user_input: str, context: str) -> str:
-    if not GEMINI_API_KEY:
-        return context
+# -----------------------------------------------------------------------------
+# Template renderer (LLM 없이 구조화 Context -> 마크다운)
+# -----------------------------------------------------------------------------
+# _render_legacy_prompt의 답변 규칙과 같은 형식으로 출력한다. 규칙을 바꾸면 양쪽을 함께 고칠 것.
+def _md_table(headers: list, rows: list) -> str:
+    out = ["| " + " | ".join(headers) + " |", "|" + "---|" * len(headers)]
+    for r in rows:
+        out.append("| " + " | ".join("" if v is None else str(v) for v in r) + " |")
+    return "\n".join(out)
 
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent?key={GEMINI_API_KEY}"
-    headers = {"Content-Type": "application/json"}
+def _render_capa_over(context: str) -> str:
+    rows = [ln for ln in context.splitlines()[1:] if ln.startswith("|")]
+    return "\n".join(["| 날짜 | 라인 | CAPA | 총 생산량 |", "|---|---|---|---|"] + rows)
+
+def _render_increase_case(context: str) -> str:
+    out = ["# 생산량 증량 사례 (품목간 우선순위 조정)"]
+    date, section, tables = None, None, {}
+
+    def flush():
+        if date is None:
+            return
+        out.append(f"\n**[날짜: {date}]**")
+        for key, title in (("inc", "증가한 제품 (선순위):"), ("dec", "감소한 제품 (후순위):")):
+            out.append(f"\n{title}")
+            out.append(_md_table(["제품명", "생산량"], tables.get(key, [])))
+
+    for ln in context.splitlines():
+        m = re.match(r"^\[날짜: (.+)\]$", ln)
+        if m:
+            flush()
+            date, section, tables = m.group(1), None, {}
+        elif ln.startswith("증가(선순위)"):
+            section = "inc"
+        elif ln.startswith("감소(후순위)"):
+            section = "dec"
+        elif section and ln.startswith("  - "):
+            name, _, qty = ln[4:].rpartition(": ")
+            tables.setdefault(section, []).append((name, qty))
+    flush()
+    return "\n".join(out)
+
+def _render_code_case(context: str) -> str | None:
+    head, _, data = context.partition("\nData:\n")
+    fields = dict(ln.split(": ", 1) for ln in head.splitlines()[1:] if ": " in ln)
+    rows = parse_compact_table(data)
+    if not rows:
+        return None
+    table = _md_table(
+        ["날짜", "품목명", "계획(V0)", "실적(V2)", "차이(Gap)"],
+        [(r.get("날짜"), r.get("품목명"), r.get("계획_v0"), r.get("실적_v2"), r.get("누적차이_Gap")) for r in rows],
+    )
+    return f"# {fields.get('Code', '')}: {fields.get('Title', '')}\n\n{table}"
+
+def _render_monthly_briefing(context: str) -> str:
+    title, *lines = context.splitlines()
+    return f"### {title.strip('[]')}\n\n" + "\n".join(lines)
+
+def _render_month_total(context: str) -> str:
+    label, _, value = context.partition("]: ")
+    return f"**{label.lstrip('[')}**: {value}"
+
+_LEGACY_TEMPLATES = [
+    (re.compile(r"^\[CAPA 초과 리스트\]\n"), _render_capa_over),
+    (re.compile(r"^\[PRODUCTION_INCREASE CASE FOUND\]\n"), _render_increase_case),
+    (re.compile(r"^\[CODE CASE FOUND\]\n"), _render_code_case),
+    (re.compile(r"^\[\S+ 월간 총 생산량 브리핑\]\n"), _render_monthly_briefing),
+    (re.compile(r"^\[\d{1,2}월 \S+ 총 생산량\]: [\d,]+$"), _render_month_total),
+]
+
+def render_legacy_template(context: str) -> str | None:
+    """구조화된 Context면 마크다운 답변을, 자연어 합성이 필요한 Context면 None을 반환"""
+    if not LEGACY_TEMPLATE_RENDER:
+        return None
+    for pattern, render in _LEGACY_TEMPLATES:
+        if pattern.search(context):
+            out = render(context)
+            if out is not None:
+                _record_metric("llm_skipped", "legacy", render.__name__.removeprefix("_render_"))
+            return out
+    return None
 
-    system_prompt = f"""
+def _render_legacy_prompt(user_input: str, context: str) -> str:
+    return f"""
 당신은 숙련된 생산계획 담당자입니다. 제공된 데이터(Context)를 기반으로 사용자의 질문에 답하세요.
 
 [중요: CAPA 초과 답변 규칙]
@@ -585,23 +2620,113 @@ Context에 [CODE CASE FOUND]가 있다면:
 [User Question]
 {user_input}
 """
-    data = {"contents": [{"parts": [{"text": system_prompt}]}]}
+
+def _legacy_cache_lookup(system_prompt: str) -> tuple[str | None, str | None]:
+    if llm_cache is None:
+        return None, None
+    cache_key = LLMResponseCache.make_key(GEMINI_MODEL, system_prompt, _data_version())
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        _record_metric("llm_cache", "legacy", "hit")
+    return cache_key, cached
+
+def query_gemini_legacy(user_input: str, context: str) -> str:
+    rendered = render_legacy_template(context)
+    if rendered is not None:
+        return rendered
+    if gemini_transport is None:
+        return context
+
+    system_prompt = _render_legacy_prompt(user_input, context)
+    cache_key, cached = _legacy_cache_lookup(system_prompt)
+    if cached is not None:
+        return cached
+
+    try:
+        answer = gemini_transport.generate(system_prompt, label="legacy")
+    except Exception:
+        return context
+    if cache_key is not None:
+        llm_cache.put(cache_key, answer)
+    return answer
+
+STREAM_TRUNCATED_NOTICE = "\n\n⚠️ 응답이 중간에 끊겼습니다. 위 내용은 불완전할 수 있으니 다시 질문해 주세요."
+
+def query_gemini_legacy_stream(user_input: str, context: str):
+    """query_gemini_legacy의 스트리밍 버전: 텍스트 조각을 생성되는 대로 yield"""
+    rendered = render_legacy_template(context)
+    if rendered is not None:
+        yield rendered
+        return
+    if gemini_transport is None:
+        yield context
+        return
+
+    system_prompt = _render_legacy_prompt(user_input, context)
+    cache_key, cached = _legacy_cache_lookup(system_prompt)
+    if cached is not None:
+        yield cached
+        return
+
+    parts = []
+    try:
+        for chunk in gemini_transport.stream(system_prompt, label="legacy"):
+            parts.append(chunk)
+            yield chunk
+    except Exception:
+        # 이미 내보낸 조각은 되돌릴 수 없으므로 잘렸음을 덧붙이고, 불완전한 답은 캐시하지 않는다
+        yield STREAM_TRUNCATED_NOTICE if parts else context
+        return
+    if cache_key is not None and parts:
+        llm_cache.put(cache_key, "".join(parts))
+
+
+async def query_gemini_legacy_async(user_input: str, context: str) -> str:
+    rendered = render_legacy_template(context)
+    if rendered is not None:
+        return rendered
+    if gemini_transport is None:
+        return context
+
+    system_prompt = _render_legacy_prompt(user_input, context)
+    cache_key, cached = _legacy_cache_lookup(system_prompt)
+    if cached is not None:
+        return cached
+
     try:
-        r = requests.post(url, headers=headers, json=data, timeout=60)
-        if r.status_code != 200:
-            return context
-        j = r.json()
-        return j["candidates"][0]["content"]["parts"][0]["text"]
+        answer = await gemini_transport.aio().generate(system_prompt, label="legacy")
     except Exception:
         return context
+    if cache_key is not None:
+        llm_cache.put(cache_key, answer)
+    return answer
 
+def _is_legacy_error(ctx: str) -> bool:
+    return ("오류" in ctx) or ("설정되지" in ctx) or ("찾을 수 없습니다" in ctx)
 
-def run_legacy(prompt: str) -> str:
-    ctx = fetch_db_data_legacy(prompt)
-    if ("오류" in ctx) or ("설정되지" in ctx) or ("찾을 수 없습니다" in ctx):
+def run_legacy(prompt: str, plan: QueryPlan | None = None) -> str:
+    ctx = fetch_db_data_legacy(prompt, plan)
+    if _is_legacy_error(ctx):
         return ctx
     return query_gemini_legacy(prompt, ctx)
 
+def run_legacy_stream(prompt: str, plan: QueryPlan | None = None):
+    ctx = fetch_db_data_legacy(prompt, plan)
+    if _is_legacy_error(ctx):
+        yield ctx
+        return
+    yield from query_gemini_legacy_stream(prompt, ctx)
+
+async def fetch_db_data_legacy_async(user_input: str, plan: QueryPlan | None = None) -> str:
+    # DB 계층(스냅샷/캐시/QueryBatch)은 동기 구현이므로 스레드에서 실행 (contextvars는 to_thread가 복사)
+    return await asyncio.to_thread(fetch_db_data_legacy, user_input, plan)
+
+async def run_legacy_async(prompt: str, plan: QueryPlan | None = None) -> str:
+    ctx = await fetch_db_data_legacy_async(prompt, plan)
+    if _is_legacy_error(ctx):
+        return ctx
+    return await query_gemini_legacy_async(prompt, ctx)
+
 
 # =============================================================================
 # Hybrid
@@ -609,36 +2734,346 @@ def run_legacy(prompt: str) -> str:
 
 TODAY = None
 CAPA_LIMITS = None
+DAILY_CAPA = {}
 
-def initialize_globals(today: date, capa_limits: dict):
-    global TODAY, CAPA_LIMITS
+def initialize_globals(today: date, capa_limits: dict, daily_capa: dict | None = None):
+    global TODAY, CAPA_LIMITS, DAILY_CAPA
     TODAY = today
     CAPA_LIMITS = capa_limits
+    DAILY_CAPA = daily_capa or {}
+
+def capa_for(line: str, date_str: str) -> int:
+    """
+    그 날 라인 CAPA: daily_capa의 (날짜, 라인) -> ((연, 월), 라인) -> (월, 라인) -> CAPA_LIMITS 순.
+    (월, 라인)은 날짜 없는 행(연도 정보 없음)에서만 만들어지므로 다른 해의 일자 행이 끼어들지 않는다.
+    """
+    return capa_lookup(CAPA_LIMITS, DAILY_CAPA, line, date_str)
+
+def capa_lookup(capa_limits: dict, daily_capa: dict, line: str, date_str: str) -> int:
+    """capa_for의 전역 없는 버전(배치 작업 스레드는 요청 스레드가 넘긴 CAPA 스냅샷으로 조회)"""
+    v = daily_capa.get((date_str, line))
+    if v is None:
+        v = daily_capa.get(((int(date_str[:4]), int(date_str[5:7])), line))
+    if v is None:
+        v = daily_capa.get((int(date_str[5:7]), line))
+    return int(capa_limits[line] if v is None else v)
+
+def _date_key(v) -> str:
+    """plan_date 값(str 또는 datetime64/Timestamp) -> 'YYYY-MM-DD' (단계 함수의 날짜 키는 항상 문자열)"""
+    return v if isinstance(v, str) else pd.Timestamp(v).strftime("%Y-%m-%d")
+
+def _factorize_keys(s: pd.Series):
+    """정렬된 정수 코드와 문자열 키 목록 (datetime64는 'YYYY-MM-DD', category는 값 문자열)"""
+    codes, uniques = pd.factorize(s, sort=True)
+    if isinstance(uniques, pd.DatetimeIndex):
+        return codes, list(uniques.strftime("%Y-%m-%d"))
+    return codes, [str(u) for u in uniques]
+
+def _group_positions(codes: np.ndarray) -> dict:
+    """코드 -> 그 코드 행 위치 배열(원래 행 순서). 결측(-1)과 빈 그룹은 없음"""
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, np.diff(sorted_codes) != 0])
+    return {int(sorted_codes[s]): idx for s, idx in zip(starts, np.split(order, starts[1:]))
+            if sorted_codes[s] >= 0}
+
+
+class WorkdayCalendar:
+    """
+    plan_df의 근무일 달력(조회 1회당 한 번 생성).
+    - days: is_workday == True 행이 있는 날짜의 정렬 목록 -> next/previous는 bisect로 O(log n)
+    - is_workday: 날짜별 첫 행의 is_workday 값(원래 hybrid_is_workday_in_db 기준) -> 사전 조회 O(1)
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.days = []
+        self._day_set = frozenset()
+        self._first_flag = {}
+        if df.empty or 'is_workday' not in df.columns:
+            return
+        first = df.drop_duplicates('plan_date')
+        self._first_flag = dict(zip(map(_date_key, first['plan_date']), first['is_workday']))
+        self.days = sorted(map(_date_key, df.loc[df['is_workday'] == True, 'plan_date'].unique()))
+        self._day_set = frozenset(self.days)
+
+    def __contains__(self, date_str: str) -> bool:
+        return date_str in self._day_set
+
+    def is_workday(self, date_str: str) -> bool:
+        return bool(self._first_flag.get(date_str, False))
+
+    def next(self, date_str: str, n: int) -> list:
+        """date_str 이상(당일 포함) 근무일 n개"""
+        i = bisect.bisect_left(self.days, date_str)
+        return self.days[i:i + n]
+
+    def previous(self, date_str: str, n: int, floor: str) -> list:
+        """floor 이상, date_str 미만 근무일 중 마지막 n개"""
+        if n <= 0:
+            return []
+        lo = bisect.bisect_left(self.days, floor)
+        hi = bisect.bisect_left(self.days, date_str)
+        return self.days[max(lo, hi - n):hi]
+
+    def between(self, start: str, end: str) -> list:
+        """start~end(양 끝 포함) 근무일"""
+        return self.days[bisect.bisect_left(self.days, start):bisect.bisect_right(self.days, end)]
+
+
+class PlanFrame:
+    """
+    plan_df를 조회 1회당 한 번만 인덱싱해 하이브리드 단계의 반복 마스크 필터를 사전 조회로 바꾼다.
+    - (plan_date, line) -> qty_1차 합계 / 행 위치
+    - plan_date -> 행 위치, product_name -> 행 위치(plan_date 정렬 결과는 처음 요청 시 메모)
+    - 근무일: WorkdayCalendar(calendar), 계획 날짜 정렬 목록(dates)
+    각 단계 함수는 DataFrame도 그대로 받는다(PlanFrame.of로 감쌈).
+    plan_df는 문자열 컬럼 그대로든 typed_plan_frame 결과(datetime64/category/int32)든 되고,
+    조회 키(날짜/라인/품목)는 어느 쪽이든 문자열이다.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.empty = df.empty
+        self.dates = []
+        self._date_idx, self._dl_idx, self._prod_idx, self._dl_total = {}, {}, {}, {}
+        self._prod_series = {}
+        self._slack = None
+        self.calendar = WorkdayCalendar(df)
+        if self.empty:
+            return
+
+        # groupby.indices는 키마다 Timestamp/범주 값을 만들어 느리므로 정수 코드로 묶는다
+        d_codes, d_keys = _factorize_keys(df['plan_date'])
+        l_codes, l_keys = _factorize_keys(df['line'])
+        p_codes, p_keys = _factorize_keys(df['product_name'])
+        dl_codes = np.where((d_codes < 0) | (l_codes < 0), -1, d_codes * len(l_keys) + l_codes)
+        dl_sum = np.bincount(dl_codes[dl_codes >= 0], weights=df['qty_1차'].to_numpy(dtype="int64")[dl_codes >= 0])
+
+        self._date_idx = {d_keys[c]: v for c, v in _group_positions(d_codes).items()}
+        self._prod_idx = {p_keys[c]: v for c, v in _group_positions(p_codes).items()}
+        self.dates = sorted(self._date_idx)
+        for c, v in _group_positions(dl_codes).items():
+            key = (d_keys[c // len(l_keys)], l_keys[c % len(l_keys)])
+            self._dl_idx[key] = v
+            self._dl_total[key] = int(dl_sum[c])
+
+    @classmethod
+    def of(cls, plan_df) -> "PlanFrame":
+        return plan_df if isinstance(plan_df, PlanFrame) else cls(plan_df)
+
+    def rows_on(self, date_str: str) -> pd.DataFrame:
+        return self.df.iloc[self._date_idx.get(date_str, [])]
+
+    def rows_at(self, date_str: str, line: str) -> pd.DataFrame:
+        return self.df.iloc[self._dl_idx.get((date_str, line), [])]
+
+    def total(self, date_str: str, line: str):
+        return self._dl_total.get((date_str, line), 0)
+
+    def product_series(self, name: str) -> pd.DataFrame:
+        """해당 품목의 행을 plan_date 순으로(원래 마스크 + sort_values와 같은 결과)"""
+        s = self._prod_series.get(name)
+        if s is None:
+            s = self.df.iloc[self._prod_idx.get(name, [])].sort_values('plan_date')
+            self._prod_series[name] = s
+        return s
+
+    def slack_table(self) -> pd.DataFrame:
+        if self._slack is None:
+            self._slack = compute_slack_table(self.df)
+        return self._slack
+
+
+def compute_slack_table(plan_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    모든 (product_name, plan_date)에 대한 누적/미래 여유를 한 번에 계산한다.
+    index=(product_name, plan_date), columns=cumsum_target, cumsum_actual, future_slack, last_due, buffer_days
+    - cumsum_*: 품목별 날짜순 누적합의 그 날짜 첫 행 값(동일 날짜 중복 행은 원래 행 순서 유지)
+    - future_slack: 그 날짜 이후(초과) 1차 합 - 0차 합 (역방향 누적합)
+    - last_due: qty_0차 > 0인 마지막 날짜(없으면 "미확인", buffer_days=999)
+    """
+    cols = ["cumsum_target", "cumsum_actual", "future_slack", "last_due", "buffer_days"]
+    if plan_df.empty:
+        return pd.DataFrame(columns=cols, index=pd.MultiIndex.from_tuples([], names=["product_name", "plan_date"]))
+
+    # typed_plan_frame 결과면 누적합 오버플로를 피하려 int64로 올리고, 날짜/품목 키는 결과에서 문자열로 돌린다
+    d = plan_df[["product_name", "plan_date", "qty_0차", "qty_1차"]] \
+        .astype({"qty_0차": "int64", "qty_1차": "int64"}) \
+        .sort_values(["product_name", "plan_date"], kind="mergesort")
+    typed = pd.api.types.is_datetime64_any_dtype(d["plan_date"])
+    g = d.groupby("product_name", sort=False, observed=True)
+    d = d.assign(cumsum_target=g["qty_0차"].cumsum(), cumsum_actual=g["qty_1차"].cumsum())
+    out = d.drop_duplicates(["product_name", "plan_date"]).set_index(["product_name", "plan_date"])
+
+    per_date = d.groupby(["product_name", "plan_date"], sort=True, observed=True)[["qty_0차", "qty_1차"]].sum()
+    after = per_date.iloc[::-1].groupby(level=0, sort=False, observed=True).cumsum().iloc[::-1] - per_date
+    out["future_slack"] = (after["qty_1차"] - after["qty_0차"]).reindex(out.index)
+    if typed:
+        out.index = pd.MultiIndex.from_arrays([
+            out.index.get_level_values("product_name").astype(str),
+            out.index.get_level_values("plan_date").strftime("%Y-%m-%d"),
+        ], names=["product_name", "plan_date"])
+
+    # d는 (품목, 날짜) 정렬 상태이므로 품목별 마지막 행이 최대 날짜
+    last_due = d[d["qty_0차"] > 0].drop_duplicates("product_name", keep="last") \
+        .set_index("product_name")["plan_date"]
+    if typed:
+        last_due = pd.Series(last_due.dt.strftime("%Y-%m-%d").values, index=last_due.index.astype(str))
+    due = out.index.get_level_values("product_name").map(last_due)
+    has_due = pd.notna(due)
+    days = (pd.to_datetime(pd.Series(due, index=out.index)) -
+            pd.to_datetime(out.index.get_level_values("plan_date")).to_series(index=out.index)).dt.days
+    out["last_due"] = pd.Series(due, index=out.index).where(has_due, "미확인")
+    out["buffer_days"] = days.where(has_due, 999).astype(int)
+    return out[cols]
+
+
+class CapacityLedger:
+    """
+    (라인, 날짜 인덱스) 잔여 CAPA 장부. 계획 날짜(정렬)마다 capa/load 배열을 두고
+    라인별 잔여(capa - load) 최대 세그먼트 트리로 구간 질의를 한다(휴무일 잎은 목적지가 아니므로 -inf).
+    - reserve/release: 점 갱신 O(log n). 변경은 저널에 쌓여 snapshot() -> rollback(token)이 변경 수만큼만 든다
+    - max_remaining(line, start, end): 구간(양 끝 포함) 최대 잔여와 그 날짜 O(log n)
+    - first_fit(line, start, end, qty): 잔여 >= qty인 가장 이른 근무일 O(log n)
+    - status(line, date): step3의 capa_status 항목 형식
+    계획에 없는 날짜는 load 0으로 보고(질의만 가능, reserve 불가) CAPA는 capa_fn(기본 capa_for)을 따른다.
+    """
+    _NEG = float("-inf")
+
+    def __init__(self, days: list, workdays, lines, capa_fn, load_fn):
+        self.days = list(days)
+        self.lines = tuple(lines)
+        self._capa_fn = capa_fn
+        self._pos = {d: i for i, d in enumerate(self.days)}
+        self._workday = [d in workdays for d in self.days]
+        self._size = 1
+        while self._size < max(1, len(self.days)):
+            self._size *= 2
+        self._capa = {ln: [int(capa_fn(ln, d)) for d in self.days] for ln in self.lines}
+        self._load = {ln: [int(load_fn(d, ln)) for d in self.days] for ln in self.lines}
+        self._tree = {}
+        for ln in self.lines:
+            tree = [self._NEG] * (2 * self._size)
+            for i in range(len(self.days)):
+                tree[self._size + i] = self._leaf(ln, i)
+            for k in range(self._size - 1, 0, -1):
+                tree[k] = max(tree[2 * k], tree[2 * k + 1])
+            self._tree[ln] = tree
+        self._journal = []
+
+    @classmethod
+    def from_plan(cls, plan_df, lines=("조립1", "조립2", "조립3"), capa_fn=None) -> "CapacityLedger":
+        pf = PlanFrame.of(plan_df)
+        return cls(pf.dates, pf.calendar, lines, capa_fn or capa_for, pf.total)
+
+    def _leaf(self, line: str, i: int):
+        return self._capa[line][i] - self._load[line][i] if self._workday[i] else self._NEG
+
+    def _set(self, line: str, i: int):
+        tree, k = self._tree[line], self._size + i
+        tree[k] = self._leaf(line, i)
+        k //= 2
+        while k:
+            tree[k] = max(tree[2 * k], tree[2 * k + 1])
+            k //= 2
+
+    def _span(self, start: str, end: str):
+        return bisect.bisect_left(self.days, start), bisect.bisect_right(self.days, end)
+
+    # --- 조회 ---
+    def capacity(self, line: str, date_str: str) -> int:
+        i = self._pos.get(date_str)
+        return int(self._capa_fn(line, date_str)) if i is None else self._capa[line][i]
+
+    def load(self, line: str, date_str: str) -> int:
+        i = self._pos.get(date_str)
+        return 0 if i is None else self._load[line][i]
+
+    def remaining(self, line: str, date_str: str) -> int:
+        return self.capacity(line, date_str) - self.load(line, date_str)
+
+    def status(self, line: str, date_str: str) -> dict:
+        current, mx = self.load(line, date_str), self.capacity(line, date_str)
+        return {
+            'date': date_str, 'line': line,
+            'current': int(current),
+            'remaining': int(mx - current),
+            'max': int(mx),
+            'usage_rate': (float(current) / float(mx) * 100.0) if mx else 0.0
+        }
+
+    def max_remaining(self, line: str, start: str, end: str):
+        """start~end 근무일 중 최대 잔여 (잔여, 날짜). 근무일이 없으면 (None, None)"""
+        lo, hi = self._span(start, end)
+        tree, best, best_k = self._tree[line], self._NEG, None
+        lo += self._size
+        hi += self._size
+        while lo < hi:
+            if lo & 1:
+                if tree[lo] > best:
+                    best, best_k = tree[lo], lo
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                if tree[hi] > best:
+                    best, best_k = tree[hi], hi
+            lo //= 2
+            hi //= 2
+        if best_k is None:
+            return None, None
+        while best_k < self._size:  # 같은 값을 가진 자식으로 내려가 잎(날짜)을 찾는다
+            best_k = 2 * best_k if tree[2 * best_k] == best else 2 * best_k + 1
+        return int(best), self.days[best_k - self._size]
+
+    def first_fit(self, line: str, start: str, end: str, qty: int) -> str | None:
+        """start~end 근무일 중 잔여 >= qty인 가장 이른 날짜"""
+        lo, hi = self._span(start, end)
+        tree = self._tree[line]
+
+        def descend(k, k_lo, k_hi):
+            if k_hi <= lo or hi <= k_lo or tree[k] < qty:
+                return None
+            if k >= self._size:
+                return k - self._size
+            mid = (k_lo + k_hi) // 2
+            found = descend(2 * k, k_lo, mid)
+            return found if found is not None else descend(2 * k + 1, mid, k_hi)
+
+        i = descend(1, 0, self._size)
+        return None if i is None else self.days[i]
+
+    # --- 변경 ---
+    def reserve(self, line: str, date_str: str, qty: int):
+        """date_str 라인에 qty만큼 부하 추가(음수면 반납). 계획에 없는 날짜면 KeyError"""
+        i = self._pos[date_str]
+        self._load[line][i] += int(qty)
+        self._journal.append((line, i, int(qty)))
+        self._set(line, i)
+
+    def release(self, line: str, date_str: str, qty: int):
+        self.reserve(line, date_str, -int(qty))
+
+    def snapshot(self) -> int:
+        return len(self._journal)
+
+    def rollback(self, token: int):
+        while len(self._journal) > token:
+            line, i, qty = self._journal.pop()
+            self._load[line][i] -= qty
+            self._set(line, i)
+
 
 def hybrid_is_workday_in_db(plan_df, date_str):
-    if plan_df.empty or 'is_workday' not in plan_df.columns:
-        return False
-    row = plan_df[plan_df['plan_date'] == date_str]
-    if not row.empty:
-        return bool(row.iloc[0].get('is_workday', False))
-    return False
+    return PlanFrame.of(plan_df).calendar.is_workday(date_str)
 
 def get_workdays_from_db(plan_df, start_date_str, direction='future', days_count=10):
-    if plan_df.empty or 'is_workday' not in plan_df.columns:
-        return []
-    db_dates = plan_df[['plan_date', 'is_workday']].drop_duplicates().sort_values('plan_date')
-
+    cal = PlanFrame.of(plan_df).calendar
     if direction == 'future':
-        available = db_dates[(db_dates['plan_date'] >= start_date_str) & (db_dates['is_workday'] == True)]
-        return available['plan_date'].head(days_count).tolist()
-
-    available = db_dates[(db_dates['plan_date'] < start_date_str) &
-                         (db_dates['plan_date'] >= TODAY.strftime('%Y-%m-%d')) &
-                         (db_dates['is_workday'] == True)]
-    return available['plan_date'].tail(days_count).tolist()
+        return cal.next(start_date_str, days_count)
+    return cal.previous(start_date_str, days_count, TODAY.strftime('%Y-%m-%d'))
 
 def step1_list_current_stock(plan_df, target_date, target_line):
-    current = plan_df[(plan_df['plan_date'] == target_date) & (plan_df['line'] == target_line)].copy()
+    current = PlanFrame.of(plan_df).rows_at(target_date, target_line)
     if current.empty:
         return None, "해당 날짜에 생산 계획이 없습니다."
     total = int(current['qty_1차'].sum())
@@ -659,28 +3094,23 @@ def step2_calculate_cumulative_slack(plan_df, stock_result):
     return list with additional fields for reporting:
       - cumsum_target, cumsum_actual, future_slack
     """
+    table = PlanFrame.of(plan_df).slack_table()
+    try:
+        today = table.xs(stock_result['date'], level="plan_date").to_dict("index")
+    except KeyError:
+        today = {}
+
     items_with_slack = []
     for item in stock_result['items']:
         p_name = item['name']
-        p_series = plan_df[plan_df['product_name'] == p_name].sort_values('plan_date').copy()
-        if p_series.empty:
+        row = today.get(p_name)
+        if row is None:
             continue
 
-        p_series['cumsum_0차'] = p_series['qty_0차'].cumsum()
-        p_series['cumsum_1차'] = p_series['qty_1차'].cumsum()
-
-        today_row = p_series[p_series['plan_date'] == stock_result['date']]
-        if today_row.empty:
-            continue
-        today_row = today_row.iloc[0]
-
-        cumsum_target = int(today_row.get('cumsum_0차', 0))
-        cumsum_actual = int(today_row.get('cumsum_1차', 0))
+        cumsum_target = int(row['cumsum_target'])
+        cumsum_actual = int(row['cumsum_actual'])
         max_movable_cumsum = cumsum_actual - cumsum_target
-
-        future_demand = int(p_series[p_series['plan_date'] > stock_result['date']]['qty_0차'].sum())
-        future_prod = int(p_series[p_series['plan_date'] > stock_result['date']]['qty_1차'].sum())
-        future_slack = int(future_prod - future_demand)
+        future_slack = int(row['future_slack'])
 
         if max_movable_cumsum > 0:
             max_movable = max_movable_cumsum
@@ -690,15 +3120,8 @@ def step2_calculate_cumulative_slack(plan_df, stock_result):
             else:
                 max_movable = max(0, int(item['qty_1차']) + future_slack)
 
-        due_dates = p_series[p_series['qty_0차'] > 0]['plan_date'].tolist()
-        last_due = max(due_dates) if due_dates else "미확인"
-
-        if last_due != "미확인":
-            last_due_dt = datetime.strptime(last_due, '%Y-%m-%d').date()
-            target_dt = datetime.strptime(stock_result['date'], '%Y-%m-%d').date()
-            buffer_days = (last_due_dt - target_dt).days
-        else:
-            buffer_days = 999
+        last_due = row['last_due']
+        buffer_days = int(row['buffer_days'])
 
         items_with_slack.append({
             'name': p_name,
@@ -715,33 +3138,37 @@ def step2_calculate_cumulative_slack(plan_df, stock_result):
         })
     return items_with_slack
 
-def step3_analyze_destination_capacity(plan_df, target_date, target_line):
-    future_workdays = get_workdays_from_db(plan_df, target_date, direction='future', days_count=10)
+def _destination_days(plan_df: PlanFrame, ledger: CapacityLedger, target_date: str, line: str) -> list:
+    """
+    같은 라인 목적지 근무일. 처음 10일은 잔여와 무관하게 모두 넣고(리포트/AI 맥락),
+    HYBRID_DEST_HORIZON_DAYS가 더 길면 그 뒤는 잔여가 있는 날만 first_fit으로 건너뛰며 모은다.
+    """
+    days = plan_df.calendar.next(target_date, max(10, HYBRID_DEST_HORIZON_DAYS))
+    head = days[:min(10, HYBRID_DEST_HORIZON_DAYS)]
+    if len(days) <= len(head):
+        return head
+    out, cursor, end = list(head), days[len(head)], days[-1]
+    while cursor is not None:
+        d = ledger.first_fit(line, cursor, end, 1)
+        if d is None:
+            break
+        out.append(d)
+        after = plan_df.calendar.next(d, 2)
+        cursor = after[1] if len(after) > 1 and after[1] <= end else None
+    return out
+
+def step3_analyze_destination_capacity(plan_df, target_date, target_line, ledger: CapacityLedger | None = None):
+    plan_df = PlanFrame.of(plan_df)
+    ledger = ledger or CapacityLedger.from_plan(plan_df)
     capa_status = {}
 
     for line in ["조립1", "조립2", "조립3"]:
         if line != target_line:
-            current = plan_df[(plan_df['plan_date'] == target_date) & (plan_df['line'] == line)]['qty_1차'].sum()
-            remaining = CAPA_LIMITS[line] - current
-            capa_status[f"{target_date}_{line}"] = {
-                'date': target_date, 'line': line,
-                'current': int(current),
-                'remaining': int(remaining),
-                'max': int(CAPA_LIMITS[line]),
-                'usage_rate': (float(current) / float(CAPA_LIMITS[line]) * 100.0) if CAPA_LIMITS[line] else 0.0
-            }
+            capa_status[f"{target_date}_{line}"] = ledger.status(line, target_date)
 
         if line == target_line:
-            for d in future_workdays:
-                current = plan_df[(plan_df['plan_date'] == d) & (plan_df['line'] == line)]['qty_1차'].sum()
-                remaining = CAPA_LIMITS[line] - current
-                capa_status[f"{d}_{line}"] = {
-                    'date': d, 'line': line,
-                    'current': int(current),
-                    'remaining': int(remaining),
-                    'max': int(CAPA_LIMITS[line]),
-                    'usage_rate': (float(current) / float(CAPA_LIMITS[line]) * 100.0) if CAPA_LIMITS[line] else 0.0
-                }
+            for d in _destination_days(plan_df, ledger, target_date, line):
+                capa_status[f"{d}_{line}"] = ledger.status(line, d)
     return capa_status
 
 def step4_prepare_constraint_info(items_with_slack, target_line):
@@ -781,6 +3208,45 @@ def _parse_target_percent(prompt: str) -> float | None:
         return int(m.group(1)) / 100.0
     return None
 
+# 스윕 파싱 전에 지우는 숫자 토큰: 날짜(2026-01-06, 1/6, 1월 6일), 라인명(조립1), 수량(샘플 200, 100개)
+_SWEEP_NOISE_RE = re.compile(
+    r"\d{4}\s*[-./]\s*\d{1,2}\s*[-./]\s*\d{1,2}"
+    r"|\d{1,2}\s*/\s*\d{1,2}(?:\s*/\s*\d{2,4})?"
+    r"|\d{1,2}\s*월(?:\s*\d{1,2}\s*일)?|\d{1,2}\s*일"
+    r"|조립\s*\d+|샘플\s*\d+|\d+\s*(?:개|ea|EA|plt|PLT)"
+)
+_SWEEP_KEYWORDS = r"(?:스윕|비교|sweep|what-?if)"
+_SWEEP_NUM = r"(?<![A-Za-z0-9_.])\d{1,3}"
+
+def _parse_sweep_percents(prompt: str) -> tuple:
+    """
+    what-if 스윕 목표 가동률(0~1, 오름차순). HYBRID_SWEEP_MIN_PCT~100 사이 값이 2개 이상일 때만 반환한다.
+    날짜/라인명/수량은 먼저 지운다('1/6 조립1, 80%'가 목록 (1, 80)으로 읽히지 않도록).
+      - 범위: '70~85%', '70%-85%' (+ '5%씩'/'5% 간격'/'5 단위', 기본 5%p)
+      - 목록: 모든 값에 %가 붙은 '70%, 75%, 80%', 또는 스윕 키워드와 붙어 있는
+        '스윕 70, 75, 80' / '70, 75, 80% 비교'
+    """
+    text = _SWEEP_NOISE_RE.sub(" ", prompt)
+    pcts = []
+    m = re.search(rf"({_SWEEP_NUM})\s*%?\s*[~\-]\s*(\d{{1,3}})\s*%", text)
+    if m:
+        lo, hi = sorted((int(m.group(1)), int(m.group(2))))
+        s = re.search(r"(\d{1,2})\s*%?\s*(?:씩|간격|단위)", text[m.end():])
+        step = int(s.group(1)) if s and int(s.group(1)) > 0 else 5
+        pcts = list(range(lo, hi + 1, step))
+        if pcts[-1] != hi:
+            pcts.append(hi)
+    else:
+        bare_list = rf"({_SWEEP_NUM}(?:\s*%?\s*,\s*\d{{1,3}})+)\s*%?"
+        m = (re.search(rf"({_SWEEP_NUM}\s*%(?:\s*,\s*\d{{1,3}}\s*%)+)", text)
+             or re.search(rf"{_SWEEP_KEYWORDS}\s*:?\s*{bare_list}", text, re.IGNORECASE)
+             or re.search(rf"({_SWEEP_NUM}(?:\s*%?\s*,\s*\d{{1,3}})+)\s*%\s*(?:로|으로)?\s*{_SWEEP_KEYWORDS}",
+                          text, re.IGNORECASE))
+        if m:
+            pcts = [int(x) for x in re.findall(r"\d{1,3}", m.group(1))]
+    pcts = sorted({p for p in pcts if HYBRID_SWEEP_MIN_PCT <= p <= 100})
+    return tuple(p / 100.0 for p in pcts) if len(pcts) >= 2 else ()
+
 def _parse_sample_qty(prompt: str) -> int | None:
     m = re.search(r"샘플\s*(\d+)", prompt)
     if m:
@@ -796,7 +3262,13 @@ def _parse_add_qty(prompt: str) -> int | None:
         return int(m.group(1))
     return None
 
-def step6_validate_moves_with_adjust(moves, constraint_info, capa_status, plan_df, target_line):
+def step6_validate_moves_with_adjust(moves, constraint_info, capa_status, plan_df, target_line,
+                                     ledger: CapacityLedger | None = None):
+    """
+    ledger를 주면 목적지 잔여를 장부에서 읽고 통과한 이동을 장부에 reserve한다(capa_status는 목적지 범위 확인만).
+    없으면 예전처럼 capa_status의 remaining을 직접 차감한다.
+    """
+    plan_df = PlanFrame.of(plan_df)
     valid = []
     violations = []
 
@@ -845,11 +3317,14 @@ def step6_validate_moves_with_adjust(moves, constraint_info, capa_status, plan_d
             violations.append(f"⚠️[{i}] {item_name}: 목적지 CAPA 정보 없음({capa_key})")
             continue
 
-        if not hybrid_is_workday_in_db(plan_df, to_date):
+        if not plan_df.calendar.is_workday(to_date):
             violations.append(f"❌[{i}] {item_name}: 목적지 {to_date} 휴무일")
             continue
 
-        remaining = int(capa_status[capa_key]["remaining"])
+        if ledger is not None:
+            remaining = int(ledger.remaining(to_line, to_date))
+        else:
+            remaining = int(capa_status[capa_key]["remaining"])
         plt = int(item["plt"])
 
         if qty > remaining:
@@ -869,38 +3344,271 @@ def step6_validate_moves_with_adjust(moves, constraint_info, capa_status, plan_d
             mv = dict(mv)
             mv["adjusted"] = False
 
-        capa_status[capa_key]["remaining"] = int(capa_status[capa_key]["remaining"]) - int(qty)
+        if ledger is not None:
+            ledger.reserve(to_line, to_date, qty)
+        else:
+            capa_status[capa_key]["remaining"] = int(capa_status[capa_key]["remaining"]) - int(qty)
         valid.append(mv)
 
     return valid, violations
 
-@st.cache_data(ttl=600)
-def fetch_data_hybrid(target_date: str):
+class PlanWindowCache:
+    """
+    HYBRID_PLAN_TABLE의 plan_date 구간 캐시.
+    - 받아 둔 구간(양 끝 포함)은 재사용하고 요청 구간에서 빠진 부분만 조회한 뒤 인접 구간과 병합
+    - 구간마다 조회 시각을 두고 TTL이 지나면 그 구간만 버린다(병합 시 더 오래된 시각 유지)
+    - 프로세스 전역(st.cache_resource)이라 1/20 -> 1/21처럼 가까운 날짜 질문은 네트워크 없이 처리
+    - 조회는 락 밖에서 한다. 조회 중인 구간은 Future로 등록해 같은 구간을 요청한 다른 스레드는 다시 조회하지 않고 기다린다
+    """
+
+    def __init__(self, fetch_range, ttl: float = HYBRID_PLAN_CACHE_TTL_SEC):
+        self._fetch_range = fetch_range  # (start_str, end_str) -> [row dict]
+        self.ttl = float(ttl)
+        self._segments = []  # [[start: date, end: date, fetched_at, rows]] 시작일 순, 서로 겹치지 않음
+        self._inflight = {}  # (start: date, end: date) -> Future[rows], 세그먼트/서로와 겹치지 않음
+        self._generation = 0  # invalidate마다 증가: 그 전에 시작한 조회 결과는 캐시에 넣지 않는다
+        self._lock = threading.Lock()
+        self.fetched_days = 0
+        self.served_days = 0
+
+    @staticmethod
+    def _gaps(segments, start: date, end: date) -> list:
+        gaps, cur = [], start
+        for s, e, _, _ in segments:
+            if e < cur:
+                continue
+            if s > end:
+                break
+            if s > cur:
+                gaps.append((cur, s - timedelta(days=1)))
+            cur = e + timedelta(days=1)
+            if cur > end:
+                return gaps
+        gaps.append((cur, end))
+        return gaps
+
+    def _insert(self, start: date, end: date, fetched_at: float, rows: list):
+        rows = sorted(rows, key=lambda r: str(r.get("plan_date")))
+        self._segments.append([start, end, fetched_at, rows])
+        self._segments.sort(key=lambda seg: seg[0])
+        merged = []
+        for seg in self._segments:
+            if merged and merged[-1][1] + timedelta(days=1) >= seg[0]:
+                last = merged[-1]
+                last[1] = max(last[1], seg[1])
+                last[2] = min(last[2], seg[2])
+                last[3] = last[3] + seg[3]
+            else:
+                merged.append(seg)
+        self._segments = merged
+
+    def get(self, start: str, end: str) -> pd.DataFrame:
+        s = datetime.strptime(start, "%Y-%m-%d").date()
+        e = datetime.strptime(end, "%Y-%m-%d").date()
+        with self._lock:
+            now = time.time()
+            self._segments = [seg for seg in self._segments if now - seg[2] < self.ttl]
+            # 세그먼트 행 리스트는 병합 시 새 리스트로 바뀌므로(제자리 수정 없음) 참조만 잡아 둬도 안전
+            cached = [seg[3] for seg in self._segments if seg[1] >= s and seg[0] <= e]
+            waiting = [fut for (fs, fe), fut in self._inflight.items() if fe >= s and fs <= e]
+            busy = sorted(self._segments + [[fs, fe, None, None] for fs, fe in self._inflight], key=lambda seg: seg[0])
+            gaps = self._gaps(busy, s, e)
+            owned = {gap: Future() for gap in gaps}
+            self._inflight.update(owned)
+            generation = self._generation
+            self.served_days += (e - s).days + 1
+
+        fetched = {}
+        if gaps:
+            batch = QueryBatch()
+            for i, (gs, ge) in enumerate(gaps):
+                batch.add(i, self._fetch_range, gs.isoformat(), ge.isoformat())
+            try:
+                fetched = batch.run()
+            except BaseException as exc:
+                with self._lock:
+                    for gap in gaps:
+                        self._inflight.pop(gap, None)
+                for fut in owned.values():
+                    fut.set_exception(exc)
+                raise
+            with self._lock:
+                for i, (gs, ge) in enumerate(gaps):
+                    self._inflight.pop((gs, ge), None)
+                    if generation == self._generation:
+                        self._insert(gs, ge, now, fetched[i])
+                    self.fetched_days += (ge - gs).days + 1
+            for i, gap in enumerate(gaps):
+                owned[gap].set_result(fetched[i])
+
+        parts = cached + [fetched[i] for i in range(len(gaps))] + [fut.result() for fut in waiting]
+        rows = sorted((r for part in parts for r in part if start <= str(r.get("plan_date")) <= end),
+                      key=lambda r: str(r.get("plan_date")))
+        _record_metric("plan_window", "fetched_days", sum((ge - gs).days + 1 for gs, ge in gaps))
+        return pd.DataFrame(rows)
+
+    def invalidate(self):
+        with self._lock:
+            self._segments = []
+            self._generation += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "segments": [(seg[0].isoformat(), seg[1].isoformat()) for seg in self._segments],
+                "fetched_days": self.fetched_days, "served_days": self.served_days,
+            }
+
+
+def _fetch_plan_range(start: str, end: str) -> list:
+    return fetch_all(
+        lambda: supabase.table(HYBRID_PLAN_TABLE).select(select_columns("hybrid.plan"))
+        .gte("plan_date", start).lte("plan_date", end),
+        page_order("hybrid.plan"),
+    ).data
+
+@st.cache_resource
+def init_plan_window_cache() -> PlanWindowCache:
+    return PlanWindowCache(_fetch_plan_range, HYBRID_PLAN_CACHE_TTL_SEC)
+
+plan_window_cache: PlanWindowCache = init_plan_window_cache()
+
+class PlanSchemaError(ValueError):
+    pass
+
+
+# hybrid plan 컬럼 -> 적재 dtype (typed_plan_frame)
+HYBRID_PLAN_DTYPES = {
+    "plan_date": "datetime64[ns]",
+    "line": "category",
+    "product_name": "category",
+    "qty_0차": "int32",
+    "qty_1차": "int32",
+    "plt": "int32",
+    "is_workday": "bool",
+}
+
+def typed_plan_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    JSON 행으로 만든 plan_df(전부 object/int64)를 HYBRID_PLAN_DTYPES로 바꾼다.
+    - plan_date: 'YYYY-MM-DD' -> datetime64 (형식이 다르거나 비어 있으면 실패)
+    - line/product_name: category (범주는 정렬 순서 = 문자열 정렬과 같은 groupby/sort 순서)
+    - qty_0차/qty_1차/plt: 정수 -> int32 (결측은 0, 소수/문자/범위 초과는 실패)
+    스키마가 맞지 않으면 PlanSchemaError.
+    """
+    if df.empty:
+        return df
+    missing = [c for c in HYBRID_PLAN_DTYPES if c not in df.columns]
+    if missing:
+        raise PlanSchemaError(f"hybrid.plan: {missing} 컬럼이 없습니다.")
+
+    out = {}
+    try:
+        out["plan_date"] = pd.to_datetime(df["plan_date"], format="%Y-%m-%d")
+    except (ValueError, TypeError) as e:
+        raise PlanSchemaError(f"hybrid.plan: plan_date 형식 오류({e})") from None
+    if out["plan_date"].isna().any():
+        raise PlanSchemaError("hybrid.plan: plan_date 결측")
+
+    for c in ("line", "product_name"):
+        if df[c].isna().any():
+            raise PlanSchemaError(f"hybrid.plan: {c} 결측")
+        s = df[c].astype(str)
+        out[c] = pd.Categorical(s, categories=sorted(s.unique()))
+
+    for c in ("qty_0차", "qty_1차", "plt"):
+        v = pd.to_numeric(df[c], errors="coerce")
+        bad = v.isna() & df[c].notna()
+        if bad.any():
+            raise PlanSchemaError(f"hybrid.plan: {c} 숫자가 아닌 값 {df.loc[bad, c].iloc[0]!r}")
+        v = v.fillna(0)
+        if (v % 1 != 0).any() or v.abs().max() >= 2 ** 31:
+            raise PlanSchemaError(f"hybrid.plan: {c} int32 범위의 정수가 아닙니다.")
+        out[c] = v.astype("int32")
+
+    out["is_workday"] = df["is_workday"].fillna(False).astype(bool)
+    extra = {c: df[c] for c in df.columns if c not in HYBRID_PLAN_DTYPES}
+    return pd.DataFrame({**out, **extra}, index=df.index)[list(df.columns)]
+
+def fetch_data_hybrid(target_date: str) -> pd.DataFrame:
     if supabase is None:
-        return pd.DataFrame(), pd.DataFrame()
+        return pd.DataFrame()
 
     dt = datetime.strptime(target_date, "%Y-%m-%d")
-    start = (dt - timedelta(days=10)).strftime("%Y-%m-%d")
-    end = (dt + timedelta(days=10)).strftime("%Y-%m-%d")
+    start = (dt - timedelta(days=HYBRID_PLAN_WINDOW_DAYS)).strftime("%Y-%m-%d")
+    end = (dt + timedelta(days=HYBRID_PLAN_WINDOW_DAYS)).strftime("%Y-%m-%d")
+    return typed_plan_frame(check_frame_projection(plan_window_cache.get(start, end), "hybrid.plan"))
 
-    plan_res = supabase.table(HYBRID_PLAN_TABLE).select("*").gte("plan_date", start).lte("plan_date", end).execute()
-    plan_df = pd.DataFrame(plan_res.data)
-
-    hist_df = pd.DataFrame()
+def _ttl_memo(ttl: float):
+    """
+    인자 없는 로더용 프로세스 전역 TTL 메모(st.cache_data 대신).
+    배치/비동기 경로의 작업 스레드에서도 호출되므로 ScriptRunContext에 의존하지 않는다.
+    DataFrame/dict는 호출부가 수정해도 캐시 원본이 바뀌지 않도록 복사본을 돌려준다. .clear()로 비움.
+    """
+    def deco(fn):
+        state = {"value": None, "at": None}
+        lock = threading.Lock()
+
+        @functools.wraps(fn)
+        def wrapper():
+            with lock:
+                if state["at"] is None or time.monotonic() - state["at"] > ttl:
+                    state["value"], state["at"] = fn(), time.monotonic()
+                value = state["value"]
+            return value.copy() if isinstance(value, (pd.DataFrame, dict)) else value
+
+        def clear():
+            with lock:
+                state["value"], state["at"] = None, None
+        wrapper.clear = clear
+        return wrapper
+    return deco
+
+@_ttl_memo(600)
+def load_hybrid_history() -> pd.DataFrame:
+    """조사 이력(HYBRID_HIST_TABLE). 필요한 단계에서만 호출한다(계획 조회와 함께 받지 않음)."""
+    if supabase is None:
+        return pd.DataFrame()
     try:
-        hist_res = supabase.table(HYBRID_HIST_TABLE).select("*").execute()
-        hist_df = pd.DataFrame(hist_res.data)
+        return pd.DataFrame(fetch_all(lambda: supabase.table(HYBRID_HIST_TABLE).select(select_columns("hybrid.hist")),
+                                      page_order("hybrid.hist", supabase)).data)
     except Exception:
-        pass
+        return pd.DataFrame()
 
-    return plan_df, hist_df
+@_ttl_memo(600)
+def load_hybrid_daily_capa() -> dict:
+    """
+    daily_capa(버전=최종)를 capa_for 조회용 사전으로: (날짜, 라인), ((연, 월), 라인), (월, 라인) -> capa.
+    월 단위 값의 연도는 그 행의 날짜에서 가져오고, 날짜 없는 행만 연도 없는 (월, 라인)으로 남긴다
+    (같은 키에 여러 값이면 마지막 값, CAPA 비교 분기와 같음).
+    """
+    if supabase is None or not HYBRID_DAILY_CAPA:
+        return {}
+    try:
+        rows = fetch_all(lambda: supabase.table("daily_capa").select(select_columns("hybrid.daily_capa"))
+                         .eq("버전", "최종"), page_order("hybrid.daily_capa", supabase)).data or []
+    except Exception:
+        return {}
+    out = {}
+    for r in rows:
+        try:
+            line, capa = normalize_line_name(r["라인"]), int(r["capa"])
+            day = normalize_date(r.get("날짜"))
+            month = None if r.get("월") is None else ((int(day[:4]), int(r["월"])) if day else int(r["월"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+        if day:
+            out[(day, line)] = capa
+        if month is not None:
+            out[(month, line)] = capa
+    return out
 
-def _pick_target_line(prompt: str, plan_df: pd.DataFrame, target_date: str) -> str | None:
+def _pick_target_line(prompt: str, plan_df: "pd.DataFrame | PlanFrame", target_date: str) -> str | None:
     for ln in ["조립1","조립2","조립3"]:
         if ln in prompt:
             return ln
 
-    date_rows = plan_df[plan_df["plan_date"] == target_date]
+    date_rows = PlanFrame.of(plan_df).rows_on(target_date)
     if date_rows.empty:
         return None
 
@@ -912,7 +3620,7 @@ def _pick_target_line(prompt: str, plan_df: pd.DataFrame, target_date: str) -> s
         lines = date_rows[date_rows["product_name"].str.contains("A2XX", case=False, na=False)]["line"].unique()
         return lines[0] if len(lines) else None
 
-    grp = date_rows.groupby("line")["qty_1차"].sum()
+    grp = date_rows.groupby("line", observed=True)["qty_1차"].sum()
     if grp.empty:
         return None
     return grp.idxmax()
@@ -922,28 +3630,26 @@ def _round_target(qty: int, unit: int) -> int:
         return qty
     return int(round(qty / unit) * unit)
 
-def _ai_build_moves(prompt, target_date, target_line, need_qty, constraint_info, capa_status, from_loc):
+def _ai_build_moves(prompt, target_date, target_line, need_qty, constraint_info, capa_status, from_loc,
+                    deadline: float | None = None):
     """
     감축 전용 AI 플래너(예전 수사 흐름에 맞춰 감축 이동만 생성)
+    deadline: Gemini 호출 전체 한도(초). 호출 측이 기다리지 않게 된 뒤에도 작업자를 붙잡지 않도록 한다.
     """
-    if not (genai and GEMINI_API_KEY):
+    if gemini_transport is None:
         return []
 
     fact = {
         "mode": "reduce",
         "target": {"date": target_date, "line": target_line, "need_reduce_qty": int(need_qty)},
         "capa_remaining": {k: int(v["remaining"]) for k, v in capa_status.items()},
-        "items": [{
-            "name": x["name"],
-            "plt": int(x["plt"]),
-            "max_movable": int(x["max_movable"]),
-            "is_t6": bool(x["is_t6"]),
-            "is_a2xx": bool(x["is_a2xx"]),
-            "constraint": x["constraint"],
-            "priority": x["priority"],
-        } for x in constraint_info[:80]],
         "from_loc": from_loc,
     }
+    # 품목은 예산 안에서 감축 여력(max_movable)이 큰 순으로 남긴다
+    items = compact_table(
+        constraint_info, ["name", "plt", "max_movable", "is_t6", "is_a2xx", "constraint", "priority"],
+        "hybrid_plan", rank=lambda x: int(x["max_movable"]),
+    )
 
     ai_prompt = f"""
 아래 FACT_JSON과 규칙을 기반으로 이동 계획을 JSON으로만 출력하라.
@@ -964,11 +3670,12 @@ def _ai_build_moves(prompt, target_date, target_line, need_qty, constraint_info,
 
 FACT_JSON:
 {json.dumps(fact, ensure_ascii=False)}
+
+ITEMS (첫 줄은 헤더, is_t6/is_a2xx는 Y/N):
+{items}
 """
     try:
-        model = genai.GenerativeModel("gemini-2.0-flash-exp")
-        resp = model.generate_content(ai_prompt)
-        raw = (resp.text or "").strip()
+        raw = (gemini_transport.generate(ai_prompt, label="hybrid_plan", deadline=deadline) or "").strip()
         raw = re.sub(r"```json\s*|\s*```", "", raw)
         s = raw.find("{")
         e = raw.rfind("}") + 1
@@ -1043,6 +3750,221 @@ def _fallback_reduce(constraint_info, capa_status, from_loc, target_line, need_r
 
     return moves
 
+def _reduce_destinations(it, capa_status, from_loc, target_line, plan_df=None) -> list:
+    """_fallback_reduce와 같은 규칙의 목적지 후보(T6: 당일 타라인, A2XX: 당일 조립1/2, 전용: 동일라인 다른 날)"""
+    from_date, _ = from_loc.split("_", 1)
+    if it["is_t6"] or it["is_a2xx"]:
+        lines = ["조립1", "조립2"] if it["is_a2xx"] else ["조립1", "조립2", "조립3"]
+        keys = [f"{from_date}_{ln}" for ln in lines if ln != target_line]
+    else:
+        keys = [k for k in capa_status if k.endswith(f"_{target_line}") and not k.startswith(from_date)]
+    keys = [k for k in keys if k in capa_status and int(capa_status[k]["remaining"]) > 0]
+    if plan_df is not None:
+        keys = [k for k in keys if hybrid_is_workday_in_db(plan_df, k.split("_", 1)[0])]
+    return keys
+
+def _reachable_sums(parts, cap: int) -> int:
+    """(plt, 최대 PLT 수) 목록으로 만들 수 있는 0..cap 합계의 비트셋(bit k = 합계 k 가능)"""
+    if cap <= 0:
+        return 1
+    mask = (1 << (cap + 1)) - 1
+    bits = 1
+    for plt, units in parts:
+        for _ in range(min(units, cap // plt)):
+            nxt = (bits | (bits << plt)) & mask
+            if nxt == bits:
+                break
+            bits = nxt
+    return bits
+
+def _optimal_reduce(constraint_info, capa_status, from_loc, target_line, need_reduce_qty,
+                    plan_df=None, time_limit: float | None = None, node_budget: int | None = None):
+    """
+    PLT 정수배 이동에 대한 정확한 분기한정(branch-and-bound) 감축 계획.
+    목적: 부족분(need - 이동량) 최소 -> 이동 건수 최소. 이동량은 need를 넘지 않는다.
+    제약: 품목별 min(max_movable, qty_1차), T6/A2XX/전용 라인 규칙, 근무일, 목적지 remaining.
+    greedy(_fallback_reduce) 결과를 초기해로 두므로 결과가 greedy보다 나빠지지 않으며,
+    time_limit 안에 탐색을 끝내지 못하면 그때까지의 최선해를 돌려준다.
+    node_budget을 주면 시간 대신 탐색 노드 수로 끊는다(부하/스레드 수와 무관하게 같은 입력이면 같은 결과).
+    반환: (moves, info) - info = {"optimal", "nodes", "ms", "greedy_qty", "qty"}
+    """
+    t0 = time.monotonic()
+    time_limit = HYBRID_OPT_TIME_LIMIT_SEC if time_limit is None else float(time_limit)
+    need = int(need_reduce_qty)
+
+    greedy = _fallback_reduce(constraint_info, {k: dict(v) for k, v in capa_status.items()},
+                              from_loc, target_line, need)
+    greedy_qty = sum(int(m["qty"]) for m in greedy)
+
+    dest_keys, dest_pos = [], {}
+    items = []
+    for it in constraint_info:
+        plt = int(it["plt"])
+        units = min(int(it["max_movable"]), int(it["qty_1차"])) // plt if plt > 0 else 0
+        keys = _reduce_destinations(it, capa_status, from_loc, target_line, plan_df)
+        if units <= 0 or not keys:
+            continue
+        for k in keys:
+            if k not in dest_pos:
+                dest_pos[k] = len(dest_keys)
+                dest_keys.append(k)
+        same_day = keys[0].split("_", 1)[0] == from_loc.split("_", 1)[0]
+        items.append((it["name"], plt, units, [dest_pos[k] for k in keys], int(same_day)))
+    items.sort(key=lambda x: (x[1], x[1] * x[2]), reverse=True)
+
+    n = len(items)
+    rem = [int(capa_status[k]["remaining"]) for k in dest_keys]
+    # 목적지 묶음: 0=동일라인 다른 날(전용), 1=당일 타라인(T6/A2XX). 묶음끼리는 목적지가 겹치지 않는다.
+    group_dests = [sorted({d for it in items if it[4] == g for d in it[3]}) for g in (0, 1)]
+    suffix_cap = [[0, 0] for _ in range(n + 1)]  # 묶음별 남은 품목 물량
+    suffix_gcd = [0] * (n + 1)
+    # 이동 건수 하한용: i번째 이후 품목 물량을 큰 순으로 누적한 합(각 품목은 최소 1건)
+    suffix_top = [[0] for _ in range(n + 1)]
+    for i in range(n - 1, -1, -1):
+        suffix_cap[i] = list(suffix_cap[i + 1])
+        suffix_cap[i][items[i][4]] += items[i][1] * items[i][2]
+        suffix_gcd[i] = math.gcd(suffix_gcd[i + 1], items[i][1])
+    for i in range(n):
+        caps = sorted((it[1] * it[2] for it in items[i:]), reverse=True)
+        acc = suffix_top[i]
+        for c in caps:
+            acc.append(acc[-1] + c)
+
+    # 목적지별로 들어올 수 있는 품목의 PLT 최소값/최대공약수: 잔여를 실제로 채울 수 있는 양으로 내림
+    dest_gcd, dest_min = [0] * len(dest_keys), [0] * len(dest_keys)
+    for _, plt, _, dests, _ in items:
+        for d in dests:
+            dest_gcd[d] = math.gcd(dest_gcd[d], plt)
+            dest_min[d] = min(dest_min[d], plt) if dest_min[d] else plt
+
+    def usable(d):
+        r = rem[d]
+        return 0 if r < dest_min[d] else (r // dest_gcd[d]) * dest_gcd[d]
+
+    # 루트 상한: 목적지별로 채울 수 있는 최대량의 합(묶음별) 안에서 PLT 조합으로 만들 수 있는 최대 합
+    dest_fill = []
+    for d in range(len(dest_keys)):
+        bits = _reachable_sums([(p, u) for _, p, u, ds, _ in items if d in ds], usable(d))
+        dest_fill.append(bits.bit_length() - 1)
+    reach = 1
+    for g in (0, 1):
+        members = [(p, u) for _, p, u, _, gid in items if gid == g]
+        if not members:
+            continue
+        bits = _reachable_sums(members, min(need, sum(dest_fill[d] for d in group_dests[g])))
+        combined, a = 0, 0
+        while bits >> a:
+            if (bits >> a) & 1:
+                combined |= reach << a
+            a += 1
+        reach = combined & ((1 << (need + 1)) - 1)
+    upper = reach.bit_length() - 1 if need > 0 else 0
+
+    best = {"qty": greedy_qty, "moves": len(greedy), "plan": None}
+    alloc = {}  # (item idx, dest idx) -> PLT 수
+    state = {"nodes": 0, "timeout": False}
+
+    def _min_moves(qty, current_cap, i):
+        # qty를 채우는 데 필요한 최소 건수: 품목 물량 기준과 목적지 잔여 기준 중 큰 값
+        tops = suffix_top[i + 1]
+        k = bisect.bisect_left(tops, qty)
+        if current_cap > 0:
+            k = min(k, 1 + bisect.bisect_left(tops, qty - current_cap))
+        acc, kd = 0, 0
+        for r in sorted((usable(d) for d in range(len(rem))), reverse=True):
+            if acc >= qty or r <= 0:
+                break
+            acc, kd = acc + r, kd + 1
+        if acc < qty:
+            kd = len(tops) + 1
+        return max(k, kd)
+
+    def node(i, j, left, moved, nmoves):
+        # 탐색 노드 하나: 자식 노드 인자를 yield하면 드라이버가 그 자식을 끝까지 탐색한 뒤 이어서 실행한다.
+        # 깊이가 (품목 x 목적지) 칸 수만큼 커지므로 재귀 대신 명시적 스택(_run_nodes)으로 돈다.
+        state["nodes"] += 1
+        if node_budget is not None:
+            if state["nodes"] > node_budget:
+                state["timeout"] = True
+        elif state["nodes"] % 2048 == 0 and time.monotonic() - t0 > time_limit:
+            state["timeout"] = True
+        if state["timeout"]:
+            return
+        if moved > best["qty"] or (moved == best["qty"] and nmoves < best["moves"]):
+            best.update(qty=moved, moves=nmoves, plan=dict(alloc))
+        if moved >= upper or i >= n:
+            return
+
+        name, plt, units, dests, gid = items[i]
+        if j >= len(dests) or left == 0:
+            yield i + 1, 0, items[i + 1][2] if i + 1 < n else 0, moved, nmoves
+            return
+
+        # 상한: 묶음별 min(남은 품목 물량, 목적지 잔여)의 합과 남은 필요량 중 최소를 PLT 최대공약수로 내림
+        cap = 0
+        for g in (0, 1):
+            item_cap = suffix_cap[i + 1][g] + (left * plt if g == gid else 0)
+            if item_cap:
+                cap += min(item_cap, sum(usable(d) for d in group_dests[g]))
+        cap = min(upper - moved, cap)
+        g = math.gcd(plt, suffix_gcd[i + 1])
+        bound = moved + (cap // g) * g
+        if bound < best["qty"]:
+            return
+        if bound == best["qty"]:
+            # 같은 이동량이면 이동 건수가 줄어들 가능성이 있을 때만 계속
+            if nmoves + _min_moves(best["qty"] - moved, left * plt, i) >= best["moves"]:
+                return
+
+        d = dests[j]
+        top = min(left, rem[d] // plt, (need - moved) // plt)
+        for k in range(top, 0, -1):
+            rem[d] -= k * plt
+            alloc[(i, d)] = k
+            yield i, j + 1, left - k, moved + k * plt, nmoves + 1
+            del alloc[(i, d)]
+            rem[d] += k * plt
+            if state["timeout"]:
+                return
+        yield i, j + 1, left, moved, nmoves
+
+    if n and need > 0 and not (best["qty"] == upper and best["moves"] <= 1):
+        stack = [node(0, 0, items[0][2], 0, 0)]
+        while stack:
+            try:
+                child = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                continue
+            stack.append(node(*child))
+
+    info = {
+        "optimal": not state["timeout"], "nodes": state["nodes"],
+        "ms": round((time.monotonic() - t0) * 1000.0, 1), "greedy_qty": greedy_qty, "qty": best["qty"],
+    }
+    if best["plan"] is None:
+        return greedy, info
+
+    moves = []
+    for (i, d), k in sorted(best["plan"].items()):
+        moves.append({
+            "item": items[i][0],
+            "qty": int(k * items[i][1]),
+            "from": from_loc,
+            "to": dest_keys[d],
+            "reason": "폴백(최적화): 제약/PLT/CAPA 기반 감축"
+        })
+    return moves, info
+
+def _rule_based_reduce(constraint_info, capa_status, from_loc, target_line, need_reduce_qty, plan_df=None):
+    """run_hybrid의 룰 기반 후보: HYBRID_OPTIMAL_PLANNER면 최적화, 아니면 기존 greedy"""
+    if not HYBRID_OPTIMAL_PLANNER:
+        return _fallback_reduce(constraint_info, {k: dict(v) for k, v in capa_status.items()},
+                                from_loc, target_line, need_reduce_qty)
+    moves, info = _optimal_reduce(constraint_info, capa_status, from_loc, target_line, need_reduce_qty, plan_df)
+    _record_metric("hybrid_plan", "optimizer", info)
+    return moves
+
 def _badge_by_remaining(remaining: int, max_capa: int) -> str:
     if max_capa <= 0:
         return "⚠️"
@@ -1091,7 +4013,8 @@ def _render_hybrid_investigation_report(
     lines.append("기본 정보")
     lines.append(f"대상: {target_date} / {target_line}")
     lines.append(f"현재 생산량: {current_total:,}개")
-    util_pct = (target_qty / CAPA_LIMITS[target_line] * 100.0) if CAPA_LIMITS.get(target_line) else 0.0
+    capa = capa_for(target_line, target_date)
+    util_pct = (target_qty / capa * 100.0) if capa else 0.0
     lines.append(f"목표 생산량: {target_qty:,}개 ({util_pct:.0f}% CAPA)")
     if sample_qty:
         lines.append(f"샘플 추가: {int(sample_qty):,}개")
@@ -1240,23 +4163,93 @@ def _render_hybrid_simple_report(target_date, target_line, stock_total, target_q
 
     return "\n".join(out)
 
-def run_hybrid(prompt: str) -> str:
+_PLANNER_POOL_SIZE = 4
+_PLANNER_POOL = ThreadPoolExecutor(max_workers=_PLANNER_POOL_SIZE, thread_name_prefix="ai-plan")
+# 진행 중인 AI 호출 수 제한: 작업자가 모두 차 있으면 줄 서지 않고 폴백 계획만 쓴다
+_PLANNER_SLOTS = threading.BoundedSemaphore(_PLANNER_POOL_SIZE)
+
+def _plan_score(valid_moves, violations, need_qty: int) -> tuple:
+    """검증 결과 비교용 점수(클수록 좋음): 필요량 충족 > 위반 적음 > 필요량에 근접 > 이동 건수 적음"""
+    moved = sum(int(m.get("qty", 0)) for m in valid_moves)
+    hard = sum(1 for v in violations if v.startswith("❌"))
+    return (min(moved, need_qty), -hard, -abs(moved - need_qty), -len(valid_moves))
+
+def _choose_reduce_plan(prompt, target_date, target_line, need_qty, constraint_info, capa_status, plan_df, from_loc):
+    """
+    AI 계획과 룰 기반 폴백 계획을 동시에 만들고 둘 다 step6로 검증해 점수가 높은 쪽을 고른다.
+    AI는 HYBRID_AI_DEADLINE_SEC 안에 도착한 경우에만 후보가 된다(동점이면 AI 우선).
+    반환: (valid_moves, violations, ai_used, ai_fail_reason)
+    """
+    def validate(moves):
+        return step6_validate_moves_with_adjust(
+            moves=moves,
+            constraint_info=constraint_info,
+            capa_status={k: dict(v) for k, v in capa_status.items()},
+            plan_df=plan_df,
+            target_line=target_line
+        )
+
+    ai_future = None
+    ai_busy = False
+    t0 = time.monotonic()
+    if gemini_transport is not None and constraint_info:
+        if _PLANNER_SLOTS.acquire(blocking=False):
+            ai_future = _PLANNER_POOL.submit(
+                contextvars.copy_context().run, _ai_build_moves,
+                prompt, target_date, target_line, need_qty, constraint_info, capa_status, from_loc,
+                deadline=HYBRID_AI_DEADLINE_SEC,
+            )
+            ai_future.add_done_callback(lambda _f: _PLANNER_SLOTS.release())
+        else:
+            ai_busy = True
+
+    fb_valid, fb_violations = validate(
+        _rule_based_reduce(constraint_info, capa_status, from_loc, target_line, need_qty, plan_df))
+    if ai_busy:
+        _record_metric("hybrid_plan", "ai", "busy")
+        return fb_valid, fb_violations, False, "AI 작업자 포화(이전 요청 처리 중)"
+    if ai_future is None:
+        return fb_valid, fb_violations, False, None
+
+    try:
+        ai_moves = ai_future.result(timeout=max(0.0, HYBRID_AI_DEADLINE_SEC - (time.monotonic() - t0)))
+    except FutureTimeoutError:
+        _record_metric("hybrid_plan", "ai", "timeout")
+        return fb_valid, fb_violations, False, f"AI 응답 지연({HYBRID_AI_DEADLINE_SEC:g}초 초과)"
+    if not ai_moves:
+        _record_metric("hybrid_plan", "ai", "empty")
+        return fb_valid, fb_violations, False, "AI 결과 없음/파싱 실패"
+
+    ai_valid, ai_violations = validate(ai_moves)
+    ai_score = _plan_score(ai_valid, ai_violations, need_qty)
+    fb_score = _plan_score(fb_valid, fb_violations, need_qty)
+    _record_metric("hybrid_plan", "scores", {"ai": ai_score, "fallback": fb_score})
+    if ai_score >= fb_score:
+        return ai_valid, ai_violations, True, None
+    return fb_valid, fb_violations, False, "검증 결과 룰 기반 계획이 더 우수"
+
+def run_hybrid(prompt: str, plan: QueryPlan | None = None) -> str:
     if supabase is None:
         return "SUPABASE_URL/SUPABASE_KEY가 설정되지 않아 하이브리드 DB 조회를 할 수 없습니다. Streamlit Secrets를 확인하세요."
 
-    target_date = _extract_date_any(prompt, default_year="2026")
+    plan = plan or parse_query(prompt)
+    target_date = plan.hybrid_date
     if not target_date:
         return "조정 요청으로 보이지만 날짜를 인식할 수 없습니다. 예: `1/21 T6 샘플 100개 추가` 또는 `2026-01-21 ...`"
 
     today = _get_hybrid_today()
     capa_limits = CAPA_LIMITS_DEFAULT if isinstance(CAPA_LIMITS_DEFAULT, dict) else {"조립1": 3300, "조립2": 3700, "조립3": 3600}
-    initialize_globals(today, capa_limits)
+    initialize_globals(today, capa_limits, load_hybrid_daily_capa())
 
-    plan_df, _hist_df = fetch_data_hybrid(target_date)
+    try:
+        plan_df = fetch_data_hybrid(target_date)
+    except PlanSchemaError as e:
+        return f"생산계획 데이터 형식이 올바르지 않습니다: {e}"
     if plan_df.empty:
         return f"{target_date} 기준 생산계획 데이터를 불러오지 못했습니다(테이블/날짜 확인 필요: {HYBRID_PLAN_TABLE})."
 
-    target_line = _pick_target_line(prompt, plan_df, target_date)
+    plan_df = PlanFrame(plan_df)
+    target_line = plan.line or _pick_target_line(prompt, plan_df, target_date)
     if not target_line:
         return "대상 라인을 찾을 수 없습니다. `조립1/2/3` 또는 품목 힌트(T6/A2XX)를 포함해서 입력하세요."
 
@@ -1266,19 +4259,26 @@ def run_hybrid(prompt: str) -> str:
 
     items_slack = step2_calculate_cumulative_slack(plan_df, stock)
     constraint_info = step4_prepare_constraint_info(items_slack, target_line)
-    capa_status = step3_analyze_destination_capacity(plan_df, target_date, target_line)
+    ledger = CapacityLedger.from_plan(plan_df)
+    capa_status = step3_analyze_destination_capacity(plan_df, target_date, target_line, ledger)
+
+    if plan.sweep_percents:
+        rows = hybrid_sweep(plan_df, ledger, stock, constraint_info, capa_status, plan.sweep_percents,
+                            extra_qty=int(plan.sample_qty or 0))
+        _record_metric("hybrid_sweep", "rows", rows)
+        return _render_sweep_report(target_date, target_line, int(stock["total"]), plan.sample_qty, rows)
 
     # --- intent parsing ---
-    pct = _parse_target_percent(prompt)
+    pct = plan.target_percent
     if pct is None:
         pct = HYBRID_DEFAULT_TARGET_UTIL
 
     # 목표 생산량: 예전 리포트 느낌(예: 81% CAPA, 100단위 반올림)
-    raw_target = int(CAPA_LIMITS[target_line] * float(pct))
+    raw_target = int(ledger.capacity(target_line, target_date) * float(pct))
     target_qty = _round_target(raw_target, HYBRID_TARGET_ROUNDING)
 
-    sample_qty = _parse_sample_qty(prompt)  # "샘플 100"
-    add_qty = _parse_add_qty(prompt)        # "추가 100" (샘플 없이도)
+    sample_qty = plan.sample_qty  # "샘플 100"
+    add_qty = plan.add_qty        # "추가 100" (샘플 없이도)
 
     # 시나리오:
     # - "샘플 N 추가" => 샘플이 들어오면 당일 계획을 감축/이송해서 목표 가동률(=target_qty) 이내로 맞추는 수사
@@ -1339,41 +4339,10 @@ def run_hybrid(prompt: str) -> str:
     # locations (reduce)
     from_loc = f"{target_date}_{target_line}"
 
-    # 1) AI plan (optional)
-    ai_used = False
-    ai_fail_reason = None
-    moves = []
-
-    if genai and GEMINI_API_KEY and constraint_info:
-        ai_moves = _ai_build_moves(
-            prompt=prompt,
-            target_date=target_date,
-            target_line=target_line,
-            need_qty=int(abs(need_reduce_qty)),
-            constraint_info=constraint_info,
-            capa_status=capa_status,
-            from_loc=from_loc,
-        )
-        if ai_moves:
-            moves = ai_moves
-            ai_used = True
-        else:
-            ai_fail_reason = "AI 결과 없음/파싱 실패"
-
-    # 2) fallback
-    if not moves:
-        capa_copy = {k: dict(v) for k, v in capa_status.items()}
-        moves = _fallback_reduce(constraint_info, capa_copy, from_loc, target_line, abs(need_reduce_qty))
-        ai_used = False
-
-    # 3) validate (with adjust)
-    capa_for_validate = {k: dict(v) for k, v in capa_status.items()}
-    valid_moves, violations = step6_validate_moves_with_adjust(
-        moves=moves,
-        constraint_info=constraint_info,
-        capa_status=capa_for_validate,
-        plan_df=plan_df,
-        target_line=target_line
+    # AI plan || fallback plan -> validate both (with adjust) -> pick the better one
+    valid_moves, violations, ai_used, ai_fail_reason = _choose_reduce_plan(
+        prompt, target_date, target_line, int(abs(need_reduce_qty)),
+        constraint_info, capa_status, plan_df, from_loc,
     )
 
     if HYBRID_REPORT_STYLE == "investigation":
@@ -1406,17 +4375,404 @@ def run_hybrid(prompt: str) -> str:
         ai_failed_reason=ai_fail_reason
     )
 
+async def run_hybrid_async(prompt: str, plan: QueryPlan | None = None) -> str:
+    return await asyncio.to_thread(run_hybrid, prompt, plan)
+
+
+# =============================================================================
+# Horizon batch planner (기간 평준화)
+# =============================================================================
+HORIZON_LINES = ("조립1", "조립2", "조립3")
+
+def _horizon_windows(pf: PlanFrame, cells: list) -> list:
+    """
+    목표 초과 셀(date, line)을 목적지 범위(당일 ~ 이후 HYBRID_DEST_HORIZON_DAYS 근무일)가 겹치는 것끼리 묶는다.
+    서로 다른 묶음은 CAPA를 공유하지 않으므로 독립적으로 계획할 수 있다.
+    """
+    spans = []
+    for d, line in cells:
+        future = get_workdays_from_db(pf, d, direction='future', days_count=max(10, HYBRID_DEST_HORIZON_DAYS))
+        spans.append((d, max([d] + future), (d, line)))
+    spans.sort()
+    windows, cur_end = [], None
+    for start, end, cell in spans:
+        if windows and start <= cur_end:
+            windows[-1].append(cell)
+            cur_end = max(cur_end, end)
+        else:
+            windows.append([cell])
+            cur_end = end
+    return windows
+
+def _horizon_target_fn(target_util: float, capa_limits: dict, daily_capa: dict):
+    """(라인, 날짜) -> 목표 생산량(CAPA × 목표 가동률, HYBRID_TARGET_ROUNDING 반올림). 전역 대신 넘겨받은 CAPA 스냅샷 사용"""
+    def target_for(line: str, date_str: str) -> int:
+        return _round_target(int(capa_lookup(capa_limits, daily_capa, line, date_str) * target_util),
+                             HYBRID_TARGET_ROUNDING)
+    return target_for
+
+def _plan_horizon_window(plan_df: pd.DataFrame, cells: list, target_util: float, capa_limits: dict,
+                         daily_capa: dict, node_budget: int) -> list:
+    """
+    한 묶음의 셀을 날짜순으로 계획한다(_BATCH_PLAN_POOL 작업 단위, plan_df는 읽기만 하므로 묶음끼리 공유).
+    묶음 전체가 '목표 장부'(CAPA 대신 목표 생산량을 한도로 둔 CapacityLedger) 하나를 공유한다:
+    목적지 잔여가 목표까지만이라 받은 날도 목표를 넘지 않고, 통과한 이동은 목적지에 reserve,
+    출발지에서 release되어 이후 셀의 현재량/목적지 잔여에 그대로 반영된다.
+    묶음 구간에 목표를 넘는 (날짜, 라인)이 새로 보이면(선정 시점 이후 변한 셀) 없어질 때까지 다시 돈다.
+    전역(TODAY/CAPA_LIMITS/DAILY_CAPA)은 건드리지 않고, 탐색은 node_budget으로 끊어 작업자 수/부하와 무관하게 같다.
+    """
+    pf = PlanFrame.of(plan_df)
+    ledger = CapacityLedger.from_plan(pf, capa_fn=_horizon_target_fn(target_util, capa_limits, daily_capa))
+    first, last = min(d for d, _ in cells), max(d for d, _ in cells)
+    results, seen = [], set()
+    pending = sorted(cells)
+    while pending:
+        for d, line in pending:
+            seen.add((d, line))
+            stock, err = step1_list_current_stock(pf, d, line)
+            if err:
+                continue
+            total, target = ledger.load(line, d), ledger.capacity(line, d)
+            need = total - target
+            result = {"date": d, "line": line, "total": total, "target": target,
+                      "need": max(0, need), "moved": 0, "moves": [], "violations": []}
+            results.append(result)
+            if need <= 0:
+                continue
+
+            constraint_info = step4_prepare_constraint_info(step2_calculate_cumulative_slack(pf, stock), line)
+            capa_status = step3_analyze_destination_capacity(pf, d, line, ledger)
+
+            from_loc = f"{d}_{line}"
+            moves, _ = _optimal_reduce(constraint_info, capa_status, from_loc, line, need, pf,
+                                       node_budget=node_budget)
+            valid, violations = step6_validate_moves_with_adjust(
+                moves=moves,
+                constraint_info=constraint_info,
+                capa_status=capa_status,
+                plan_df=pf,
+                target_line=line,
+                ledger=ledger,
+            )
+            for mv in valid:
+                ledger.release(line, d, int(mv["qty"]))
+            result["moves"] = valid
+            result["violations"] = violations
+            result["moved"] = sum(int(m["qty"]) for m in valid)
+        pending = [(d, ln) for d in pf.calendar.between(first, last) for ln in HORIZON_LINES
+                   if (d, ln) not in seen and ledger.remaining(ln, d) < 0]
+    results.sort(key=lambda r: (r["date"], r["line"]))
+    return results
+
+# 배치 평준화/스윕 공용 스레드 풀(프로세스 수명 동안 하나).
+# 탐색은 순수 파이썬이라 GIL 때문에 스레드 수만큼 빨라지지는 않는다: 요청 스레드와 분리된 작업 큐 역할이고,
+# 결과는 노드 한도(HYBRID_OPT_NODE_BUDGET)로 끊으므로 작업자 수와 무관하게 같다.
+# 멀티스레드인 Streamlit 서버에서 요청마다 fork 프로세스 풀을 만들면 다른 스레드가 잡고 있던 락이
+# 자식에 복사돼 교착될 수 있고, spawn은 자식에서 engine을 다시 import하며 Supabase/스냅샷 초기화를 반복한다.
+_BATCH_PLAN_POOL = ThreadPoolExecutor(max_workers=max(1, HYBRID_HORIZON_WORKERS), thread_name_prefix="batch-plan")
+
+def run_horizon(start_date: str, end_date: str, target_util: float, workers: int | None = None) -> dict:
+    """
+    기간(start~end, 양 끝 포함)의 조립1/2/3을 목표 가동률(target_util, 0~1)로 평준화하는 배치 계획.
+    계획은 한 번만 읽고, 목적지 범위가 겹치는 셀끼리 목표 장부를 공유하며, 독립 묶음은 _BATCH_PLAN_POOL에서 나눠 계획한다.
+    목적지는 목표까지만 받으므로 이동 후 어느 날도 목표 가동률을 넘지 않는다(목표 미달 셀은 리포트에 표시).
+    반환: {"report": 통합 리포트(str), "moves": [이동(dict)], "cells": [셀별 요약(dict)]}
+    """
+    if supabase is None:
+        return {"report": "SUPABASE_URL/SUPABASE_KEY가 설정되지 않아 하이브리드 DB 조회를 할 수 없습니다.", "moves": [], "cells": []}
+
+    capa_limits = CAPA_LIMITS_DEFAULT if isinstance(CAPA_LIMITS_DEFAULT, dict) else {"조립1": 3300, "조립2": 3700, "조립3": 3600}
+    daily_capa = load_hybrid_daily_capa()
+    target_for = _horizon_target_fn(float(target_util), capa_limits, daily_capa)
+
+    s = datetime.strptime(start_date, "%Y-%m-%d")
+    e = datetime.strptime(end_date, "%Y-%m-%d")
+    plan_df = typed_plan_frame(check_frame_projection(plan_window_cache.get(
+        (s - timedelta(days=HYBRID_PLAN_WINDOW_DAYS)).strftime("%Y-%m-%d"),
+        (e + timedelta(days=HYBRID_PLAN_WINDOW_DAYS)).strftime("%Y-%m-%d"),
+    ), "hybrid.plan"))
+    if plan_df.empty:
+        return {"report": f"{start_date}~{end_date} 생산계획 데이터를 불러오지 못했습니다({HYBRID_PLAN_TABLE}).", "moves": [], "cells": []}
+
+    pf = PlanFrame(plan_df)
+    days = pf.calendar.between(start_date, end_date)
+    cells = [(d, ln) for d in days for ln in HORIZON_LINES if pf.total(d, ln) > target_for(ln, d)]
+
+    windows = _horizon_windows(pf, cells)
+    t0 = time.monotonic()
+    results = []
+    args = (float(target_util), capa_limits, daily_capa, HYBRID_OPT_NODE_BUDGET)
+    if len(windows) <= 1 or (workers or HYBRID_HORIZON_WORKERS) <= 1:
+        for w in windows:
+            results.extend(_plan_horizon_window(pf, w, *args))
+    else:
+        futs = [_BATCH_PLAN_POOL.submit(contextvars.copy_context().run, _plan_horizon_window, pf, w, *args)
+                for w in windows]
+        for fut in futs:
+            results.extend(fut.result())
+    _record_metric("horizon", "plan_ms", round((time.monotonic() - t0) * 1000.0, 1))
+    results.sort(key=lambda r: (r["date"], r["line"]))
+
+    moves = [{
+        "date": r["date"], "line": r["line"], "item": mv.get("item"), "qty": int(mv.get("qty", 0)),
+        "from": mv.get("from"), "to": mv.get("to"), "adjusted": bool(mv.get("adjusted")),
+    } for r in results for mv in r["moves"]]
+    cells_out = [{
+        "date": r["date"], "line": r["line"], "total": r["total"], "target": r["target"], "need": r["need"],
+        "moved": r["moved"], "after": r["total"] - r["moved"],
+    } for r in results]
+    report = _render_horizon_report(start_date, end_date, float(target_util), days, windows, results, capa_limits)
+    return {"report": report, "moves": moves, "cells": cells_out}
+
+def _render_horizon_report(start_date, end_date, target_util, days, windows, results, capa_limits) -> str:
+    need = sum(r["need"] for r in results)
+    moved = sum(r["moved"] for r in results)
+    lines = [f"📊 {start_date} ~ {end_date} 기간 평준화 계획 (목표 가동률 {target_util * 100:.0f}%)", ""]
+    lines.append("목표 생산량: 일별 라인 CAPA × 목표 가동률 (" + ", ".join(
+        f"{ln} {_round_target(int(capa_limits[ln] * target_util), HYBRID_TARGET_ROUNDING):,}" for ln in HORIZON_LINES)
+        + " 기준, daily_capa가 있는 날은 그 값)")
+    lines.append(f"대상 근무일: {len(days)}일 / 목표 초과 셀: {len(results)}개 / 독립 묶음: {len(windows)}개")
+    lines.append(f"필요 감축 합계: {need:,}개 / 실제 감축 합계: {moved:,}개"
+                 + (f" (달성률 {moved / need * 100.0:.1f}%)" if need else ""))
+    lines.append("")
+    if not results:
+        lines.append("기간 내 목표를 초과한 날이 없습니다.")
+        return "\n".join(lines)
+
+    lines.append("| 날짜 | 라인 | 현재 | 목표 | 필요 감축 | 실제 감축 | 이동 후 |")
+    lines.append("|---|---|---|---|---|---|---|")
+    for r in results:
+        lines.append(f"| {r['date']} | {r['line']} | {r['total']:,} | {r['target']:,} | {r['need']:,} | "
+                     f"{r['moved']:,} | {r['total'] - r['moved']:,} |")
+
+    lines.append("")
+    lines.append("[이동 계획]")
+    for r in results:
+        for mv in r["moves"]:
+            lines.append(f"- {mv.get('item', '')} | {int(mv.get('qty', 0)):,} | {mv.get('from', '')} → {mv.get('to', '')}")
+    short = [r for r in results if r["moved"] < r["need"]]
+    if short:
+        lines.append("")
+        lines.append("[목표 미달 셀]")
+        for r in short:
+            lines.append(f"- {r['date']} {r['line']}: {r['need'] - r['moved']:,}개 부족")
+    return "\n".join(lines)
+
+
+# =============================================================================
+# What-if sweep (목표 가동률 스윕)
+# =============================================================================
+def _plan_sweep_target(plan_df, need: int, target_line: str, from_loc: str, constraint_info: list, capa_status: dict,
+                       node_budget: int) -> dict:
+    """
+    목표 하나의 룰 기반 계획 + step6 검증(_BATCH_PLAN_POOL 작업 단위).
+    CAPA는 요청 스레드가 만든 capa_status에만 있어 전역을 읽거나 바꾸지 않고, 탐색은 node_budget으로 끊는다.
+    """
+    pf = PlanFrame.of(plan_df)
+    moves, info = _optimal_reduce(constraint_info, capa_status, from_loc, target_line, need, pf,
+                                  node_budget=node_budget)
+    valid, violations = step6_validate_moves_with_adjust(
+        moves=moves,
+        constraint_info=constraint_info,
+        capa_status={k: dict(v) for k, v in capa_status.items()},
+        plan_df=pf,
+        target_line=target_line
+    )
+    return {"moves": valid, "moved": sum(int(m["qty"]) for m in valid),
+            "hard": sum(1 for v in violations if v.startswith("❌")), "optimal": bool(info["optimal"])}
+
+def hybrid_sweep(plan_df: PlanFrame, ledger: CapacityLedger, stock: dict, constraint_info: list, capa_status: dict,
+                 percents, extra_qty: int = 0, workers: int | None = None) -> list:
+    """
+    한 번 계산한 step1~4 결과로 목표 가동률 여러 개를 계획한다(AI 없이 룰 기반).
+    반올림 후 필요 감축량이 같은 목표는 한 번만 계획하고, 서로 다른 감축량은 _BATCH_PLAN_POOL에 나눠 푼다
+    (노드 한도로 끊으므로 작업자 수와 무관하게 같은 결과).
+    extra_qty: 샘플 추가분(현재량에 더해 필요 감축량 계산)
+    반환: 목표별 요약 행 목록(pct 오름차순)
+    """
+    target_date, target_line = stock["date"], stock["line"]
+    current = int(stock["total"]) + int(extra_qty)
+    capa = ledger.capacity(target_line, target_date)
+    from_loc = f"{target_date}_{target_line}"
+    targets = [(float(p), _round_target(int(capa * float(p)), HYBRID_TARGET_ROUNDING)) for p in sorted(percents)]
+    needs = sorted({max(0, current - t) for _, t in targets} - {0})
+
+    t0 = time.monotonic()
+    args = (target_line, from_loc, constraint_info, capa_status, HYBRID_OPT_NODE_BUDGET)
+    workers = workers or HYBRID_HORIZON_WORKERS
+    if len(needs) <= 1 or workers <= 1:
+        plans = {n: _plan_sweep_target(plan_df, n, *args) for n in needs}
+    else:
+        futs = {n: _BATCH_PLAN_POOL.submit(contextvars.copy_context().run, _plan_sweep_target, plan_df, n, *args)
+                for n in needs}
+        plans = {n: fut.result() for n, fut in futs.items()}
+    _record_metric("hybrid_sweep", "plan_ms", round((time.monotonic() - t0) * 1000.0, 1))
+
+    rows = []
+    for pct, target in targets:
+        need = max(0, current - target)
+        p = plans.get(need, {"moves": [], "moved": 0, "hard": 0, "optimal": True})
+        after = current - p["moved"]
+        rows.append({
+            "pct": round(pct * 100.0, 1), "target": target, "need": need, "moved": p["moved"],
+            "after": after, "after_util": round(after / capa * 100.0, 1) if capa else 0.0,
+            "achieved": round(p["moved"] / need * 100.0, 1) if need else 100.0,
+            "moves": len(p["moves"]), "hard": p["hard"], "optimal": p["optimal"],
+        })
+    return rows
+
+def sweep_figure(rows: list):
+    """스윕 결과 곡선(Plotly): 목표 가동률별 필요 감축량 vs 가능 감축량"""
+    import plotly.graph_objects as go
+
+    x = [r["pct"] for r in rows]
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=x, y=[r["need"] for r in rows], name="필요 감축", mode="lines+markers",
+                             line=dict(dash="dash")))
+    fig.add_trace(go.Scatter(x=x, y=[r["moved"] for r in rows], name="가능 감축", mode="lines+markers",
+                             customdata=[[r["achieved"], r["after_util"]] for r in rows],
+                             hovertemplate="목표 %{x}%<br>가능 감축 %{y:,}개<br>달성률 %{customdata[0]}%"
+                                           "<br>이동 후 가동률 %{customdata[1]}%<extra></extra>"))
+    fig.update_layout(xaxis_title="목표 가동률(%)", yaxis_title="감축량(개)", hovermode="x unified",
+                      legend=dict(orientation="h", y=1.1), margin=dict(l=10, r=10, t=30, b=10))
+    return fig
+
+def _render_sweep_report(target_date: str, target_line: str, current: int, sample_qty, rows: list) -> str:
+    lines = [f"📊 {target_date} {target_line} 목표 가동률 스윕", ""]
+    lines.append(f"현재 생산량: {current:,}개" + (f" (+ 샘플 {int(sample_qty):,}개)" if sample_qty else ""))
+    lines.append("")
+    lines.append("| 목표 가동률 | 목표 생산량 | 필요 감축 | 가능 감축 | 달성률 | 이동 후 | 이동 후 가동률 | 이동 수 |")
+    lines.append("|---|---|---|---|---|---|---|---|")
+    for r in rows:
+        lines.append(f"| {r['pct']:g}% | {r['target']:,} | {r['need']:,} | {r['moved']:,} | {r['achieved']:g}% | "
+                     f"{r['after']:,} | {r['after_util']:g}% | {r['moves']} |")
+    full = [r for r in rows if r["moved"] >= r["need"]]
+    lines.append("")
+    if full:
+        lines.append(f"필요 감축을 모두 채우는 가장 낮은 목표 가동률: {full[0]['pct']:g}%")
+    else:
+        lines.append("스윕 범위 안에서는 필요 감축을 모두 채우는 목표가 없습니다.")
+    if any(not r["optimal"] for r in rows):
+        lines.append("(일부 목표는 탐색 시간 한도로 최적성이 확인되지 않았습니다)")
+    return "\n".join(lines)
+
 
 # =============================================================================
 # Entry
 # =============================================================================
 
+async def route_and_answer_async(prompt: str) -> tuple[str, dict]:
+    """
+    비동기 진입점: DB 조회는 작업 스레드에서, Gemini 호출은 httpx 비동기 클라이언트로 수행해
+    한 프로세스(이벤트 루프)가 여러 대화를 동시에 처리할 수 있다.
+    """
+    metrics = {}
+    token = _REQUEST_METRICS.set(metrics)
+    try:
+        plan = parse_query(prompt)
+        if plan.route == "hybrid":
+            ans = await run_hybrid_async(prompt, plan)
+        else:
+            ans = await run_legacy_async(prompt, plan)
+    finally:
+        _REQUEST_METRICS.reset(token)
+    return ans, _answer_debug(plan, metrics)
+
+def _answer_debug(plan: QueryPlan, metrics: dict) -> dict:
+    debug = {"route": plan.route, "reason": plan.route_reason, "plan": plan.debug_info(), **metrics}
+    _add_debug_stats(debug)
+    return debug
+
+_ENGINE_LOOP: asyncio.AbstractEventLoop | None = None
+_ENGINE_LOOP_LOCK = threading.Lock()
+
+def _run_engine_loop(loop: asyncio.AbstractEventLoop):
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_forever()
+    finally:
+        loop.close()
+
+def _engine_loop() -> asyncio.AbstractEventLoop:
+    """동기 래퍼용 상주 이벤트 루프(커넥션 풀을 호출 간에 재사용하기 위해 매번 새로 만들지 않음)"""
+    global _ENGINE_LOOP
+    with _ENGINE_LOOP_LOCK:
+        if _ENGINE_LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=_run_engine_loop, args=(loop,), name="engine-async", daemon=True).start()
+            _ENGINE_LOOP = loop
+        return _ENGINE_LOOP
+
+def shutdown_engine_loop(timeout: float = 5.0):
+    """상주 루프의 httpx.AsyncClient를 닫고 루프를 멈춘다(atexit 등록, 이후 호출 시 새 루프가 만들어짐)"""
+    global _ENGINE_LOOP
+    with _ENGINE_LOOP_LOCK:
+        loop, _ENGINE_LOOP = _ENGINE_LOOP, None
+    if loop is None or loop.is_closed():
+        return
+    aio = getattr(gemini_transport, "_aio", None)
+    if aio is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(aio.aclose(), loop).result(timeout)
+        except Exception:
+            pass
+    loop.call_soon_threadsafe(loop.stop)
+
+atexit.register(shutdown_engine_loop)
+
+def run_sync(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _engine_loop()).result()
+
 def route_and_answer(prompt: str) -> tuple[str, dict]:
-    route, meta = classify_route(prompt)
-    if route == "hybrid":
-        ans = run_hybrid(prompt)
-    else:
-        ans = run_legacy(prompt)
+    """동기 진입점: 호출한 스레드(Streamlit 스크립트 스레드)에서 그대로 실행한다."""
+    metrics = {}
+    token = _REQUEST_METRICS.set(metrics)
+    try:
+        plan = parse_query(prompt)
+        if plan.route == "hybrid":
+            ans = run_hybrid(prompt, plan)
+        else:
+            ans = run_legacy(prompt, plan)
+    finally:
+        _REQUEST_METRICS.reset(token)
+    return ans, _answer_debug(plan, metrics)
+
+def _add_debug_stats(debug: dict):
+    if query_cache is not None:
+        debug["query_cache"] = query_cache.stats()
+    if gemini_transport is not None:
+        debug["gemini"] = gemini_transport.stats()
+    if llm_cache is not None:
+        debug["llm_cache"] = llm_cache.stats()
+    if debug.get("route") == "hybrid" and plan_window_cache is not None:
+        debug["plan_cache"] = plan_window_cache.stats()
+
+def route_and_answer_stream(prompt: str):
+    """
+    route_and_answer의 스트리밍 버전: (텍스트 조각 generator, debug dict) 반환.
+    debug의 측정값(지연시간/캐시)은 generator를 끝까지 소비한 뒤 채워진다.
+    """
+    metrics = {}
+    ctx = contextvars.copy_context()
+    ctx.run(_REQUEST_METRICS.set, metrics)
+    plan = ctx.run(parse_query, prompt)
+    debug = {"route": plan.route, "reason": plan.route_reason, "plan": plan.debug_info()}
+
+    def _chunks():
+        if plan.route == "hybrid":
+            yield run_hybrid(prompt, plan)
+        else:
+            yield from run_legacy_stream(prompt, plan)
+
+    def _stream():
+        it = _chunks()
+        while True:
+            try:
+                chunk = ctx.run(next, it)
+            except StopIteration:
+                break
+            yield chunk
+        debug.update(metrics)
+        _add_debug_stats(debug)
 
-    debug = {"route": route, **meta}
-    return ans, debug
+    return _stream(), debug
@@ -0,0 +1,119 @@
+import copy
+import fnmatch
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+        self.count = None
+
+
+class FakeQuery:
+    """supabase-py 쿼리 빌더의 로컬 대역 (테스트에서 쓰는 메서드만)"""
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table_name = table
+        self.cols = None
+        self.filters = []
+        self.orders = []
+        self.window = None
+        self.lim = None
+
+    def select(self, columns="*", **_kwargs):
+        cols = [c.strip() for c in columns.split(",") if c.strip()]
+        self.cols = None if cols in ([], ["*"]) else cols
+        return self
+
+    def _f(self, fn):
+        self.filters.append(fn)
+        return self
+
+    def eq(self, col, val):
+        return self._f(lambda r: r.get(col) == val)
+
+    def neq(self, col, val):
+        return self._f(lambda r: r.get(col) != val)
+
+    def gt(self, col, val):
+        return self._f(lambda r: r.get(col) is not None and r.get(col) > val)
+
+    def gte(self, col, val):
+        return self._f(lambda r: r.get(col) is not None and r.get(col) >= val)
+
+    def lt(self, col, val):
+        return self._f(lambda r: r.get(col) is not None and r.get(col) < val)
+
+    def lte(self, col, val):
+        return self._f(lambda r: r.get(col) is not None and r.get(col) <= val)
+
+    def like(self, col, pattern):
+        pat = pattern.replace("%", "*")
+        return self._f(lambda r: fnmatch.fnmatchcase(str(r.get(col)), pat))
+
+    def ilike(self, col, pattern):
+        pat = pattern.replace("%", "*").lower()
+        return self._f(lambda r: fnmatch.fnmatch(str(r.get(col)).lower(), pat))
+
+    def in_(self, col, values):
+        values = list(values)
+        return self._f(lambda r: r.get(col) in values)
+
+    def or_(self, filters, **_kwargs):
+        conds = [c.split(".", 2) for c in filters.split(",")]
+
+        def match(r):
+            for col, op, val in conds:
+                v = r.get(col)
+                if op == "ilike" and fnmatch.fnmatch(str(v).lower(), val.replace("%", "*").lower()):
+                    return True
+                if op == "eq" and str(v) == val:
+                    return True
+                if op == "not" and val.startswith("eq.") and str(v) != val[3:]:
+                    return True
+            return False
+        return self._f(match)
+
+    def order(self, col, desc=False, **_kwargs):
+        self.orders.append((col, desc))
+        return self
+
+    def range(self, start, end, **_kwargs):
+        self.window = (start, end)
+        return self
+
+    def limit(self, n, **_kwargs):
+        self.lim = n
+        return self
+
+    def execute(self):
+        self.client.calls.append(self)
+        rows = [r for r in self.client.tables.get(self.table_name, []) if all(f(r) for f in self.filters)]
+        if self.client.shuffle_ties:
+            # 정렬 키가 같은 행의 순서를 호출마다 바꾼다(PostgREST는 동률 순서를 보장하지 않음)
+            self.client.rnd.shuffle(rows)
+        for col, desc in reversed(self.orders):
+            rows.sort(key=lambda r: (r.get(col) is None, r.get(col)), reverse=desc)
+        if self.window:
+            rows = rows[self.window[0]:self.window[1] + 1]
+        if self.lim is not None:
+            rows = rows[:self.lim]
+        if self.cols:
+            rows = [{c: r.get(c) for c in self.cols} for r in rows]
+        return FakeResult(copy.deepcopy(rows))
+
+
+class FakeClient:
+    def __init__(self, tables, shuffle_ties=False):
+        self.tables = tables
+        self.calls = []
+        self.shuffle_ties = shuffle_ties
+        self.rnd = random.Random(0)
+
+    def table(self, name):
+        return FakeQuery(self, name)
@@ -0,0 +1,38 @@
+from datetime import date
+
+import pytest
+from conftest import FakeClient
+
+import engine
+
+
+@pytest.fixture
+def capa_db(monkeypatch):
+    rows = [
+        {"날짜": "2025-01-10", "월": 1, "버전": "최종", "라인": "조립1", "capa": 2000, "비고": "x"},
+        {"날짜": "2026-01-12", "월": 1, "버전": "최종", "라인": "조립1", "capa": 3100, "비고": "x"},
+        {"날짜": None, "월": 2, "버전": "최종", "라인": "조립1", "capa": 2900, "비고": "x"},
+        {"날짜": "2026-01-13", "월": 1, "버전": "0차", "라인": "조립1", "capa": 1, "비고": "x"},
+    ]
+    client = FakeClient({"daily_capa": rows})
+    monkeypatch.setattr(engine, "supabase", client)
+    monkeypatch.setattr(engine, "HYBRID_DAILY_CAPA", True)
+    for name in ("TODAY", "CAPA_LIMITS", "DAILY_CAPA"):
+        monkeypatch.setattr(engine, name, getattr(engine, name))
+    engine.load_hybrid_daily_capa.clear()
+    yield client
+    engine.load_hybrid_daily_capa.clear()
+
+
+def test_month_capa_does_not_leak_across_years(capa_db):
+    engine.initialize_globals(date(2026, 1, 1), {"조립1": 3300}, engine.load_hybrid_daily_capa())
+    assert engine.capa_for("조립1", "2026-01-12") == 3100
+    assert engine.capa_for("조립1", "2026-01-20") == 3100  # 2026년 1월 값
+    assert engine.capa_for("조립1", "2027-01-20") == 3300  # 다른 해 1월은 기본값(2025년 값 아님)
+    assert engine.capa_for("조립1", "2026-02-03") == 2900  # 날짜 없는 월 행
+
+
+def test_daily_capa_uses_explicit_projection(capa_db):
+    engine.load_hybrid_daily_capa()
+    queries = [q for q in capa_db.calls if q.table_name == "daily_capa"]
+    assert queries and all(q.cols and "비고" not in q.cols for q in queries)
@@ -0,0 +1,197 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import engine
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *_args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        srv = self.server
+        with srv.lock:
+            srv.hits += 1
+            status, delay = srv.script.pop(0) if srv.script else (200, 0)
+        time.sleep(delay)
+        if "streamGenerateContent" in self.path:
+            return self._sse(srv.sse_finish)
+        if status == 200:
+            body = json.dumps({"candidates": [{"content": {"parts": [{"text": "ok"}]}}]}).encode()
+        else:
+            body = json.dumps({"error": {"code": status}}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _sse(self, finish):
+        events = [{"candidates": [{"content": {"parts": [{"text": t}]}}]} for t in ("안녕", "하세요")]
+        if finish:
+            events[-1]["candidates"][0]["finishReason"] = "STOP"
+        body = "".join(f"data: {json.dumps(e)}\r\n\r\n" for e in events).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    srv.lock, srv.hits, srv.script, srv.sse_finish = threading.Lock(), 0, [], True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def _transport(server, **kwargs):
+    opts = dict(connect_timeout=1.0, read_timeout=1.0, deadline=5.0, max_retries=3, backoff=0.01)
+    opts.update(kwargs)
+    return engine.GeminiTransport("test-key", base_url=f"http://127.0.0.1:{server.server_address[1]}", **opts)
+
+
+def _spy_close(transport):
+    """session.post가 돌려준 응답마다 close 호출 여부를 기록"""
+    responses = []
+    post = transport.session.post
+
+    def spy(*args, **kwargs):
+        r = post(*args, **kwargs)
+        r.closed_by_caller = False
+        close = r.close
+
+        def _close():
+            r.closed_by_caller = True
+            close()
+        r.close = _close
+        responses.append(r)
+        return r
+    transport.session.post = spy
+    return responses
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_retryable_status_is_retried(server, status):
+    server.script = [(status, 0), (status, 0)]
+    t = _transport(server)
+    assert t.generate("hi") == "ok"
+    assert server.hits == 3
+    assert t.stats()["retries"] == 2 and t.stats()["errors"] == 0
+
+
+def test_retries_are_bounded(server):
+    server.script = [(503, 0)] * 10
+    t = _transport(server, max_retries=2)
+    with pytest.raises(engine.GeminiError, match="503"):
+        t.generate("hi")
+    assert server.hits == 3
+    assert t.stats()["errors"] == 1
+
+
+@pytest.mark.parametrize("status", [400, 403, 404])
+def test_non_retryable_status_fails_fast_and_closes(server, status):
+    server.script = [(status, 0)]
+    t = _transport(server)
+    responses = _spy_close(t)
+    with pytest.raises(engine.GeminiError, match=str(status)):
+        t.generate("hi")
+    assert server.hits == 1
+    assert t.stats()["retries"] == 0
+    assert [r.closed_by_caller for r in responses] == [True]
+
+
+def test_deadline_bounds_slow_retries(server):
+    server.script = [(200, 2.0)] * 10
+    t = _transport(server, read_timeout=0.3, deadline=1.0, max_retries=10)
+    t0 = time.monotonic()
+    with pytest.raises(engine.GeminiError):
+        t.generate("hi")
+    assert time.monotonic() - t0 < 2.0
+    assert t.stats()["errors"] == 1
+
+
+def test_stream_yields_chunks_until_finish(server):
+    t = _transport(server)
+    assert list(t.stream("hi")) == ["안녕", "하세요"]
+    assert t.stats()["errors"] == 0
+
+
+def test_stream_without_finish_reason_is_an_error(server):
+    server.sse_finish = False
+    t = _transport(server)
+    chunks = []
+    with pytest.raises(engine.GeminiError, match="finishReason"):
+        for chunk in t.stream("hi"):
+            chunks.append(chunk)
+    assert chunks == ["안녕", "하세요"]
+    assert t.stats()["errors"] == 1
+
+
+def test_truncated_legacy_stream_appends_notice(server, monkeypatch):
+    server.sse_finish = False
+    monkeypatch.setattr(engine, "gemini_transport", _transport(server))
+    monkeypatch.setattr(engine, "llm_cache", None)
+    monkeypatch.setattr(engine, "render_legacy_template", lambda ctx: None)
+    out = list(engine.query_gemini_legacy_stream("질문", "context"))
+    assert out == ["안녕", "하세요", engine.STREAM_TRUNCATED_NOTICE]
+
+
+def test_shutdown_engine_loop_closes_async_client(server, monkeypatch):
+    t = _transport(server)
+    monkeypatch.setattr(engine, "gemini_transport", t)
+    assert engine.run_sync(t.aio().generate("hi")) == "ok"
+    loop = engine._ENGINE_LOOP
+    (client,) = list(t.aio()._clients.values())
+
+    engine.shutdown_engine_loop()
+    assert client.is_closed
+    assert engine._ENGINE_LOOP is None
+    for _ in range(100):
+        if loop.is_closed():
+            break
+        time.sleep(0.01)
+    assert loop.is_closed()
+
+    # 종료 후 호출하면 새 루프/클라이언트로 다시 동작
+    assert engine.run_sync(t.aio().generate("hi")) == "ok"
+    engine.shutdown_engine_loop()
+
+
+def test_per_call_deadline_shortens_transport_deadline(server):
+    server.script = [(200, 2.0)] * 10
+    t = _transport(server, read_timeout=5.0, deadline=10.0, max_retries=10)
+    t0 = time.monotonic()
+    with pytest.raises(engine.GeminiError):
+        t.generate("hi", deadline=0.5)
+    assert time.monotonic() - t0 < 1.5
+
+
+def test_stream_closed_early_still_records_latency(server):
+    t = _transport(server)
+    it = t.stream("hi")
+    assert next(it) == "안녕"
+    it.close()
+    stats = t.stats()
+    assert stats["calls"] == 2 and stats["errors"] == 0  # 연결(post) + 스트림
+
+
+def test_async_per_call_deadline_shortens_transport_deadline(server):
+    server.script = [(200, 2.0)] * 10
+    t = _transport(server, read_timeout=5.0, deadline=10.0, max_retries=10)
+    t0 = time.monotonic()
+    with pytest.raises(engine.GeminiError):
+        engine.run_sync(t.aio().generate("hi", deadline=0.5))
+    assert time.monotonic() - t0 < 1.5
+    engine.shutdown_engine_loop()
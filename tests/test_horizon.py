@@ -0,0 +1,88 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import pandas as pd
+
+import engine
+
+CAPA = {"조립1": 3300, "조립2": 3700, "조립3": 3600}
+
+
+def _plan():
+    """2026-01-05/06 조립1이 목표(2,600)를 넘고, 이후 근무일은 목표 바로 아래(2,300)인 계획"""
+    rows = []
+    for k in range(21):
+        d = date(2026, 1, 5) + timedelta(days=k)
+        workday = d.weekday() < 5
+        ds = d.isoformat()
+        if not workday:
+            rows.append({"plan_date": ds, "line": "조립1", "product_name": "D1-BASE", "qty_0차": 0, "qty_1차": 0,
+                         "plt": 100, "is_workday": False})
+            continue
+        heavy = {0: 3500, 1: 3400}.get(k)
+        rows.append({"plan_date": ds, "line": "조립1", "product_name": "D1-MOVE" if heavy else "D1-BASE",
+                     "qty_0차": 0, "qty_1차": heavy or 2300, "plt": 100, "is_workday": True})
+        for line in ("조립2", "조립3"):
+            rows.append({"plan_date": ds, "line": line, "product_name": f"D9-{line}", "qty_0차": 0,
+                         "qty_1차": 1000, "plt": 100, "is_workday": True})
+    return engine.PlanFrame(engine.typed_plan_frame(pd.DataFrame(rows)))
+
+
+def _final_loads(pf, results):
+    delta = collections.Counter()
+    for r in results:
+        for mv in r["moves"]:
+            delta[tuple(mv["to"].split("_", 1))] += int(mv["qty"])
+            delta[tuple(mv["from"].split("_", 1))] -= int(mv["qty"])
+    return {k: pf.total(*k) + v for k, v in delta.items()}
+
+
+def test_horizon_levels_sources_without_pushing_destinations_over_target():
+    pf = _plan()
+    cells = [("2026-01-05", "조립1"), ("2026-01-06", "조립1")]
+    results = engine._plan_horizon_window(pf, cells, 0.8, CAPA, {}, engine.HYBRID_OPT_NODE_BUDGET)
+    target = engine._round_target(int(CAPA["조립1"] * 0.8), engine.HYBRID_TARGET_ROUNDING)
+
+    assert [(r["date"], r["line"]) for r in results] == cells
+    for r in results:
+        assert r["target"] == target
+        assert r["total"] - r["moved"] <= r["target"]
+    loads = _final_loads(pf, results)
+    over = {(d, ln): v for (d, ln), v in loads.items() if v > engine._round_target(
+        int(CAPA[ln] * 0.8), engine.HYBRID_TARGET_ROUNDING)}
+    assert over == {}
+
+
+def test_horizon_plan_does_not_depend_on_globals_or_workers():
+    pf = _plan()
+    cells = [("2026-01-05", "조립1"), ("2026-01-06", "조립1")]
+    engine.initialize_globals(date(2026, 1, 1), {"조립1": 1, "조립2": 1, "조립3": 1})
+    try:
+        seq = engine._plan_horizon_window(pf, cells, 0.8, CAPA, {}, 500)
+        with ThreadPoolExecutor(4) as pool:
+            par = list(pool.map(lambda _: engine._plan_horizon_window(pf, cells, 0.8, CAPA, {}, 500), range(8)))
+        assert engine.CAPA_LIMITS == {"조립1": 1, "조립2": 1, "조립3": 1}
+    finally:
+        engine.initialize_globals(date(2026, 1, 1), CAPA)
+    assert all(p == seq for p in par)
+
+
+def test_sweep_plans_match_across_workers_and_leave_globals_alone(monkeypatch):
+    pf = _plan()
+    engine.initialize_globals(date(2026, 1, 1), CAPA)
+    ledger = engine.CapacityLedger.from_plan(pf)
+    stock, err = engine.step1_list_current_stock(pf, "2026-01-05", "조립1")
+    assert not err
+    constraint_info = engine.step4_prepare_constraint_info(engine.step2_calculate_cumulative_slack(pf, stock), "조립1")
+    capa_status = engine.step3_analyze_destination_capacity(pf, "2026-01-05", "조립1", ledger)
+
+    def no_globals(*_args, **_kwargs):
+        raise AssertionError("sweep workers must not reset engine globals")
+    monkeypatch.setattr(engine, "initialize_globals", no_globals)
+    monkeypatch.setattr(engine, "HYBRID_OPT_NODE_BUDGET", 300)
+    percents = (0.7, 0.75, 0.8, 0.85)
+    seq = engine.hybrid_sweep(pf, ledger, stock, constraint_info, capa_status, percents, workers=1)
+    par = engine.hybrid_sweep(pf, ledger, stock, constraint_info, capa_status, percents, workers=4)
+    assert seq == par
+    assert [r["pct"] for r in seq] == [70.0, 75.0, 80.0, 85.0]
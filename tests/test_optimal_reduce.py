@@ -0,0 +1,25 @@
+import random
+import sys
+
+import pytest
+
+import engine
+from bench import _reduce_instance
+
+
+@pytest.mark.parametrize("n_items,days", [(120, 10), (80, 20), (80, 40)])
+def test_deep_search_does_not_recurse(n_items, days):
+    ci, cs, from_loc, line, need = _reduce_instance(random.Random(7), n_items, days)
+    greedy = engine._fallback_reduce(ci, {k: dict(v) for k, v in cs.items()}, from_loc, line, need)
+    limit = sys.getrecursionlimit()
+    # 탐색 깊이(품목 x 목적지 칸)가 이 한도를 훨씬 넘는다: 재귀로 돌면 RecursionError
+    sys.setrecursionlimit(300)
+    try:
+        moves, info = engine._optimal_reduce(ci, cs, from_loc, line, need, time_limit=0.5)
+    finally:
+        sys.setrecursionlimit(limit)
+
+    plt = {it["name"]: it["plt"] for it in ci}
+    assert info["qty"] >= sum(m["qty"] for m in greedy)
+    assert sum(m["qty"] for m in moves) == info["qty"] <= need
+    assert all(m["qty"] % plt[m["item"]] == 0 and m["to"] in cs for m in moves)
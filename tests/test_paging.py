@@ -0,0 +1,69 @@
+import pytest
+
+import engine
+from conftest import FakeClient
+
+
+@pytest.fixture
+def remote():
+    return FakeClient({"production_data": [{"id": i, "품명": f"P{i % 4}"} for i in reversed(range(23))]})
+
+
+def test_every_page_carries_the_order_key(remote):
+    rows = engine.fetch_all(lambda: remote.table("production_data").select("id"), ["id"], page_size=5).data
+    assert [r["id"] for r in rows] == list(range(23))
+    assert len(remote.calls) == 5
+    assert all(q.orders == [("id", False)] and q.window is not None for q in remote.calls)
+
+
+def test_multi_column_order_is_applied_in_sequence(remote):
+    engine.fetch_all(lambda: remote.table("production_data").select("id, 품명"), ["품명", "id"], page_size=50)
+    assert remote.calls[0].orders == [("품명", False), ("id", False)]
+
+
+def test_missing_order_key_is_rejected(remote):
+    with pytest.raises(ValueError):
+        engine.fetch_all(lambda: remote.table("production_data").select("id"), [])
+
+
+def test_order_completes_with_all_selected_columns():
+    assert engine.table_order_keys("daily_capa", ["capa", "라인", "월"]) == ["월", "라인", "capa"]
+    assert engine.table_order_keys("final_issue", ["날짜", "품목명"]) == ["날짜", "품목명"]
+    with pytest.raises(ValueError):
+        engine.table_order_keys("final_issue", ["*"])
+
+
+def _capa_rows():
+    # 월/버전/라인이 같고 날짜/capa만 다른 행: 선두 키만으로는 동률
+    return [{"월": 1, "버전": "최종", "라인": "조립1", "날짜": f"2026-01-{d:02d}", "capa": 3000 + d} for d in range(1, 24)]
+
+
+def test_tied_order_keys_neither_duplicate_nor_drop_rows():
+    remote = FakeClient({"daily_capa": _capa_rows()}, shuffle_ties=True)
+    order = engine.page_order_for(remote, "daily_capa")
+    assert order[:4] == ["월", "버전", "날짜", "라인"] and "capa" in order
+    for _ in range(5):
+        rows = engine.fetch_all(lambda: remote.table("daily_capa").select("*"), order, page_size=4).data
+        assert sorted(r["날짜"] for r in rows) == [r["날짜"] for r in _capa_rows()]
+
+
+def test_leading_keys_alone_would_drop_rows():
+    # 대조군: 동률이 남는 정렬(월/버전/라인)로는 페이지 경계에서 행이 중복/누락된다
+    remote = FakeClient({"daily_capa": _capa_rows()}, shuffle_ties=True)
+    seen = engine.fetch_all(lambda: remote.table("daily_capa").select("*"), ["월", "버전", "라인"], page_size=4).data
+    assert len({r["날짜"] for r in seen}) < len(seen)
+
+
+def test_missing_configured_key_falls_back_to_real_columns(monkeypatch):
+    monkeypatch.setitem(engine.PAGED_ORDER_KEYS, "production_data", ["id"])
+    remote = FakeClient({"production_data": [{"품명": f"P{i % 3}", "생산량": i} for i in range(7)]}, shuffle_ties=True)
+    order = engine.page_order_for(remote, "production_data")
+    assert order == ["품명", "생산량"]
+    rows = engine.fetch_all(lambda: remote.table("production_data").select("*"), order, page_size=2).data
+    assert sorted(r["생산량"] for r in rows) == list(range(7))
+
+
+def test_empty_table_pages_nothing():
+    remote = FakeClient({"monthly_production": []})
+    order = engine.page_order_for(remote, "monthly_production")
+    assert engine.fetch_all(lambda: remote.table("monthly_production").select("*"), order).data == []
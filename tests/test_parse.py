@@ -0,0 +1,55 @@
+import pytest
+
+import engine
+
+
+@pytest.mark.parametrize("prompt,expected", [
+    ("2026-01-06 조립2 70~85%", (0.7, 0.75, 0.8, 0.85)),
+    ("1/6 조립1 70%-85%", (0.7, 0.75, 0.8, 0.85)),
+    ("1/7 조립2 샘플 200 추가 70~90% 10%씩", (0.7, 0.8, 0.9)),
+    ("1/12 조립1 70%, 80%", (0.7, 0.8)),
+    ("1/12 조립1 70, 75, 80, 85% 비교", (0.7, 0.75, 0.8, 0.85)),
+    ("1/12 조립3 스윕 70, 80, 90", (0.7, 0.8, 0.9)),
+])
+def test_sweep_lists_and_ranges(prompt, expected):
+    assert engine._parse_sweep_percents(prompt) == expected
+
+
+@pytest.mark.parametrize("prompt", [
+    "1/6 조립1, 80% 줄여",
+    "1/6 조립1 80%",
+    "1/6-1/8 조립1 80%",
+    "1월 6일 조립3, 80%",
+    "2026-01-06 조립2, 75%만 생산",
+    "1/6 조립1 샘플 100, 80%",
+    "1/12 조립1 70, 75, 80, 85%",  # %도 키워드도 없는 맨 숫자 목록
+])
+def test_dates_lines_and_single_percent_are_not_sweeps(prompt):
+    assert engine._parse_sweep_percents(prompt) == ()
+
+
+def test_values_below_floor_are_dropped():
+    assert engine._parse_sweep_percents("1/6 조립1 5%, 10% 비교") == ()
+    assert engine._parse_sweep_percents("1/6 조립1 10%, 70%, 80%") == (0.7, 0.8)
+
+
+def test_single_percent_prompt_routes_to_single_target():
+    plan = engine.parse_query("1/6 조립1, 80% 줄여")
+    assert plan.sweep_percents == ()
+    assert plan.target_percent == 0.8
+
+
+def test_route_and_answer_runs_on_calling_thread(monkeypatch):
+    import threading
+    seen = {}
+
+    def fake_legacy(prompt, plan):
+        seen["thread"] = threading.current_thread()
+        return "답변"
+    monkeypatch.setattr(engine, "run_legacy", fake_legacy)
+    monkeypatch.setattr(engine, "run_hybrid", fake_legacy)
+    monkeypatch.setattr(engine, "_engine_loop", lambda: pytest.fail("sync path must not use the engine loop"))
+    ans, debug = engine.route_and_answer("1월 조립1 생산량")
+    assert ans == "답변"
+    assert seen["thread"] is threading.current_thread()
+    assert debug["route"] in ("legacy", "hybrid")
@@ -0,0 +1,97 @@
+import threading
+import time
+from datetime import date, timedelta
+
+import engine
+
+
+class SlowFetch:
+    def __init__(self, delay=0.3, fail=False):
+        self.delay, self.fail = delay, fail
+        self.calls = []
+        self.started = threading.Event()
+
+    def __call__(self, start, end):
+        self.calls.append((start, end))
+        self.started.set()
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("boom")
+        d, last = date.fromisoformat(start), date.fromisoformat(end)
+        rows = []
+        while d <= last:
+            rows.append({"plan_date": d.isoformat(), "qty_0차": 1})
+            d += timedelta(days=1)
+        return rows
+
+
+def _run_concurrently(fn, n):
+    out, errors = [None] * n, []
+
+    def work(i):
+        try:
+            out[i] = fn()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return out, errors
+
+
+def test_concurrent_requests_share_one_fetch():
+    fetch = SlowFetch()
+    cache = engine.PlanWindowCache(fetch, ttl=60)
+    out, errors = _run_concurrently(lambda: cache.get("2026-01-01", "2026-01-10"), 5)
+    assert not errors
+    assert fetch.calls == [("2026-01-01", "2026-01-10")]
+    assert all(len(df) == 10 for df in out)
+
+
+def test_lock_is_not_held_during_fetch():
+    fetch = SlowFetch(delay=0.5)
+    cache = engine.PlanWindowCache(fetch, ttl=60)
+    t = threading.Thread(target=cache.get, args=("2026-01-01", "2026-01-10"))
+    t.start()
+    fetch.started.wait(1)
+    t0 = time.monotonic()
+    cache.stats()
+    df = cache.get("2026-02-01", "2026-02-03")  # 다른 구간은 첫 조회를 기다리지 않는다
+    assert time.monotonic() - t0 < 0.9
+    assert len(df) == 3
+    t.join()
+
+
+def test_overlapping_request_fetches_only_the_uncovered_part():
+    fetch = SlowFetch()
+    cache = engine.PlanWindowCache(fetch, ttl=60)
+    t = threading.Thread(target=cache.get, args=("2026-01-01", "2026-01-10"))
+    t.start()
+    fetch.started.wait(1)
+    df = cache.get("2026-01-05", "2026-01-15")
+    t.join()
+    assert sorted(fetch.calls) == [("2026-01-01", "2026-01-10"), ("2026-01-11", "2026-01-15")]
+    assert list(df["plan_date"]) == [f"2026-01-{d:02d}" for d in range(5, 16)]
+
+
+def test_failed_fetch_reaches_waiters_and_is_retried():
+    fetch = SlowFetch(fail=True)
+    cache = engine.PlanWindowCache(fetch, ttl=60)
+    _, errors = _run_concurrently(lambda: cache.get("2026-01-01", "2026-01-03"), 3)
+    assert len(errors) == 3 and len(fetch.calls) == 1
+    fetch.fail = False
+    assert len(cache.get("2026-01-01", "2026-01-03")) == 3
+    assert len(fetch.calls) == 2
+
+
+def test_fetch_started_before_invalidate_is_not_cached():
+    fetch = SlowFetch()
+    cache = engine.PlanWindowCache(fetch, ttl=60)
+    t = threading.Thread(target=cache.get, args=("2026-01-01", "2026-01-03"))
+    t.start()
+    fetch.started.wait(1)
+    cache.invalidate()
+    t.join()
+    assert cache.stats()["segments"] == []
@@ -0,0 +1,86 @@
+import threading
+
+import engine
+from conftest import FakeClient, FakeResult
+
+
+class SlowClient(FakeClient):
+    """production_data 조회가 gate가 열릴 때까지 멈추는 클라이언트(rpc 선택)"""
+
+    def __init__(self, tables, names_rpc=None):
+        super().__init__(tables)
+        self.gate = threading.Event()
+        self.names_rpc = names_rpc
+        self.rpc_calls = 0
+
+    def table(self, name):
+        self.gate.wait(5)
+        return super().table(name)
+
+    def rpc(self, fn, params):
+        self.rpc_calls += 1
+        if self.names_rpc is None:
+            raise RuntimeError(f"function {fn} does not exist")
+        return _Exec([{"품명": n} for n in self.names_rpc])
+
+
+class _Exec:
+    def __init__(self, data):
+        self.data = data
+
+    def execute(self):
+        return FakeResult(self.data)
+
+
+def _rows(names):
+    return {"production_data": [{"품명": n, "생산량": i} for i, n in enumerate(names)]}
+
+
+def _catalog(monkeypatch, client, rpc="legacy_product_names"):
+    monkeypatch.setattr(engine, "supabase", client)
+    monkeypatch.setattr(engine, "legacy_snapshot", None)
+    return engine.ProductCatalog(ttl=3600, rpc=rpc)
+
+
+def test_first_lookup_does_not_wait_for_the_build(monkeypatch):
+    client = SlowClient(_rows(["T6X001A", "A2XX1"]))
+    catalog = _catalog(monkeypatch, client, rpc="")
+    assert catalog.index() is None  # 색인이 없으면 기다리지 않고 None(ilike 조회)
+    assert catalog.index() is None
+    client.gate.set()
+    catalog.refresh(wait=True)
+    assert sorted(catalog.index().names) == ["A2XX1", "T6X001A"]
+
+
+def test_stale_index_is_served_while_rebuilding(monkeypatch):
+    client = SlowClient(_rows(["T6X001A"]))
+    client.gate.set()
+    catalog = _catalog(monkeypatch, client, rpc="")
+    catalog.refresh(wait=True)
+    old = catalog.index()
+
+    client.gate.clear()
+    client.tables["production_data"].append({"품명": "NEW1", "생산량": 0})
+    catalog.invalidate("production_data")
+    assert catalog.index() is old
+    assert catalog.index() is old  # 갱신은 한 번만 진행
+    client.gate.set()
+    catalog.refresh(wait=True)
+    assert "NEW1" in catalog.index().names
+
+
+def test_distinct_names_come_from_rpc(monkeypatch):
+    client = SlowClient(_rows([]), names_rpc=["T6X001A", "A2XX1"])
+    catalog = _catalog(monkeypatch, client)
+    catalog.refresh(wait=True)
+    assert sorted(catalog.index().names) == ["A2XX1", "T6X001A"]
+    assert client.calls == []  # 행을 훑지 않음
+
+
+def test_missing_rpc_falls_back_to_paging(monkeypatch):
+    client = SlowClient(_rows(["T6X001A", "T6X001A", "A2XX1"]))
+    client.gate.set()
+    catalog = _catalog(monkeypatch, client)
+    catalog.refresh(wait=True)
+    assert sorted(catalog.index().names) == ["A2XX1", "T6X001A"]
+    assert client.rpc_calls == 1 and client.calls
@@ -0,0 +1,38 @@
+from datetime import date
+
+import pytest
+
+import engine
+from bench import _slack_reference, _synthetic_plan
+
+
+@pytest.fixture(autouse=True)
+def _globals():
+    engine.initialize_globals(date(2026, 1, 1), {"조립1": 3300, "조립2": 3700, "조립3": 3600})
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_vectorized_slack_matches_loop_reference(seed):
+    df = _synthetic_plan(days=40, products=60, seed=seed)
+    pf = engine.PlanFrame(df)
+    dates = sorted(df["plan_date"].unique())
+    checked = 0
+    for d in dates[::4]:
+        for line in ("조립1", "조립2", "조립3"):
+            stock, _ = engine.step1_list_current_stock(df, d, line)
+            if not stock:
+                continue
+            ref = _slack_reference(df, stock)
+            assert engine.step2_calculate_cumulative_slack(pf, stock) == ref, (d, line)
+            assert engine.step2_calculate_cumulative_slack(df, stock) == ref, (d, line)
+            checked += 1
+    assert checked > 0
+
+
+def test_slack_table_on_typed_frame_matches_reference():
+    df = _synthetic_plan(days=30, products=40, seed=7)
+    pf = engine.PlanFrame(engine.typed_plan_frame(df))
+    for d in sorted(df["plan_date"].unique())[::3]:
+        stock, _ = engine.step1_list_current_stock(df, d, "조립1")
+        if stock:
+            assert engine.step2_calculate_cumulative_slack(pf, stock) == _slack_reference(df, stock)
@@ -0,0 +1,188 @@
+import time
+
+import pytest
+
+import engine
+from conftest import FakeClient
+
+TABLES = ["production_data", "daily_capa"]
+
+
+def _rows():
+    prod = []
+    for i in range(25):
+        prod.append({
+            "id": i, "월": 10 + i % 2, "버전": ["0차", "최종"][i % 2], "구분": ["Fan", "Motor"][i % 2],
+            "품명": f"T6X{i:03d}A" if i % 3 else f"A2XX{i}", "생산량": 10 * i,
+            "생산일": f"2025-10-{1 + i:02d}T00:00:00", "updated_at": i,
+        })
+    capa = [{"월": 10, "버전": "최종", "라인": str(n), "capa": c} for n, c in [(1, 3300), (2, 3700), (3, 3600)]]
+    return {"production_data": prod, "daily_capa": capa}
+
+
+@pytest.fixture
+def remote():
+    return FakeClient(_rows())
+
+
+@pytest.fixture
+def store(tmp_path, remote):
+    s = engine.LocalSnapshotStore(str(tmp_path / "snap.sqlite3"), remote, TABLES, page_size=10)
+    s.sync_all()
+    return s
+
+
+def _local(store, remote, build):
+    """같은 빌더 체인을 스냅샷과 원격에 각각 실행해 (로컬 결과, 원격 결과)"""
+    return build(store.table("production_data")).execute().data, build(remote.table("production_data")).execute().data
+
+
+@pytest.mark.parametrize("build", [
+    lambda q: q.select("id, 품명").eq("월", 10).order("id"),
+    lambda q: q.select("id").gte("id", 5).lt("id", 9).neq("id", 6).order("id"),
+    lambda q: q.select("id, 품명").ilike("품명", "%a2xx%").order("id"),
+    lambda q: q.select("id, 품명").like("품명", "A2XX%").order("id"),
+    lambda q: q.select("id").in_("구분", ["Motor"]).order("id", desc=True),
+    lambda q: q.select("id").order("생산량", desc=True).range(3, 7),
+    lambda q: q.select("id").or_("품명.ilike.%A2XX%,구분.eq.Motor").order("id"),
+])
+def test_snapshot_query_matches_remote(store, remote, build):
+    local, live = _local(store, remote, build)
+    assert local == live
+    assert local
+
+
+def test_date_filters_compare_on_date_part(store):
+    # timestamp 컬럼에 날짜 문자열로 비교하면 DB처럼 날짜 부분(앞 10자리)으로 비교한다
+    rows = store.table("production_data").select("id").gte("생산일", "2025-10-05").lte("생산일", "2025-10-09") \
+        .order("id").execute().data
+    assert [r["id"] for r in rows] == [4, 5, 6, 7, 8]
+
+
+def test_sync_mirrors_tables(store, remote):
+    assert all(store.is_ready(t) for t in TABLES)
+    assert store.table("daily_capa").select("라인, capa").order("라인").execute().data == [
+        {"라인": "1", "capa": 3300}, {"라인": "2", "capa": 3700}, {"라인": "3", "capa": 3600}]
+
+
+def test_incremental_sync_upserts_by_key(tmp_path, remote):
+    s = engine.LocalSnapshotStore(str(tmp_path / "snap.sqlite3"), remote, ["production_data"],
+                                  cursors={"production_data": {"cursor": "updated_at", "keys": ["id"]}}, page_size=10)
+    s.sync_all()
+    remote.tables["production_data"][0].update({"생산량": 999, "updated_at": 100})
+    remote.tables["production_data"].append({"id": 99, "월": 10, "버전": "최종", "구분": "Fan", "품명": "NEW",
+                                             "생산량": 1, "생산일": "2025-10-30", "updated_at": 101})
+    assert s.sync_table("production_data") == 2
+    rows = s.table("production_data").select("id, 생산량").in_("id", [0, 99]).order("id").execute().data
+    assert rows == [{"id": 0, "생산량": 999}, {"id": 99, "생산량": 1}]
+    assert s.table("production_data").select("id").execute().data.__len__() == 26
+
+
+def test_like_is_case_sensitive(store):
+    q = store.table("production_data").select("id")
+    assert q.like("품명", "a2xx%").execute().data == []
+    rows = store.table("production_data").select("id").or_("품명.like.A2XX*").order("id").execute().data
+    assert [r["id"] for r in rows] == [i for i in range(25) if i % 3 == 0]
+
+
+def test_offset_without_limit(store):
+    rows = store.run_select("production_data", ["id"], [], [], ['"id" ASC'], None, 20)
+    assert [r["id"] for r in rows] == [20, 21, 22, 23, 24]
+
+
+def _incremental_store(tmp_path, remote, **kwargs):
+    s = engine.LocalSnapshotStore(str(tmp_path / "snap.sqlite3"), remote, ["production_data"],
+                                  cursors={"production_data": {"cursor": "updated_at", "keys": ["id"]}},
+                                  page_size=10, **kwargs)
+    s.sync_all()
+    return s
+
+
+def test_incremental_sync_picks_up_rows_at_the_watermark(tmp_path, remote):
+    s = _incremental_store(tmp_path, remote)
+    # 워터마크(24)와 같은 시각으로 나중에 커밋된 행
+    remote.tables["production_data"].append({"id": 77, "월": 10, "버전": "최종", "구분": "Fan", "품명": "LATE",
+                                             "생산량": 1, "생산일": "2025-10-30", "updated_at": 24})
+    assert s.sync_table("production_data") == 1
+    assert s.table("production_data").select("id").eq("id", 77).execute().data == [{"id": 77}]
+    # 변경이 없으면 워터마크 행을 다시 받아도 적용할 행이 없다
+    assert s.sync_table("production_data") == 0
+
+
+def test_full_resync_drops_deleted_rows(tmp_path, remote):
+    s = _incremental_store(tmp_path, remote, full_resync=3600)
+    del remote.tables["production_data"][3]
+    s.sync_table("production_data")
+    assert len(s.table("production_data").select("id").execute().data) == 25  # 증분은 삭제를 보지 못함
+
+    with s._lock:
+        s._conn.execute("UPDATE _snapshot_meta SET full_synced_at = ?", (time.time() - 7200,))
+        s._conn.commit()
+    s.sync_table("production_data")
+    assert len(s.table("production_data").select("id").execute().data) == 24
+
+
+def test_unsupported_or_operator_runs_on_remote(store, remote):
+    before = len(remote.calls)
+    rows = store.table("production_data").select("id").or_("구분.not.eq.Motor").order("id").execute().data
+    assert [r["id"] for r in rows] == [i for i in range(25) if i % 2 == 0]
+    assert len(remote.calls) == before + 1
+    assert store.remote_fallbacks == 1
+
+
+def test_unknown_column_runs_on_remote(store, remote):
+    remote.tables["production_data"][0]["비고"] = "x"
+    rows = store.table("production_data").select("id, 비고").eq("id", 0).execute().data
+    assert rows == [{"id": 0, "비고": "x"}]
+
+
+def test_empty_table_uses_projection_schema(tmp_path):
+    remote = FakeClient({"daily_capa": []})
+    s = engine.LocalSnapshotStore(str(tmp_path / "snap.sqlite3"), remote, ["daily_capa"])
+    s.sync_all()
+    assert s.is_ready("daily_capa")
+    assert s.table("daily_capa").select("라인, capa").eq("월", 10).execute().data == []
+
+
+def test_stale_snapshot_routes_to_remote(store, remote):
+    client = engine._SnapshotRoutingClient(store, remote)
+    assert isinstance(client.table("production_data"), engine._SnapshotQuery)
+
+    store.max_age = 60
+    with store._lock:
+        store._conn.execute("UPDATE _snapshot_meta SET synced_at = ?", (time.time() - 3600,))
+        store._conn.commit()
+    assert not store.is_ready("production_data")
+    assert not isinstance(client.table("production_data"), engine._SnapshotQuery)
+    assert client.table("daily_capa").select("capa").eq("라인", "2").execute().data == [{"capa": 3700}]
+
+
+def test_routing_client_sends_unsynced_tables_to_remote(store, remote):
+    client = engine._SnapshotRoutingClient(store, remote)
+    remote.tables["monthly_production"] = [{"월": 1, "총_생산량": 5}]
+    assert client.table("monthly_production").select("총_생산량").execute().data == [{"총_생산량": 5}]
+
+
+def test_version_changes_only_when_rows_change(store, remote):
+    synced = []
+    store.on_synced.append(synced.append)
+    v0 = store.version()
+    assert store.sync_all() == {"production_data": 0, "daily_capa": 0}
+    assert store.version() == v0 and synced == []
+
+    remote.tables["daily_capa"][0]["capa"] = 3400
+    assert store.sync_table("daily_capa") == 3
+    assert store.version() != v0 and synced == ["daily_capa"]
+    assert store.table("daily_capa").select("capa").eq("라인", "1").execute().data == [{"capa": 3400}]
+
+
+def test_llm_cache_is_cleared_by_snapshot_changes(store, remote):
+    cache = engine.LLMResponseCache()
+    store.on_synced.append(cache.invalidate)
+    key = cache.make_key("m", "prompt", store.version())
+    cache.put(key, "answer")
+    store.sync_all()
+    assert cache.get(key) == "answer"
+    remote.tables["daily_capa"].pop()
+    store.sync_all()
+    assert cache.get(key) is None